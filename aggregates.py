@@ -0,0 +1,70 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+from columnar import LogColumns
+
+
+# Running per-user aggregates of finished logs: the totals of every project over the whole history,
+#   {"total": {"all": {project: [duration, pause, n_logs]}}}
+# "total" is the part stored under the meta key "aggr:total" (see `db.Storage`), "all" the layout it was
+# first stored in. The size depends on the number of projects and not on the history, and nothing depends
+# on the timezone of the user. Summaries of periods are answered by the engine (`Backend.period_totals`)
+PARTS = ("total",)
+
+
+def empty() -> Dict[str, dict]:
+    return {part: {} for part in PARTS}
+
+
+def add_log(aggr: Dict[str, dict], log: dict, sign: int = 1) -> None:
+    ''' add a finished log to the aggregates (or subtract it with sign=-1), O(1) '''
+    _add(aggr, log["name"], log["stop"] - log["start"] - log["pause"], log["pause"], sign)
+
+
+def _add(aggr: Dict[str, dict], name: str, duration: int, pause: int, sign: int = 1) -> None:
+    projects = aggr["total"].setdefault("all", {})
+    totals = projects.setdefault(name, [0, 0, 0])
+    totals[0] += sign * duration
+    totals[1] += sign * pause
+    totals[2] += sign
+    # drop empty entries, so that a removed project does not show up in the summary
+    if totals[2] <= 0:
+        del projects[name]
+        if not projects:
+            del aggr["total"]["all"]
+
+
+def remove_log(aggr: Dict[str, dict], log: dict) -> None:
+    add_log(aggr, log, sign=-1)
+
+
+def rebuild(logs: Iterable[dict]) -> Dict[str, dict]:
+    ''' recompute the aggregates from raw (finished) logs '''
+    aggr = empty()
+    for log in logs:
+        add_log(aggr, log)
+    return aggr
+
+
+def rebuild_columns(columns: LogColumns, skip: Optional[str] = None) -> Dict[str, dict]:
+    ''' recompute the aggregates from the columnar layout, `skip` is the ID of a log to leave out (the running one) '''
+    aggr = empty()
+    skipped = columns.position(skip) if skip is not None else -1
+    projects = columns.projects
+    for i, (start, stop, pause, pid) in enumerate(zip(columns.starts, columns.stops, columns.pauses, columns.project_ids)):
+        if i != skipped:
+            _add(aggr, projects[pid], stop - start - pause, pause)
+    return aggr
+
+
+def verify(aggr: Dict[str, dict], logs: Iterable[dict]) -> Tuple[bool, Dict[str, dict]]:
+    ''' compare the aggregates with the ones recomputed from raw logs, return (is_valid, recomputed) '''
+    expected = rebuild(logs)
+    return aggr == expected, expected
+
+
+def totals(aggr: Dict[str, dict]) -> Dict[str, dict]:
+    ''' return the per-project totals in the format of `Storage.aggregate_user_logs` '''
+    return {
+        prj_name: {"duration": duration, "pause": pause, "n_logs": n_logs}
+        for prj_name, (duration, pause, n_logs) in aggr["total"].get("all", {}).items()
+    }
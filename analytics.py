@@ -0,0 +1,190 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # the bot works without numpy, only the stats screens need it
+    np = None
+
+from columnar import LogColumns
+from helpers import Timezone, now_timestamp, timedelta_to_str, utc_offset
+
+
+DAY = 86400
+WEEKDAYS = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("numpy is required for analytics, install it with `pip install numpy`")
+
+
+class LogArrays():
+    ''' NumPy view of logs: int64 start/duration/pause arrays, project codes and a project table.
+    Arrays of a single user are zero-copy views of the `LogColumns` buffers
+    '''
+    __slots__ = ("starts", "durations", "pauses", "projects", "project_names")
+
+    def __init__(self, starts, durations, pauses, projects, project_names: List[str]):
+        self.starts = starts
+        self.durations = durations
+        self.pauses = pauses
+        self.projects = projects
+        self.project_names = project_names
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def from_columns(cls, columns: LogColumns, skip: Optional[str] = None) -> "LogArrays":
+        ''' arrays of a user, `skip` is the ID of a log to leave out (the running one) '''
+        _require_numpy()
+        starts = np.frombuffer(columns.starts, dtype=np.int64)
+        stops = np.frombuffer(columns.stops, dtype=np.int64)
+        pauses = np.frombuffer(columns.pauses, dtype=np.int64)
+        projects = np.frombuffer(columns.project_ids, dtype=np.uint32)
+        arrays = cls(starts, stops - starts - pauses, pauses, projects, list(columns.projects))
+        skipped = columns.position(skip) if skip is not None else -1
+        if skipped >= 0:
+            keep = np.ones(len(starts), dtype=bool)
+            keep[skipped] = False
+            arrays = arrays.select(keep)
+        return arrays
+
+    @classmethod
+    def concatenate(cls, parts: Iterable["LogArrays"]) -> "LogArrays":
+        ''' merge arrays of several users, project codes are remapped to a common project table '''
+        _require_numpy()
+        names: Dict[str, int] = {}
+        starts, durations, pauses, projects = [], [], [], []
+        for part in parts:
+            remap = np.array([names.setdefault(name, len(names)) for name in part.project_names], dtype=np.uint32)
+            starts.append(part.starts)
+            durations.append(part.durations)
+            pauses.append(part.pauses)
+            projects.append(remap[part.projects] if len(remap) else part.projects)
+        if not starts:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, empty, np.zeros(0, dtype=np.uint32), [])
+        return cls(np.concatenate(starts), np.concatenate(durations), np.concatenate(pauses),
+                   np.concatenate(projects), list(names))
+
+    def select(self, mask) -> "LogArrays":
+        return LogArrays(self.starts[mask], self.durations[mask], self.pauses[mask], self.projects[mask],
+                         self.project_names)
+
+
+def local_times(starts, tz: Timezone = 0):
+    ''' the timestamps shifted to the local wall time of the timezone, offsets of a zone are looked up once
+    per distinct hour (DST changes happen on the hour)
+    '''
+    if not isinstance(tz, str):
+        return starts + int(tz * 3600)
+    hours, inverse = np.unique(starts // 3600, return_inverse=True)
+    offsets = np.array([utc_offset(int(hour) * 3600, tz) for hour in hours], dtype=np.int64)
+    return starts + offsets[inverse]
+
+
+def project_totals(arrays: LogArrays) -> Dict[str, Tuple[int, int]]:
+    ''' project -> (total duration, number of logs) in one grouped pass '''
+    n = len(arrays.project_names)
+    sums = np.bincount(arrays.projects, weights=arrays.durations, minlength=n)
+    counts = np.bincount(arrays.projects, minlength=n)
+    return {name: (int(sums[i]), int(counts[i])) for i, name in enumerate(arrays.project_names) if counts[i]}
+
+
+def daily_totals(arrays: LogArrays, since_day: int, n_days: int, tz: Timezone = 0):
+    ''' tracked seconds per local day for `n_days` days starting with the day number `since_day` '''
+    days = local_times(arrays.starts, tz) // DAY - since_day
+    inside = (days >= 0) & (days < n_days)
+    return np.bincount(days[inside], weights=arrays.durations[inside], minlength=n_days)
+
+
+def hour_heatmap(arrays: LogArrays, tz: Timezone = 0):
+    ''' 7x24 matrix of tracked seconds by weekday and hour of the start time '''
+    local = local_times(arrays.starts, tz)
+    weekday = (local // DAY + 3) % 7  # 01.01.1970 was a Thursday
+    hour = (local % DAY) // 3600
+    cells = np.bincount(weekday * 24 + hour, weights=arrays.durations, minlength=7 * 24)
+    return cells.reshape(7, 24)
+
+
+def rolling_mean(values, window: int = 7):
+    ''' trailing mean over `window` values (shorter at the beginning), via cumulative sums '''
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    n = np.arange(1, len(values) + 1)
+    lo = np.maximum(n - window, 0)
+    return (sums[n] - sums[lo]) / (n - lo)
+
+
+def streaks(arrays: LogArrays, today: int, tz: Timezone = 0) -> Tuple[int, int]:
+    ''' (current, longest) number of consecutive local days with at least one log '''
+    days = np.unique(local_times(arrays.starts, tz) // DAY)
+    if not len(days):
+        return 0, 0
+    # a new run starts wherever the gap to the previous day is not 1
+    breaks = np.flatnonzero(np.diff(days) != 1) + 1
+    bounds = np.concatenate(([0], breaks, [len(days)]))
+    runs = np.diff(bounds)
+    current = int(runs[-1]) if days[-1] >= today - 1 else 0
+    return current, int(runs.max())
+
+
+def user_stats(arrays: LogArrays, tz: Timezone = 0, now: int = None, n_days: int = 28) -> dict:
+    ''' all the numbers of the stats screen of a single user '''
+    _require_numpy()
+    now = now_timestamp() if now is None else now
+    today = (now + utc_offset(now, tz)) // DAY
+    daily = daily_totals(arrays, today - n_days + 1, n_days, tz)
+    current, longest = streaks(arrays, today, tz)
+    return {
+        "projects": project_totals(arrays),
+        "daily": daily,
+        "weekly_average": rolling_mean(daily, 7),
+        "heatmap": hour_heatmap(arrays, tz),
+        "streak": current,
+        "longest_streak": longest,
+        "total": int(arrays.durations.sum()),
+        "n_logs": len(arrays),
+    }
+
+
+def global_stats(arrays: LogArrays, n_users: int, now: int = None, n_days: int = 28) -> dict:
+    ''' numbers of the admin report over the logs of every user (UTC) '''
+    stats = user_stats(arrays, 0, now, n_days)
+    stats["n_users"] = n_users
+    return stats
+
+
+def _bar(value: float, top: float, width: int = 12) -> str:
+    return "▇" * int(round(width * value / top)) if top > 0 else ""
+
+
+def render_stats(stats: dict, title: str = "Stats") -> str:
+    ''' text of the stats screen '''
+    lines = [f"📈 {title}:", "-" * 60]
+    if "n_users" in stats:
+        lines.append(f"👤 users: {stats['n_users']}")
+    lines.append(f"🕓 total: {timedelta_to_str(stats['total'])} in {stats['n_logs']} logs")
+    lines.append(f"🔥 streak: {stats['streak']} days (longest {stats['longest_streak']})")
+    lines.append(f"📅 7-day average: {timedelta_to_str(int(stats['weekly_average'][-1]))} per day")
+
+    lines.append("\nTop projects:")
+    top = sorted(stats["projects"].items(), key=lambda item: -item[1][0])[:10]
+    for name, (duration, n_logs) in top:
+        lines.append(f"📝 {name} ({n_logs} logs): {timedelta_to_str(duration)}")
+
+    lines.append("\nLast 7 days:")
+    week = stats["daily"][-7:]
+    for offset, seconds in enumerate(week):
+        lines.append(f"{len(week) - 1 - offset:2d}d ago {_bar(seconds, week.max())} {timedelta_to_str(int(seconds))}")
+
+    heatmap = stats["heatmap"]
+    lines.append("\nBusiest hours:")
+    by_hour = heatmap.sum(axis=0)
+    for hour in np.argsort(by_hour)[::-1][:3]:
+        if by_hour[hour] > 0:
+            lines.append(f"{hour:02d}:00 {timedelta_to_str(int(by_hour[hour]))}")
+    by_day = heatmap.sum(axis=1)
+    if by_day.max() > 0:
+        lines.append(f"Busiest weekday: {WEEKDAYS[int(np.argmax(by_day))]}")
+    return "\n".join(lines)
@@ -1,31 +1,310 @@
+import argparse
+import asyncio
+import json
+import logging
 import os
-from flask import Flask
+import signal
+import sys
+from typing import Optional
+
+import tornado.web
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Application, TypeHandler
+
 import bot
+import journal
+import metrics
+from capture import UpdateRecorder, make_recorder
+from db import PROJECTLIST
+from shard import Dispatcher
 
 API_TOKEN = os.environ['BOT_API_KEY']
 PORT = int(os.environ.get('PORT', '8443'))
 APP_URL = os.environ['APP_URL']
-WEBHOOKMODE = False
+WEBHOOKMODE = os.environ.get('WEBHOOKMODE', '0') == '1'
+# telegram sends it with every webhook update, requests without it are rejected
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+# seconds the queued updates get to be processed on shutdown
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+# /debug/profile samples the whole process, so it is only served when explicitly enabled
+ENABLE_PROFILER = os.environ.get('ENABLE_PROFILER', '0') == '1'
+MAX_PROFILE_SECONDS = 60
+# worker processes of a sharded bot (see shard.py), 1 runs the bot in this process
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '1'))
+# seconds between two checks for workers that died
+WATCHDOG_INTERVAL = 5
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
-@app.route('/')
-def index():
-    return 'index'
+WEBHOOK_REJECTED = metrics.Counter("webhook_rejected_total", "Webhook updates that were not accepted", ["reason"])
 
 
-if __name__ == "__main__":
-    bot_app = bot.main(API_TOKEN)
-    if not WEBHOOKMODE:
-      # use polling
-        bot_app.run_polling()
-        app.run(host='0.0.0.0', port=81)
+class WebServer():
+    ''' One asyncio HTTP server (tornado, the webhook dependency of python-telegram-bot) next to the bot,
+    in the same event loop: the keep-alive page, the health check, /metrics and the telegram webhook.
+    Webhook updates go to the bounded update queue of the bot, which fills up once the bot has the most
+    updates in flight it takes (see `bot.UserOrderedApplication`). When it is full, the request is answered
+    with 429, and with 503 while the bot drains on shutdown, so telegram delivers the update again later
+    '''
+    def __init__(self, application: Application, webhook_path: str, recorder: Optional[UpdateRecorder] = None):
+        self.application = application
+        self.webhook_path = webhook_path
+        self.recorder = recorder
+        self.draining = False
+
+    def make_app(self) -> tornado.web.Application:
+        args = {"server": self}
+        return tornado.web.Application([
+            (r"/", IndexHandler),
+            (r"/health", HealthHandler, args),
+            (r"/metrics", MetricsHandler, args),
+            (r"/debug/profile", ProfileHandler),
+            (r"/" + self.webhook_path, WebhookHandler, args),
+        ])
+
+    @property
+    def accepting(self) -> bool:
+        return self.application.running and not self.draining
+
+    def status(self) -> dict:
+        queue = self.application.update_queue
+        return {"queue_size": queue.qsize(), "queue_max": queue.maxsize,
+                "in_flight": self.application.updates_in_flight}
+
+    def render_metrics(self) -> str:
+        return metrics.render()
+
+    def deliver(self, body: bytes) -> Optional[str]:
+        ''' queue a webhook update, the reason if it was not accepted '''
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except ValueError:
+            return "malformed"
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return "queue_full"
+        return None
+
+
+class ShardedWebServer(WebServer):
+    ''' The web server of the dispatcher of a sharded bot: webhook updates go to the queue of the worker
+    of their user, /health shows the workers and /metrics the metrics of all processes (see shard.py)
+    '''
+    def __init__(self, dispatcher: Dispatcher, webhook_path: str, recorder: Optional[UpdateRecorder] = None):
+        self.dispatcher = dispatcher
+        self.webhook_path = webhook_path
+        self.recorder = recorder
+        self.draining = False
+
+    @property
+    def accepting(self) -> bool:
+        return not self.draining and self.dispatcher.health()["accepting"]
+
+    def status(self) -> dict:
+        return self.dispatcher.health()
+
+    def render_metrics(self) -> str:
+        return self.dispatcher.render_metrics()
+
+    def deliver(self, body: bytes) -> Optional[str]:
+        return self.dispatcher.route(body)
+
+
+class IndexHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write('index')
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, server: WebServer):
+        self.server = server
+
+    def get(self):
+        accepting = self.server.accepting
+        if not accepting:
+            self.set_status(503)
+        self.write({
+            "status": "ok" if accepting else ("draining" if self.server.draining else "starting"),
+            **self.server.status(),
+        })
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, server: WebServer):
+        self.server = server
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.server.render_metrics())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    async def get(self):
+        ''' /debug/profile?seconds=10&interval=0.005 - sampled stacks of the live process in the collapsed format '''
+        if not ENABLE_PROFILER:
+            raise tornado.web.HTTPError(404)
+        seconds = min(float(self.get_argument('seconds', '10')), MAX_PROFILE_SECONDS)
+        interval = max(float(self.get_argument('interval', '0.005')), 0.001)
+        # the sampler runs in a thread, so it sees the event loop at work instead of blocking it
+        stacks = await asyncio.to_thread(metrics.sample_profile, seconds, interval)
+        self.set_header("Content-Type", "text/plain")
+        self.write(stacks)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, server: WebServer):
+        self.server = server
+
+    def reject(self, status: int, reason: str) -> None:
+        WEBHOOK_REJECTED.inc(reason)
+        self.set_status(status)
+
+    def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return self.reject(403, "secret")
+        if not self.server.accepting:
+            return self.reject(503, "unavailable")
+        reason = self.server.deliver(self.request.body)
+        if reason == "malformed":
+            return self.reject(400, reason)
+        if reason == "queue_full":
+            self.set_header("Retry-After", "1")
+            return self.reject(429, reason)
+        if self.server.recorder is not None:  # only accepted updates, telegram sends the others again
+            self.server.recorder.record_raw(self.request.body)
+
+
+async def serve(application: Application, webhook: bool = WEBHOOKMODE, port: int = PORT,
+                recorder: Optional[UpdateRecorder] = None) -> None:
+    ''' Run the bot and the web server in the current event loop until SIGINT/SIGTERM, then drain:
+    new webhook updates are refused, polling stops, the queued updates are processed (for at most
+    DRAIN_TIMEOUT seconds) and the bot shuts down. `recorder` captures the inbound updates (see capture.py)
+    '''
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = WebServer(application, webhook_path=API_TOKEN, recorder=recorder)
+    if recorder is not None and not webhook:
+        # polled updates go straight to the update queue, they are recorded before any other handler sees them
+        async def record(update: Update, context) -> None:
+            recorder.record(update.to_dict())
+        application.add_handler(TypeHandler(Update, record), group=-1)
+    # listen first, so the keep-alive and health checks are answered while the bot starts
+    http_server = server.make_app().listen(port)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if webhook:
+        await application.bot.set_webhook(APP_URL + API_TOKEN, secret_token=WEBHOOK_SECRET)
     else:
-        # use webhook on replit
-        bot_app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=API_TOKEN,
-            webhook_url=APP_URL + API_TOKEN
-        )
+        await application.updater.start_polling()
+    await application.start()
+    logger.info("Serving on port %d (%s)", port, "webhook" if webhook else "polling")
+
+    try:
+        await stop.wait()
+    finally:
+        server.draining = True
+        if application.updater.running:
+            await application.updater.stop()
+        try:
+            await asyncio.wait_for(application.update_queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("%d updates were not processed before shutdown", application.update_queue.qsize())
+        await application.stop()
+        http_server.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def poll(telegram: Bot, dispatcher: Dispatcher, recorder: Optional[UpdateRecorder] = None) -> None:
+    ''' long polling for the workers: an update waits until the queue of its worker takes it,
+    the offset moves past it only then, so telegram keeps what was not routed
+    '''
+    offset = None
+    while True:
+        try:
+            updates = await telegram.get_updates(offset=offset, timeout=10)
+        except TelegramError as e:
+            logger.warning("Polling failed: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            body = update.to_json().encode()
+            while dispatcher.route(body) == "queue_full":
+                await asyncio.sleep(0.1)
+            if recorder is not None:
+                recorder.record(update.to_dict())
+            offset = update.update_id + 1
+
+
+async def serve_sharded(dispatcher: Dispatcher, webhook: bool = WEBHOOKMODE, port: int = PORT,
+                        recorder: Optional[UpdateRecorder] = None) -> None:
+    ''' Run the dispatcher of a sharded bot and its web server until SIGINT/SIGTERM (see shard.py),
+    then drain: new webhook updates are refused, polling stops and the workers process their queues
+    '''
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = ShardedWebServer(dispatcher, webhook_path=API_TOKEN, recorder=recorder)
+    http_server = server.make_app().listen(port)
+    await asyncio.to_thread(dispatcher.start)
+    telegram = Bot(API_TOKEN)
+    await telegram.initialize()
+    poller = None
+    if webhook:
+        await telegram.set_webhook(APP_URL + API_TOKEN, secret_token=WEBHOOK_SECRET)
+    else:
+        await telegram.delete_webhook()
+        poller = asyncio.create_task(poll(telegram, dispatcher, recorder))
+    logger.info("Dispatching to %d workers on port %d (%s)", dispatcher.count, port,
+                "webhook" if webhook else "polling")
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), WATCHDOG_INTERVAL)
+            except asyncio.TimeoutError:
+                dispatcher.check()
+    finally:
+        server.draining = True
+        if poller is not None:
+            poller.cancel()
+        reports = await asyncio.to_thread(dispatcher.stop)
+        logger.info("Workers processed %s updates", {index: r["updates"] for index, r in reports.items()})
+        http_server.stop()
+        await telegram.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Tracker bot with its web server")
+    parser.add_argument("--wipe-storage", action="store_true",
+                        help="delete every user with all their logs from the storage and exit")
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS,
+                        help="worker processes the updates are routed to by user (see shard.py)")
+    args = parser.parse_args()
+    if args.wipe_storage:
+        # destructive maintenance never runs as part of a normal start
+        print(f"Deleted {bot.db.wipe()} users")
+        bot.db.close()
+        sys.exit(0)
 
+    # the callback data of the buttons and the default projects are no personal data, replays need them
+    recorder = make_recorder(API_TOKEN, keep=PROJECTLIST, keep_prefixes=(bot.PAGE_PREFIX,))
+    try:
+        if args.workers > 1:
+            asyncio.run(serve_sharded(Dispatcher(API_TOKEN, args.workers), recorder=recorder))
+        else:
+            if os.environ.get('STORAGE_JOURNAL'):  # the running timers of the workers of a sharded run
+                journal.rebalance(os.environ['STORAGE_JOURNAL'], 1, lambda user_id: 0)
+            asyncio.run(serve(bot.main(API_TOKEN), recorder=recorder))
+    finally:
+        if recorder is not None:
+            recorder.close()
@@ -0,0 +1,833 @@
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from columnar import LogColumns
+from index import StartIndex
+import metrics
+
+ARCHIVED_LOGS = metrics.Counter("storage_archived_logs_total", "Logs moved from the hot documents into monthly archives")
+ARCHIVE_READS = metrics.Counter("storage_archive_reads_total", "Monthly log archives read and decompressed")
+
+
+class Backend():
+    ''' Interface of a storage engine used by `db.Storage`.
+
+    A user is described by three parts:
+        settings  : dict - {"timezone": ..., "projects": [...]}
+        recording : str or None - the ID of the currently running log
+        logs      : mapping log_id -> {"name", "start", "stop", "pause"}
+        meta      : mapping key -> JSON-serialisable value, derived data (e.g. aggregates) kept by `db.Storage`
+    All user IDs are strings. Every method works on a single part, so an engine is free to
+    store the parts separately and to update a single log without touching the rest of the user.
+    '''
+
+    def has_user(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    def add_user(self, user_id: str, settings: dict) -> None:
+        raise NotImplementedError
+
+    def delete_user(self, user_id: str) -> None:
+        raise NotImplementedError
+
+    def user_ids(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def get_settings(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    def set_settings(self, user_id: str, settings: dict) -> None:
+        raise NotImplementedError
+
+    def get_recording(self, user_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set_recording(self, user_id: str, log_id: Optional[str]) -> None:
+        raise NotImplementedError
+
+    def get_log(self, user_id: str, log_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put_log(self, user_id: str, log_id: str, log: dict) -> None:
+        raise NotImplementedError
+
+    def put_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        ''' Store several logs at once. Engines should override it with a single write '''
+        for log_id, log in logs.items():
+            self.put_log(user_id, log_id, log)
+
+    def delete_log(self, user_id: str, log_id: str) -> None:
+        raise NotImplementedError
+
+    def clear_logs(self, user_id: str) -> None:
+        raise NotImplementedError
+
+    def iter_logs(self, user_id: str) -> Iterator[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    def iter_logs_range(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                        reverse: bool = False, limit: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+        ''' Logs with since <= start < until (optionally of a single project) ordered by (start, log_id),
+        at most `limit` of them. The default implementation scans everything, engines should override it
+        with an indexed lookup
+        '''
+        logs = sorted(
+            ((log_id, log) for log_id, log in self.iter_logs(user_id)
+             if since <= log["start"] < until and (project is None or log["name"] == project)),
+            key=lambda item: (item[1]["start"], item[0]), reverse=reverse)
+        return iter(logs[:limit])
+
+    def log_columns(self, user_id: str) -> LogColumns:
+        ''' All logs of the user in the compact columnar layout, the fastest way to scan a whole history '''
+        columns = LogColumns()
+        columns.extend(self.iter_logs(user_id))
+        return columns
+
+    def period_totals(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                      skip: Optional[str] = None) -> Dict[str, List[int]]:
+        ''' project -> [duration, pause, n_logs] of the logs with since <= start < until, except the `skip` log.
+        Engines that keep precomputed totals (see `ReplitBackend`) override it
+        '''
+        totals: Dict[str, List[int]] = {}
+        for log_id, log in self.iter_logs_range(user_id, since, until, project):
+            if log_id != skip:
+                _add_to_totals(totals, log)
+        return totals
+
+    def get_meta(self, user_id: str, key: str) -> Any:
+        ''' Return the meta value stored under the key, None if it does not exist '''
+        raise NotImplementedError
+
+    def set_meta(self, user_id: str, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def write_batch(self, batch: Dict[str, dict]) -> None:
+        ''' Write changes of several users at once, used by the write-behind cache.
+        Args:
+            batch : dict - user_id -> {"settings": ..., "recording": ..., "logs": {...}, "meta": {...}},
+                    all keys are optional
+        '''
+        for user_id, changes in batch.items():
+            if changes.get("logs"):
+                self.put_logs(user_id, changes["logs"])
+            if "settings" in changes:
+                self.set_settings(user_id, changes["settings"])
+            if "recording" in changes:
+                self.set_recording(user_id, changes["recording"])
+            for key, value in changes.get("meta", {}).items():
+                self.set_meta(user_id, key, value)
+
+    def close(self) -> None:
+        pass
+
+
+def _add_to_totals(totals: Dict[str, List[int]], log: dict) -> None:
+    item = totals.setdefault(log["name"], [0, 0, 0])
+    item[0] += log["stop"] - log["start"] - log["pause"]
+    item[1] += log["pause"]
+    item[2] += 1
+
+
+def _month(ts: int) -> str:
+    ''' "YYYY-MM" of a timestamp in UTC, the months of the log archives '''
+    return time.strftime("%Y-%m", time.gmtime(ts))
+
+
+class ReplitBackend(Backend):
+    ''' Engine on top of the replit key-value storage: one JSON document per user,
+    {"settings": {...}, "logs": {...}, "recording": ...}.
+
+    Documents are read with `get_raw` and written back explicitly, so the observed-dict
+    magic of `replit.db` (one HTTP request per nested assignment) is never triggered.
+    With `compact` the logs are stored in the columnar layout of `columnar.py` under "columns"
+    instead of "logs", which is several times smaller. Both layouts are read, so existing documents are
+    converted on their next write.
+
+    With `archive_after` the document keeps only the recent logs, every one that started in a UTC month
+    ending more than `archive_after` days ago is moved, when the document is written, into a compressed
+    archive of its month under the key "<user_id>/archive/<YYYY-MM>". The document lists the archives
+    under "archives" with the range of their start times and the totals per project, so range queries
+    read only the archives of months overlapping the range and summaries of whole months read none.
+    The running log is never archived, a log written into an archived month is merged into its archive.
+
+    Meta values (the aggregates, the conversation states) are kept out of the document, each under the
+    key "<user_id>/meta/<key>", so reading one does not read the logs. Documents written before still
+    hold them under "meta", they are moved out on the first read of a value that is not moved yet.
+    Args:
+        db : a `replit.Database`-like client, defaults to `replit.db`
+        compact : bool - write logs in the columnar layout
+        archive_after : int - days after which the logs of a month are archived, 0 keeps all logs in the document
+        codec : str - compression of the archives, "zlib", "zlib9" or "zstd" (see `columnar.compress`)
+    '''
+    def __init__(self, db=None, index_size: int = 1000, compact: bool = False, archive_after: int = 0,
+                 codec: str = "zlib"):
+        if db is None:
+            from replit import db
+        self.db = db
+        self.compact = compact
+        self.archive_after = archive_after
+        self.codec = codec
+        # sorted start-time indexes of recently queried users, kept up to date by the writes below
+        self.index_size = index_size
+        self.indexes: "OrderedDict[str, StartIndex]" = OrderedDict()
+
+    def _index(self, user_id: str, logs: dict) -> StartIndex:
+        index = self.indexes.get(user_id)
+        if index is None or len(index) != len(logs):  # unknown or changed by somebody else
+            index = StartIndex((log["start"], log_id) for log_id, log in logs.items())
+            self.indexes[user_id] = index
+            if len(self.indexes) > self.index_size:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(user_id)
+        return index
+
+    def _index_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        index = self.indexes.get(user_id)
+        if index is not None:
+            for log_id, log in logs.items():
+                index.add(log_id, log["start"])
+
+    def _load(self, user_id: str) -> dict:
+        doc = json.loads(self.db.get_raw(user_id))
+        if "columns" in doc:
+            doc["logs"] = LogColumns.load(doc.pop("columns")).to_dict()
+        return doc
+
+    def _dumps(self, doc: dict) -> str:
+        if self.compact:
+            doc = dict(doc)
+            doc["columns"] = LogColumns.from_dict(doc.pop("logs")).dump()
+        return json.dumps(doc)
+
+    def _save(self, user_id: str, doc: dict) -> None:
+        archives = self._tier(user_id, doc)
+        if archives:
+            self.db.set_bulk_raw({**archives, user_id: self._dumps(doc)})
+        else:
+            self.db.set_raw(user_id, self._dumps(doc))
+
+    # ---------------------------------------------------------------- archives
+    @staticmethod
+    def _archive_key(user_id: str, month: str) -> str:
+        # user IDs are numbers, the slash keeps the archives apart from the documents (see `user_ids`)
+        return f"{user_id}/archive/{month}"
+
+    def _cutoff(self) -> int:
+        ''' start of the UTC month of the moment `archive_after` days ago, earlier logs belong to archives '''
+        moment = datetime.fromtimestamp(time.time() - self.archive_after * 86400, timezone.utc)
+        return int(moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+    def _archive(self, user_id: str, month: str) -> LogColumns:
+        ARCHIVE_READS.inc()
+        return LogColumns.load(json.loads(self.db.get_raw(self._archive_key(user_id, month))))
+
+    def _archive_items(self, user_id: str, month: str, since: int, until: int,
+                       reverse: bool) -> Iterator[Tuple[str, dict]]:
+        ''' logs of an archive with since <= start < until ordered by (start, log_id), read on the first `next` '''
+        items = [(log_id, log) for log_id, log in self._archive(user_id, month).items() if since <= log["start"] < until]
+        items.sort(key=lambda item: (item[1]["start"], item[0]), reverse=reverse)
+        yield from items
+
+    def _tier(self, user_id: str, doc: dict) -> Dict[str, str]:
+        ''' move the logs of the months due out of the document, return the archives to write with it '''
+        if not self.archive_after:
+            return {}
+        cutoff = self._cutoff()
+        logs = doc["logs"]
+        due = [log_id for log_id, log in logs.items() if log["start"] < cutoff and log_id != doc.get("recording")]
+        if not due:
+            return {}
+        months: Dict[str, Dict[str, dict]] = {}
+        for log_id in due:
+            log = logs.pop(log_id)
+            months.setdefault(_month(log["start"]), {})[log_id] = log
+        manifest = doc.setdefault("archives", {})
+        out = {}
+        for month, moved in months.items():
+            if month in manifest:
+                archived = self._archive(user_id, month).to_dict()
+                archived.update(moved)
+                moved = archived
+            rows = sorted(moved.items(), key=lambda item: (item[1]["start"], item[0]))
+            columns = LogColumns()
+            columns.extend(rows)
+            out[self._archive_key(user_id, month)] = json.dumps(columns.dump(self.codec))
+            totals: Dict[str, List[int]] = {}
+            for _, log in rows:
+                _add_to_totals(totals, log)
+            manifest[month] = {"n": len(rows), "first": rows[0][1]["start"], "last": rows[-1][1]["start"],
+                               "totals": totals}
+        doc["archives"] = dict(sorted(manifest.items()))
+        self.indexes.pop(user_id, None)
+        ARCHIVED_LOGS.inc(amount=len(due))
+        return out
+
+    def has_user(self, user_id: str) -> bool:
+        try:
+            self.db.get_raw(user_id)
+        except KeyError:
+            return False
+        return True
+
+    def add_user(self, user_id: str, settings: dict) -> None:
+        self.indexes.pop(user_id, None)
+        self._save(user_id, {"settings": settings, "logs": {}, "recording": None})
+
+    def delete_user(self, user_id: str) -> None:
+        self.indexes.pop(user_id, None)
+        self._delete_archives(user_id, self._load(user_id))
+        for key in self.db.prefix(self._meta_key(user_id, "")):
+            del self.db[key]
+        del self.db[user_id]
+
+    def _delete_archives(self, user_id: str, doc: dict) -> None:
+        for month in doc.pop("archives", {}):
+            try:
+                del self.db[self._archive_key(user_id, month)]
+            except KeyError:
+                pass
+
+    def user_ids(self) -> Iterator[str]:
+        return (key for key in self.db.keys() if "/" not in key)
+
+    def get_settings(self, user_id: str) -> dict:
+        return self._load(user_id)["settings"]
+
+    def set_settings(self, user_id: str, settings: dict) -> None:
+        doc = self._load(user_id)
+        doc["settings"] = settings
+        self._save(user_id, doc)
+
+    def get_recording(self, user_id: str) -> Optional[str]:
+        return self._load(user_id)["recording"]
+
+    def set_recording(self, user_id: str, log_id: Optional[str]) -> None:
+        doc = self._load(user_id)
+        doc["recording"] = log_id
+        self._save(user_id, doc)
+
+    def get_log(self, user_id: str, log_id: str) -> Optional[dict]:
+        doc = self._load(user_id)
+        log = doc["logs"].get(log_id)
+        if log is None:
+            for month in reversed(list(doc.get("archives", {}))):
+                archive = self._archive(user_id, month)
+                position = archive.position(log_id)
+                if position >= 0:
+                    return archive.log(position)
+        return log
+
+    def put_log(self, user_id: str, log_id: str, log: dict) -> None:
+        self.put_logs(user_id, {log_id: log})
+
+    def put_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        doc = self._load(user_id)
+        doc["logs"].update(logs)
+        self._save(user_id, doc)
+        self._index_logs(user_id, logs)
+
+    def delete_log(self, user_id: str, log_id: str) -> None:
+        doc = self._load(user_id)
+        if log_id not in doc["logs"] and self._delete_archived(user_id, doc, log_id):
+            return
+        doc["logs"].pop(log_id, None)
+        self._save(user_id, doc)
+        if user_id in self.indexes:
+            self.indexes[user_id].remove(log_id)
+
+    def _delete_archived(self, user_id: str, doc: dict, log_id: str) -> bool:
+        ''' delete the log from the archive holding it, False if no archive does '''
+        manifest = doc.get("archives", {})
+        for month in reversed(list(manifest)):
+            logs = self._archive(user_id, month).to_dict()
+            log = logs.pop(log_id, None)
+            if log is None:
+                continue
+            key = self._archive_key(user_id, month)
+            if logs:
+                # the manifest is updated in place, the archive keeps its order
+                columns = LogColumns.from_dict(logs)
+                totals = manifest[month]["totals"]
+                item = totals[log["name"]]
+                item[0] -= log["stop"] - log["start"] - log["pause"]
+                item[1] -= log["pause"]
+                item[2] -= 1
+                if not item[2]:
+                    del totals[log["name"]]
+                manifest[month].update(n=len(logs), first=min(columns.starts), last=max(columns.starts))
+                self.db.set_bulk_raw({key: json.dumps(columns.dump(self.codec)), user_id: self._dumps(doc)})
+            else:
+                del manifest[month]
+                self._save(user_id, doc)
+                del self.db[key]
+            return True
+        return False
+
+    def clear_logs(self, user_id: str) -> None:
+        doc = self._load(user_id)
+        doc["logs"] = {}
+        archives = {"archives": doc["archives"]} if "archives" in doc else {}
+        self._save(user_id, doc)
+        self._delete_archives(user_id, archives)
+        self.indexes.pop(user_id, None)
+
+    def iter_logs(self, user_id: str) -> Iterator[Tuple[str, dict]]:
+        doc = self._load(user_id)
+        archived = (self._archive(user_id, month).items() for month in doc.get("archives", {}))
+        return chain(chain.from_iterable(archived), doc["logs"].items())
+
+    def iter_logs_range(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                        reverse: bool = False, limit: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+        # the document is loaded as a whole, but only the requested range of it is touched
+        doc = self._load(user_id)
+        logs = doc["logs"]
+        ids = self._index(user_id, logs).range(since, until, reverse)
+        items: Iterable[Tuple[str, dict]] = ((log_id, logs[log_id]) for log_id in ids)
+        if doc.get("archives"):
+            items = self._with_archives(user_id, doc, list(items), since, until, reverse)
+        for log_id, log in items:
+            if limit is not None and limit <= 0:
+                return
+            if project is None or log["name"] == project:
+                if limit is not None:
+                    limit -= 1
+                yield log_id, log
+
+    def _with_archives(self, user_id: str, doc: dict, hot: List[Tuple[str, dict]], since: int, until: int,
+                       reverse: bool) -> Iterator[Tuple[str, dict]]:
+        ''' the hot logs of the range and those of the archives overlapping it, in order. An archive is read
+        only once the iteration reaches its month, so a reversed query over recent logs reads none
+        '''
+        months = [month for month, info in doc["archives"].items() if info["first"] < until and since <= info["last"]]
+        if reverse:
+            months.reverse()
+        archived = chain.from_iterable(self._archive_items(user_id, month, since, until, reverse) for month in months)
+        # the hot logs all start after the archived ones, except a running log older than them
+        boundary = max(info["last"] for info in doc["archives"].values())
+        recent = [item for item in hot if item[1]["start"] > boundary]
+        if len(recent) < len(hot):
+            early = [item for item in hot if item[1]["start"] <= boundary]
+            archived = heapq.merge(archived, early, key=lambda item: (item[1]["start"], item[0]), reverse=reverse)
+        return chain(recent, archived) if reverse else chain(archived, recent)
+
+    def log_columns(self, user_id: str) -> LogColumns:
+        # a compact document is decoded straight into columns, without a dict per log
+        doc = json.loads(self.db.get_raw(user_id))
+        if "columns" in doc:
+            columns = LogColumns.load(doc["columns"])
+        else:
+            columns = LogColumns.from_dict(doc["logs"])
+        if not doc.get("archives"):
+            return columns
+        return LogColumns.concatenate([*(self._archive(user_id, month) for month in doc["archives"]), columns])
+
+    def period_totals(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                      skip: Optional[str] = None) -> Dict[str, List[int]]:
+        # archives of months inside the period count by their totals, only the partial ones are read
+        doc = self._load(user_id)
+        logs = doc["logs"]
+        # the log to skip is always hot, unless it was archived before it became the running one
+        whole = skip is None or skip in logs
+        totals: Dict[str, List[int]] = {}
+        partial = []
+        for month, info in doc.get("archives", {}).items():
+            if info["first"] < until and since <= info["last"]:
+                if whole and since <= info["first"] and info["last"] < until:
+                    for name, (duration, pause, n) in info["totals"].items():
+                        if project is None or name == project:
+                            item = totals.setdefault(name, [0, 0, 0])
+                            item[0] += duration
+                            item[1] += pause
+                            item[2] += n
+                else:
+                    partial.append(month)
+        scanned = chain(chain.from_iterable(self._archive_items(user_id, month, since, until, False) for month in partial),
+                        ((log_id, logs[log_id]) for log_id in self._index(user_id, logs).range(since, until)))
+        for log_id, log in scanned:
+            if log_id != skip and (project is None or log["name"] == project):
+                _add_to_totals(totals, log)
+        return totals
+
+    @staticmethod
+    def _meta_key(user_id: str, key: str) -> str:
+        return f"{user_id}/meta/{key}"
+
+    def get_meta(self, user_id: str, key: str) -> Any:
+        try:
+            return json.loads(self.db.get_raw(self._meta_key(user_id, key)))
+        except KeyError:  # not set, or still in the document
+            pass
+        try:
+            doc = self._load(user_id)
+        except KeyError:  # no such user
+            return None
+        meta = doc.pop("meta", None)
+        if meta is None:
+            return None
+        # move the values out of the document, values set since then are newer
+        moved = {}
+        for name, value in meta.items():
+            try:
+                self.db.get_raw(self._meta_key(user_id, name))
+            except KeyError:
+                moved[self._meta_key(user_id, name)] = json.dumps(value)
+        self.db.set_bulk_raw({**moved, user_id: self._dumps(doc)})
+        return meta.get(key)
+
+    def set_meta(self, user_id: str, key: str, value: Any) -> None:
+        self.db.set_raw(self._meta_key(user_id, key), json.dumps(value))
+
+    def write_batch(self, batch: Dict[str, dict]) -> None:
+        # one read per user, but a single bulk request for all the writes
+        docs = {}
+        for user_id, changes in batch.items():
+            for key, value in changes.get("meta", {}).items():
+                docs[self._meta_key(user_id, key)] = json.dumps(value)
+            if not (changes.get("logs") or "settings" in changes or "recording" in changes):
+                continue  # the document stays as it is
+            doc = self._load(user_id)
+            doc["logs"].update(changes.get("logs", {}))
+            for part in ("settings", "recording"):
+                if part in changes:
+                    doc[part] = changes[part]
+            docs.update(self._tier(user_id, doc))
+            docs[user_id] = self._dumps(doc)
+        if docs:
+            self.db.set_bulk_raw(docs)
+        for user_id, changes in batch.items():
+            self._index_logs(user_id, changes.get("logs", {}))
+
+
+class SQLiteBackend(Backend):
+    ''' Engine on top of a local SQLite file in WAL mode.
+
+    Users, projects and logs live in separate tables, logs are indexed by (user_id, start) and
+    (user_id, project), so starting or stopping a timer is a single-row write.
+    Args:
+        path : str - path to the database file (":memory:" for a throw-away database)
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id   TEXT PRIMARY KEY,
+            settings  TEXT NOT NULL,
+            recording TEXT
+        );
+        CREATE TABLE IF NOT EXISTS projects (
+            user_id  TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name     TEXT NOT NULL,
+            PRIMARY KEY (user_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS logs (
+            user_id TEXT NOT NULL,
+            log_id  TEXT NOT NULL,
+            project TEXT NOT NULL,
+            start   INTEGER NOT NULL,
+            stop    INTEGER NOT NULL,
+            pause   INTEGER NOT NULL,
+            PRIMARY KEY (user_id, log_id)
+        );
+        CREATE INDEX IF NOT EXISTS logs_user_start ON logs (user_id, start);
+        CREATE INDEX IF NOT EXISTS logs_user_project ON logs (user_id, project);
+        CREATE TABLE IF NOT EXISTS meta (
+            user_id TEXT NOT NULL,
+            key     TEXT NOT NULL,
+            value   TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        );
+    '''
+
+    def __init__(self, path: str = "timetracker.sqlite3"):
+        self.path = path
+        # the connection is shared between the bot and the background threads, guard it by a lock
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _row_to_log(row: tuple) -> dict:
+        return {"name": row[0], "start": row[1], "stop": row[2], "pause": row[3]}
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _write(self, *statements: Tuple[str, tuple]) -> None:
+        ''' execute one or more statements in a single transaction '''
+        with self._transaction() as conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+
+    def has_user(self, user_id: str) -> bool:
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def add_user(self, user_id: str, settings: dict) -> None:
+        self._write(
+            ("INSERT OR REPLACE INTO users (user_id, settings, recording) VALUES (?, '{}', NULL)", (user_id,)),
+            *self._settings_statements(user_id, settings))
+
+    def delete_user(self, user_id: str) -> None:
+        self._write(
+            ("DELETE FROM logs WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM projects WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM meta WHERE user_id = ?", (user_id,)),
+            ("DELETE FROM users WHERE user_id = ?", (user_id,)),
+        )
+
+    def user_ids(self) -> Iterator[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id FROM users").fetchall()
+        return (row[0] for row in rows)
+
+    def get_settings(self, user_id: str) -> dict:
+        with self.lock:
+            row = self.conn.execute("SELECT settings FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            projects = self.conn.execute(
+                "SELECT name FROM projects WHERE user_id = ? ORDER BY position", (user_id,)).fetchall()
+        if row is None:
+            raise KeyError(user_id)
+        settings = json.loads(row[0])
+        settings["projects"] = [prj for prj, in projects]
+        return settings
+
+    @staticmethod
+    def _settings_statements(user_id: str, settings: dict) -> list:
+        ''' projects go to their own table, the rest of the settings is kept as JSON '''
+        rest = {k: v for k, v in settings.items() if k != "projects"}
+        statements = [
+            ("UPDATE users SET settings = ? WHERE user_id = ?", (json.dumps(rest), user_id)),
+            ("DELETE FROM projects WHERE user_id = ?", (user_id,)),
+        ]
+        for i, prj in enumerate(settings.get("projects", [])):
+            statements.append(("INSERT OR IGNORE INTO projects (user_id, position, name) VALUES (?, ?, ?)", (user_id, i, prj)))
+        return statements
+
+    def set_settings(self, user_id: str, settings: dict) -> None:
+        self._write(*self._settings_statements(user_id, settings))
+
+    def get_recording(self, user_id: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT recording FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            raise KeyError(user_id)
+        return row[0]
+
+    def set_recording(self, user_id: str, log_id: Optional[str]) -> None:
+        self._write(("UPDATE users SET recording = ? WHERE user_id = ?", (log_id, user_id)))
+
+    def get_log(self, user_id: str, log_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT project, start, stop, pause FROM logs WHERE user_id = ? AND log_id = ?", (user_id, log_id)).fetchone()
+        return None if row is None else self._row_to_log(row)
+
+    def put_log(self, user_id: str, log_id: str, log: dict) -> None:
+        self.put_logs(user_id, {log_id: log})
+
+    def put_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        sql = "INSERT OR REPLACE INTO logs (user_id, log_id, project, start, stop, pause) VALUES (?, ?, ?, ?, ?, ?)"
+        with self._transaction() as conn:
+            conn.executemany(sql, (
+                (user_id, log_id, log["name"], log["start"], log["stop"], log["pause"]) for log_id, log in logs.items()))
+
+    def delete_log(self, user_id: str, log_id: str) -> None:
+        self._write(("DELETE FROM logs WHERE user_id = ? AND log_id = ?", (user_id, log_id)))
+
+    def clear_logs(self, user_id: str) -> None:
+        self._write(("DELETE FROM logs WHERE user_id = ?", (user_id,)))
+
+    def iter_logs(self, user_id: str) -> Iterator[Tuple[str, dict]]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT log_id, project, start, stop, pause FROM logs WHERE user_id = ? ORDER BY start", (user_id,)).fetchall()
+        return ((row[0], self._row_to_log(row[1:])) for row in rows)
+
+    def iter_logs_range(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                        reverse: bool = False, limit: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+        # served by the (user_id, start) index, the project filter by (user_id, project)
+        sql = "SELECT log_id, project, start, stop, pause FROM logs WHERE user_id = ? AND start >= ? AND start < ?"
+        params = [user_id, since, until]
+        if project is not None:
+            sql += " AND project = ?"
+            params.append(project)
+        sql += " ORDER BY start DESC, log_id DESC" if reverse else " ORDER BY start, log_id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return ((row[0], self._row_to_log(row[1:])) for row in rows)
+
+    def log_columns(self, user_id: str) -> LogColumns:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT log_id, project, start, stop, pause FROM logs WHERE user_id = ? ORDER BY start", (user_id,)).fetchall()
+        columns = LogColumns()
+        for row in rows:
+            columns.append_row(*row)
+        return columns
+
+    def get_meta(self, user_id: str, key: str) -> Any:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE user_id = ? AND key = ?", (user_id, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_meta(self, user_id: str, key: str, value: Any) -> None:
+        self._write(self._meta_statement(user_id, key, value))
+
+    @staticmethod
+    def _meta_statement(user_id: str, key: str, value: Any) -> Tuple[str, tuple]:
+        return ("INSERT OR REPLACE INTO meta (user_id, key, value) VALUES (?, ?, ?)", (user_id, key, json.dumps(value)))
+
+    def write_batch(self, batch: Dict[str, dict]) -> None:
+        sql = "INSERT OR REPLACE INTO logs (user_id, log_id, project, start, stop, pause) VALUES (?, ?, ?, ?, ?, ?)"
+        with self._transaction() as conn:
+            for user_id, changes in batch.items():
+                conn.executemany(sql, (
+                    (user_id, log_id, log["name"], log["start"], log["stop"], log["pause"])
+                    for log_id, log in changes.get("logs", {}).items()))
+                if "settings" in changes:
+                    for statement, params in self._settings_statements(user_id, changes["settings"]):
+                        conn.execute(statement, params)
+                if "recording" in changes:
+                    conn.execute("UPDATE users SET recording = ? WHERE user_id = ?", (changes["recording"], user_id))
+                for key, value in changes.get("meta", {}).items():
+                    conn.execute(*self._meta_statement(user_id, key, value))
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class InstrumentedBackend(Backend):
+    ''' Records the count and the latency of every round-trip to the wrapped engine (see `metrics.py`).
+    Scans are read completely inside the timed call, so their latency covers the whole round-trip
+    '''
+    def __init__(self, backend: Backend):
+        self.backend = backend
+
+    def _call(self, operation: str, *args):
+        return metrics.timed_call(operation, getattr(self.backend, operation), *args)
+
+    def _scan(self, operation: str, *args) -> Iterator:
+        return iter(metrics.timed_call(operation, lambda: list(getattr(self.backend, operation)(*args))))
+
+    def has_user(self, user_id: str) -> bool:
+        return self._call("has_user", user_id)
+
+    def add_user(self, user_id: str, settings: dict) -> None:
+        self._call("add_user", user_id, settings)
+
+    def delete_user(self, user_id: str) -> None:
+        self._call("delete_user", user_id)
+
+    def user_ids(self) -> Iterator[str]:
+        return self._scan("user_ids")
+
+    def get_settings(self, user_id: str) -> dict:
+        return self._call("get_settings", user_id)
+
+    def set_settings(self, user_id: str, settings: dict) -> None:
+        self._call("set_settings", user_id, settings)
+
+    def get_recording(self, user_id: str) -> Optional[str]:
+        return self._call("get_recording", user_id)
+
+    def set_recording(self, user_id: str, log_id: Optional[str]) -> None:
+        self._call("set_recording", user_id, log_id)
+
+    def get_log(self, user_id: str, log_id: str) -> Optional[dict]:
+        return self._call("get_log", user_id, log_id)
+
+    def put_log(self, user_id: str, log_id: str, log: dict) -> None:
+        self._call("put_log", user_id, log_id, log)
+
+    def put_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        self._call("put_logs", user_id, logs)
+
+    def delete_log(self, user_id: str, log_id: str) -> None:
+        self._call("delete_log", user_id, log_id)
+
+    def clear_logs(self, user_id: str) -> None:
+        self._call("clear_logs", user_id)
+
+    def iter_logs(self, user_id: str) -> Iterator[Tuple[str, dict]]:
+        return self._scan("iter_logs", user_id)
+
+    def iter_logs_range(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                        reverse: bool = False, limit: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+        return self._scan("iter_logs_range", user_id, since, until, project, reverse, limit)
+
+    def log_columns(self, user_id: str) -> LogColumns:
+        return self._call("log_columns", user_id)
+
+    def period_totals(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                      skip: Optional[str] = None) -> Dict[str, List[int]]:
+        return self._call("period_totals", user_id, since, until, project, skip)
+
+    def get_meta(self, user_id: str, key: str) -> Any:
+        return self._call("get_meta", user_id, key)
+
+    def set_meta(self, user_id: str, key: str, value: Any) -> None:
+        self._call("set_meta", user_id, key, value)
+
+    def write_batch(self, batch: Dict[str, dict]) -> None:
+        self._call("write_batch", batch)
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def make_backend(kind: str = None, db=None) -> Backend:
+    ''' Create a storage engine by its name ("replit" or "sqlite").
+    The name defaults to the STORAGE_BACKEND environment variable, the SQLite file to SQLITE_PATH.
+    `db` replaces the client of replit.db, e.g. by `fakes.FakeReplitDB` in `replay.py`.
+    REPLIT_COMPACT_LOGS=1 stores replit logs in the columnar layout, REPLIT_ARCHIVE_AFTER_DAYS moves the logs
+    of months older than that many days into archives compressed by REPLIT_ARCHIVE_CODEC (see `ReplitBackend`).
+    Round-trips to the engine are timed for /metrics (see `InstrumentedBackend`).
+    Unless STORAGE_CACHE_SIZE is 0, the engine is wrapped into a write-behind cache (see `cache.py`),
+    flushed every STORAGE_FLUSH_INTERVAL seconds or after STORAGE_FLUSH_COUNT changes
+    '''
+    kind = kind or os.environ.get("STORAGE_BACKEND", "replit")
+    if kind == "replit":
+        backend = ReplitBackend(db, compact=os.environ.get("REPLIT_COMPACT_LOGS", "0") == "1",
+                                archive_after=int(os.environ.get("REPLIT_ARCHIVE_AFTER_DAYS", "0")),
+                                codec=os.environ.get("REPLIT_ARCHIVE_CODEC", "zlib"))
+    elif kind == "sqlite":
+        backend = SQLiteBackend(os.environ.get("SQLITE_PATH", "timetracker.sqlite3"))
+    else:
+        raise ValueError(f"Unknown storage backend {kind!r}")
+    if isinstance(backend, ReplitBackend):
+        backend.db = metrics.ByteCountingClient(backend.db)
+    backend = InstrumentedBackend(backend)
+
+    capacity = int(os.environ.get("STORAGE_CACHE_SIZE", "10000"))
+    if capacity <= 0:
+        return backend
+    from cache import CachedBackend
+    return CachedBackend(
+        backend,
+        capacity=capacity,
+        flush_interval=float(os.environ.get("STORAGE_FLUSH_INTERVAL", "5")),
+        flush_count=int(os.environ.get("STORAGE_FLUSH_COUNT", "500")),
+    )
@@ -0,0 +1,420 @@
+''' Benchmark and load generator of the bot.
+
+Synthetic users with their logs are generated at the given scale, the real callbacks of `bot.py` are
+driven through `Application.process_update` (with `fakes.FakeRequest` instead of the Bot API and
+`fakes.FakeReplitDB` instead of `replit.db`), then every `Storage` method and `helpers` formatter is timed
+on its own. Latency percentiles and throughput are printed and optionally written as JSON, a previous
+JSON run can be passed with --compare to fail on regressions. With --workers the rounds are routed
+through the dispatcher of `shard.py` to as many worker processes, each with its own fake storage.
+
+    python benchmark.py --users 100 --logs 1000 --projects 8 --json run.json
+    python benchmark.py --users 100 --iterations 1000 --workers 4 --skip-handlers
+    python benchmark.py --compare run.json --threshold 0.2
+'''
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+# bot.py connects to the storage on import, keep it away from replit until the engine is swapped below
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_PATH", ":memory:")
+# the flood limit of telegram would cap the measured throughput at 30 calls per second
+os.environ.setdefault("TELEGRAM_RATE_LIMIT", "100000")
+
+from telegram import Update
+
+import bot
+import helpers
+import timefmt
+from backends import ReplitBackend, SQLiteBackend
+from cache import CachedBackend
+from db import Storage
+from fakes import FakeReplitDB, FakeRequest, callback_update, message_update
+from journal import Journal
+from shard import Dispatcher
+
+
+USER_ID_BASE = 10**6  # synthetic telegram IDs start here
+
+
+# ---------------------------------------------------------------- statistics
+def percentile(sorted_samples: List[float], q: float) -> float:
+    ''' q-th percentile (0..100) of sorted samples, nearest-rank '''
+    if not sorted_samples:
+        return 0.0
+    rank = max(0, min(len(sorted_samples) - 1, int(round(q / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[rank]
+
+
+def summarize(samples: List[float]) -> dict:
+    ''' latency percentiles in milliseconds and throughput of samples in seconds '''
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "n": len(ordered),
+        "mean_ms": 1000 * total / len(ordered) if ordered else 0.0,
+        "p50_ms": 1000 * percentile(ordered, 50),
+        "p95_ms": 1000 * percentile(ordered, 95),
+        "p99_ms": 1000 * percentile(ordered, 99),
+        "ops_per_s": len(ordered) / total if total else 0.0,
+    }
+
+
+# ---------------------------------------------------------------- data generation
+def make_storage(engine: str, compact: bool = False, cache: bool = True, journal: str = None,
+                 archive_after: int = 0) -> Storage:
+    if engine == "replit":
+        backend = ReplitBackend(FakeReplitDB(), compact=compact, archive_after=archive_after)
+    elif engine == "sqlite":
+        backend = SQLiteBackend(":memory:")
+    else:
+        raise ValueError(f"Unknown storage backend {engine!r}")
+    # a huge interval, the benchmark decides when to flush
+    return Storage(CachedBackend(backend, flush_interval=3600, flush_count=10**9) if cache else backend,
+                   Journal(journal) if journal else None)
+
+
+def populate(storage: Storage, users: int, logs: int, projects: int, rng: random.Random,
+             now: int = None, select: Optional[Callable[[int], bool]] = None) -> List[int]:
+    ''' Create `users` users with `logs` finished logs spread over `projects` projects each.
+    Logs go back in time from `now`, so period summaries and pages see realistic data.
+    `select` skips the users it returns False for (those of other workers)
+    '''
+    now = helpers.now_timestamp() if now is None else now
+    names = [f"Project {i}" for i in range(projects)]
+    user_ids = []
+    for n in range(users):
+        user_id = USER_ID_BASE + n
+        if select is not None and not select(user_id):
+            continue
+        populate_user(storage, user_id, names, logs, rng, now)
+        user_ids.append(user_id)
+    if isinstance(storage.backend, CachedBackend):
+        storage.backend.flush()
+    return user_ids
+
+
+def populate_user(storage: Storage, user_id: int, names: List[str], logs: int, rng: random.Random, now: int) -> None:
+    ''' create a user with `logs` finished logs of the projects `names` (added if missing), going back from `now` '''
+    storage.add_user(user_id)
+    projects = storage.settings(user_id)["projects"]
+    for name in names:
+        if name not in projects:
+            storage.add_project(user_id, name)
+    batch = {}
+    start = now - logs * 3 * 3600
+    for _ in range(logs):
+        start += rng.randint(1800, 5 * 3600)
+        length = rng.randint(300, 3 * 3600)
+        batch[str(uuid4())] = {"name": rng.choice(names), "start": start, "stop": start + length,
+                               "pause": rng.choice((0, 0, 0, rng.randint(0, length // 4)))}
+    storage.backend.put_logs(str(user_id), batch)
+    storage.rebuild_aggregates(user_id)
+
+
+# ---------------------------------------------------------------- handlers
+async def bench_handlers(application, storage: Storage, user_ids: List[int], iterations: int,
+                         rng: random.Random, concurrency: int = 1) -> Dict[str, dict]:
+    ''' Drive the conversation of random users through `Application.process_update` and time every step.
+    A round is: /start, Record, a project (start_timer), stop (stop_timer), Logs, List all logs, Export.
+    With `concurrency` > 1 as many rounds of different users run at the same time
+    '''
+    steps = [
+        ("start", lambda uid: message_update(uid, "/start")),
+        ("record", lambda uid: callback_update(uid, bot.GOTO_RECORD)),
+        ("start_timer", None),  # the project is picked per user
+        ("stop_timer", lambda uid: callback_update(uid, bot.GOTO_TIMER_STOP)),
+        ("logs", lambda uid: callback_update(uid, bot.GOTO_LOGS)),
+        ("logs_list_table", lambda uid: callback_update(uid, bot.GOTO_LOGS_LIST)),
+        ("logs_list_export", lambda uid: callback_update(uid, bot.GOTO_LOGS_EXPORT)),
+    ]
+    samples: Dict[str, List[float]] = {name: [] for name, _ in steps}
+    update_ids = itertools.count(1)
+
+    async def rounds(users: List[int], n: int) -> None:
+        for _ in range(n):
+            user_id = rng.choice(users)
+            projects = storage.settings(user_id)["projects"]
+            for name, make in steps:
+                raw = make(user_id) if make else callback_update(user_id, rng.choice(projects))
+                raw["update_id"] = next(update_ids)
+                update = Update.de_json(raw, application.bot)
+                t0 = time.perf_counter()
+                await application.process_update(update)
+                samples[name].append(time.perf_counter() - t0)
+
+    # every worker gets its own users, so the rounds of one user never overlap
+    concurrency = max(1, min(concurrency, len(user_ids)))
+    workers = [rounds(user_ids[k::concurrency], iterations // concurrency + (k < iterations % concurrency))
+               for k in range(concurrency)]
+    await application.initialize()
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*workers)
+        wall = time.perf_counter() - started
+    finally:
+        await application.shutdown()
+    results = {f"handler.{name}": summarize(values) for name, values in samples.items()}
+    results["handler.round"] = {"n": iterations, "wall_s": wall,
+                                "updates_per_s": iterations * len(steps) / wall if wall else 0.0}
+    return results
+
+
+def shard_worker(args: argparse.Namespace) -> FakeRequest:
+    ''' setup of a worker of --workers (see `shard.Dispatcher`): a fake storage with the users of its shard '''
+    logging.getLogger().setLevel(logging.WARNING)
+    storage = make_storage(args.backend, compact=args.compact, cache=not args.no_cache,
+                           archive_after=args.archive_after)
+    populate(storage, args.users, args.logs, args.projects, random.Random(args.seed),
+             select=lambda user_id: helpers.shard_of(user_id, bot.SHARD_COUNT) == bot.SHARD_INDEX)
+    bot.db = storage
+    return FakeRequest(latency=args.latency)
+
+
+def bench_shards(args: argparse.Namespace, rng: random.Random) -> Dict[str, dict]:
+    ''' The rounds of `bench_handlers` as raw updates through the dispatcher to `args.workers` processes,
+    as fast as the queues of the workers take them. The wall time runs until every worker has processed
+    its queue, so it is the throughput of the whole sharded bot
+    '''
+    dispatcher = Dispatcher("123456:BENCHMARK", args.workers, setup=functools.partial(shard_worker, args))
+    dispatcher.start()
+    if not dispatcher.wait_ready(timeout=600):
+        dispatcher.stop(timeout=1)
+        raise RuntimeError("the workers did not start")
+    update_ids = itertools.count(1)
+    projects = [f"Project {i}" for i in range(args.projects)]
+    steps = [lambda uid: message_update(uid, "/start"), lambda uid: callback_update(uid, bot.GOTO_RECORD),
+             lambda uid: callback_update(uid, rng.choice(projects)),
+             lambda uid: callback_update(uid, bot.GOTO_TIMER_STOP), lambda uid: callback_update(uid, bot.GOTO_LOGS),
+             lambda uid: callback_update(uid, bot.GOTO_LOGS_LIST),
+             lambda uid: callback_update(uid, bot.GOTO_LOGS_EXPORT)]
+    full = 0
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        user_id = USER_ID_BASE + rng.randrange(args.users)
+        for make in steps:
+            raw = make(user_id)
+            raw["update_id"] = next(update_ids)
+            body = json.dumps(raw).encode()
+            while dispatcher.route(body) == "queue_full":  # the workers fall behind, as telegram would retry
+                full += 1
+                time.sleep(0.001)
+    routed = time.perf_counter() - started
+    reports = dispatcher.stop(timeout=600)
+    wall = time.perf_counter() - started
+    updates = sum(report["updates"] for report in reports.values())
+    return {"shard.round": {"n": args.iterations, "workers": args.workers, "wall_s": wall, "route_s": routed,
+                            "updates": updates, "queue_full": full, "updates_per_s": updates / wall if wall else 0.0,
+                            "per_worker": [reports[i]["updates"] for i in sorted(reports)]}}
+
+
+# ---------------------------------------------------------------- microbenchmarks
+def timeit(fn: Callable[[], object], repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+
+def bench_storage(storage: Storage, user_ids: List[int], repeat: int, rng: random.Random) -> Dict[str, dict]:
+    ''' every public `Storage` method on random users '''
+    pick = lambda: rng.choice(user_ids)
+    now = helpers.now_timestamp()
+    week = helpers.period_bounds("week", 0, now)
+
+    def start_stop():
+        user_id = pick()
+        storage.start_log(user_id, "Work")
+        storage.stop_log(user_id)
+
+    def pause_resume():
+        user_id = pick()
+        storage.start_log(user_id, "Work")
+        storage.pause_log(user_id)
+        storage.resume_log(user_id)
+        storage.stop_log(user_id)
+
+    cases = {
+        "settings": lambda: storage.settings(pick()),
+        "user_data": lambda: storage.user_data(pick()),
+        "current_log": lambda: storage.current_log(pick()),
+        "start_log+stop_log": start_stop,
+        "pause_log+resume_log": pause_resume,
+        "aggregate_user_logs": lambda: storage.aggregate_user_logs(pick()),
+        "period_summary.week": lambda: storage.period_summary(pick(), *week),
+        "query_logs.week": lambda: list(storage.query_logs(pick(), *week)),
+        "logs_page": lambda: storage.logs_page(pick()),
+        "list_user_logs": lambda: storage.list_user_logs(pick()),
+        "iter_export_rows": lambda: sum(1 for _ in storage.iter_export_rows(pick())),
+        "log_columns": lambda: storage.log_columns(pick()),
+        "rebuild_aggregates": lambda: storage.rebuild_aggregates(pick()),
+        "verify_aggregates": lambda: storage.verify_aggregates(pick(), repair=False),
+    }
+    try:
+        import numpy  # noqa: F401
+        cases["stats"] = lambda: storage.stats(pick())
+        cases["global_stats"] = lambda: storage.global_stats()
+    except ImportError:
+        pass
+    results = {}
+    for name, fn in cases.items():
+        # the whole-storage report is much slower than the rest, a few runs are enough
+        results[f"storage.{name}"] = timeit(fn, max(1, repeat // 50) if name == "global_stats" else repeat)
+    if isinstance(storage.backend, CachedBackend):
+        results["storage.flush"] = timeit(storage.backend.flush, 1)
+    return results
+
+
+def bench_helpers(repeat: int, rng: random.Random) -> Dict[str, dict]:
+    ''' the formatters used on every screen, per call '''
+    now = helpers.now_timestamp()
+    rows = [[str(uuid4()), "Project", "01.01.2023 10:00", "01.01.2023 11:00", "0:10:00", "0:50:00"]] * 1000
+    column = sorted(now - rng.randint(0, 10**7) for _ in range(1000))
+    lengths = [rng.randint(0, 4 * 3600) for _ in range(1000)]
+    formatted = timefmt.formatter("Europe/Berlin").column(column)
+    cases = {
+        "now_timestamp": helpers.now_timestamp,
+        "timestamp_to_str": lambda: helpers.timestamp_to_str(now - rng.randint(0, 10**7), tz=3),
+        "timedelta_to_str": lambda: helpers.timedelta_to_str(rng.randint(0, 10**6)),
+        "timestamp_to_str.zone": lambda: helpers.timestamp_to_str(now - rng.randint(0, 10**7), tz="Europe/Berlin"),
+        "format_column.1000.zone": lambda: timefmt.formatter("Europe/Berlin").column(column),
+        "durations.1000": lambda: timefmt.durations(lengths),
+        "parse_column.1000.zone": lambda: [timefmt.parser("Europe/Berlin").parse(text) for text in formatted],
+        "period_bounds.week": lambda: helpers.period_bounds("week", 3, now),
+        "period_bounds.month": lambda: helpers.period_bounds("month", 3, now),
+        "parse_date_range": lambda: helpers.parse_date_range("01.01.2023 - 31.01.2023", tz=3),
+        "stream_rows_to_csv.1000": lambda: helpers.stream_rows_to_csv(rows).close(),
+        "stream_rows_to_csv.1000.gzip": lambda: helpers.stream_rows_to_csv(rows, compress=True).close(),
+    }
+    return {f"helpers.{name}": timeit(fn, repeat if ".1000" not in name else max(1, repeat // 20))
+            for name, fn in cases.items()}
+
+
+def bench_journal(events: int, repeat: int, rng: random.Random) -> Dict[str, dict]:
+    ''' appending timer events and replaying a journal of `events` events (the start after a crash) '''
+    path = tempfile.mkdtemp(prefix="journal-")
+    try:
+        journal = Journal(path, snapshot_every=10**9)  # nothing is compacted, the replay reads every event
+        users = [str(USER_ID_BASE + n) for n in range(max(1, events // 100))]
+        now = helpers.now_timestamp()
+        cycle = [("start", {"name": "Project"}), ("pause", {}), ("resume", {}), ("stop", {})]
+        for i in range(events):
+            kind, fields = cycle[i % len(cycle)]
+            if kind == "start":
+                fields = dict(fields, id=str(uuid4()))
+            journal.append(users[i // len(cycle) % len(users)], kind, now + i, **fields)
+        appended = iter(range(10**9))
+        results = {"journal.append": timeit(
+            lambda: journal.append(rng.choice(users), "pause", now + next(appended)), repeat)}
+        for shard in journal.shards:  # as after a crash: no snapshot
+            shard.close()
+        results[f"journal.replay.{events}"] = timeit(lambda: Journal(path, snapshot_every=10**9), max(1, repeat // 50))
+        return results
+    finally:
+        shutil.rmtree(path)
+
+
+# ---------------------------------------------------------------- reporting
+def print_results(results: Dict[str, dict]) -> None:
+    print(f"{'benchmark':40s} {'n':>6s} {'p50 ms':>10s} {'p95 ms':>10s} {'p99 ms':>10s} {'ops/s':>12s}")
+    for name, r in results.items():
+        if "p50_ms" not in r:
+            print(f"{name:40s} {r['n']:6d} wall {r['wall_s']:.2f}s, {r['updates_per_s']:.0f} updates/s")
+            continue
+        print(f"{name:40s} {r['n']:6d} {r['p50_ms']:10.3f} {r['p95_ms']:10.3f} {r['p99_ms']:10.3f} {r['ops_per_s']:12.0f}")
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    ''' names of the benchmarks whose p50 got slower than the baseline by more than `threshold` (0.2 = 20%) '''
+    regressions = []
+    for name, r in results.items():
+        old = baseline.get(name, {})
+        if "p50_ms" in r and old.get("p50_ms"):
+            change = r["p50_ms"] / old["p50_ms"] - 1
+            if change > threshold:
+                regressions.append(f"{name}: p50 {old['p50_ms']:.3f} -> {r['p50_ms']:.3f} ms (+{100 * change:.0f}%)")
+    return regressions
+
+
+def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    journal = tempfile.mkdtemp(prefix="journal-") if args.journal else None
+    storage = make_storage(args.backend, compact=args.compact, cache=not args.no_cache, journal=journal,
+                           archive_after=args.archive_after)
+    bot.db = storage
+    application = bot.main("123456:BENCHMARK", request=FakeRequest(latency=args.latency))
+    t0 = time.perf_counter()
+    user_ids = populate(storage, args.users, args.logs, args.projects, rng)
+    populate_s = time.perf_counter() - t0
+
+    results = {}
+    if args.workers > 1:
+        results.update(bench_shards(args, rng))
+    if not args.skip_handlers:
+        results.update(asyncio.run(
+            bench_handlers(application, storage, user_ids, args.iterations, rng, args.concurrency)))
+    results.update(bench_storage(storage, user_ids, args.repeat, rng))
+    results.update(bench_helpers(args.repeat, rng))
+    results.update(bench_journal(args.journal_events, args.repeat, rng))
+    storage.close()
+    if journal:
+        shutil.rmtree(journal)
+    config = {key: value for key, value in vars(args).items() if key not in ("json", "compare")}
+    config["populate_s"] = populate_s
+    return {"config": config, "python": sys.version.split()[0], "results": results}
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20, help="number of synthetic users")
+    parser.add_argument("--logs", type=int, default=500, help="finished logs per user")
+    parser.add_argument("--projects", type=int, default=8, help="projects per user")
+    parser.add_argument("--iterations", type=int, default=200, help="handler rounds (7 updates each)")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per microbenchmark")
+    parser.add_argument("--backend", choices=("replit", "sqlite"), default="replit", help="storage engine")
+    parser.add_argument("--compact", action="store_true", help="columnar replit documents")
+    parser.add_argument("--archive-after", type=int, default=0, help="days after which replit logs are archived")
+    parser.add_argument("--no-cache", action="store_true", help="no write-behind cache in front of the engine")
+    parser.add_argument("--journal", action="store_true", help="keep the running timers in an event journal")
+    parser.add_argument("--journal-events", type=int, default=100000, help="events of the replayed journal")
+    parser.add_argument("--concurrency", type=int, default=1, help="users whose rounds run at the same time")
+    parser.add_argument("--workers", type=int, default=1, help="route the rounds to as many processes (shard.py)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    parser.add_argument("--skip-handlers", action="store_true", help="only the microbenchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="JSON of a previous run, exit with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    # the bot logs every update on DEBUG, which would dominate the numbers
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run(args)
+    print_results(report["results"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report["results"], json.load(f)["results"], args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
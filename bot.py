@@ -1,6 +1,13 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # startup phases are measured from here
+
+import asyncio
 import logging
-from uuid import uuid4
 import os
+import re
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 from telegram import __version__ as TG_VER
 try:
@@ -14,38 +21,93 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
         f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
     )
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InputTextMessageContent, Update)
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
+    ChosenInlineResultHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
-    PicklePersistence
 )
-
-from helpers import now_timestamp, timestamp_to_str, timedelta_to_str, save_list_of_rows_to_csv
-from db import Storage
-
-# connect to repltit database
+# put into the update queue by `Application.stop`, the fetcher of `UserOrderedApplication` has to know it
+from telegram.ext._application import _STOP_SIGNAL
+
+from helpers import (Timezone, now_timestamp, timestamp_to_str, timedelta_to_str, period_bounds, parse_date_range,
+                     parse_timezone, timezone_name, stream_rows_to_csv, shard_of)
+from db import Storage, MAX_TIMESTAMP
+import metrics
+from deadlines import DeadlineScheduler
+from fuzzy import project_index
+from importer import ImportReport, LogImporter
+from live import LiveTimers, View
+from outbox import Outbox, BACKGROUND
+from locks import KeyedLock
+from persistence import StoragePersistence
+from render import RenderCache
+
+# the database (replit by default, see STORAGE_BACKEND in backends.py), it connects on first use
 db = Storage()
 
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+# Enable logging, LOG_LEVEL=DEBUG logs every update
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 
+def startup_phase(phase: str) -> None:
+    ''' report the seconds from the import of the bot to a startup phase (log and /metrics) '''
+    seconds = time.perf_counter() - IMPORT_STARTED
+    metrics.STARTUP_SECONDS.set(seconds, phase)
+    logger.info("Startup: %s after %.3f s", phase, seconds)
+
+
+startup_phase("imported")
+
+
 # Conversation Stages
 STATE_START, STATE_TIMER_STARTED, STATE_ADDING_PROJECT, STATE_SETTINGS_DEL_PRJ, \
-STATE_SETTING_TZ, STATE_PRJ_SELECTED, STATE_LOG_MENU_ENTERED, STATE_SETTINGS_OPENED = [str(i) for i in range(8)]
+STATE_SETTING_TZ, STATE_PRJ_SELECTED, STATE_LOG_MENU_ENTERED, STATE_SETTINGS_OPENED, \
+STATE_LOG_RANGE, STATE_SETTING_DEADLINES = [str(i) for i in range(10)]
 
 
 # Callback data
 GOTO_RECORD, GOTO_LOGS, GOTO_SETTINGS, GOTO_TIMER_PAUSE, GOTO_TIMER_STOP, \
 GOTO_TIMER_RESUME, GOTO_RESET, GOTO_LOGS_LIST, GOTO_LOGS_EXPORT, \
-GOTO_MAIN_MENU, GOTO_SETTINGS_ADD_PRJ, GOTO_SETTINGS_DEL_PRJ, GOTO_SETTINGS_SET_TZ = [str(i) for i in range(13)]
+GOTO_MAIN_MENU, GOTO_SETTINGS_ADD_PRJ, GOTO_SETTINGS_DEL_PRJ, GOTO_SETTINGS_SET_TZ, \
+GOTO_LOGS_TODAY, GOTO_LOGS_WEEK, GOTO_LOGS_MONTH, GOTO_LOGS_RANGE, GOTO_STATS, \
+GOTO_SETTINGS_LIVE, GOTO_SETTINGS_DEADLINES = [str(i) for i in range(20)]
+PAGE_PREFIX = "page:"  # callback data of the log list pages, followed by a cursor
+
+EXPORT_GZIP_ROWS = 20000  # exports of larger histories are gzipped
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # bots cannot download larger files
+IMPORT_PROGRESS_INTERVAL = 2.0  # seconds between two edits of the progress message of an import
+DEADLINE_ARGS = r"^\s*(\d+)\s+(\d+|midnight)\s*$"  # reminder in minutes, auto-stop in hours or "midnight"
+EXPORT_ARGS = r"^\s*(\d{1,2}\.\d{1,2}\.\d{4}(?:\s*-\s*\d{1,2}\.\d{1,2}\.\d{4})?)?\s*(.*?)\s*$"
+# telegram IDs of the users allowed to run admin commands (comma separated)
+ADMIN_IDS = {int(uid) for uid in os.environ.get("ADMIN_IDS", "").split(",") if uid.strip()}
+# number of updates processed at the same time, 0 processes them one by one
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+# max number of updates waiting in the update queue, the webhook refuses updates beyond it (see app.py)
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# max number of updates taken from the queue and not processed yet, the queue fills up beyond it
+UPDATES_IN_FLIGHT = int(os.environ.get("UPDATES_IN_FLIGHT", "256"))
+# seconds between two writes of the conversation states to the storage
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "10"))
+# texts and keyboards rendered from the data of a user, kept until the data changes
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "10000"))
+# the worker of this process in a sharded deployment (see shard.py), it serves only the users of its shard
+SHARD_INDEX, SHARD_COUNT = int(os.environ.get("SHARD_INDEX", "0")), int(os.environ.get("SHARD_COUNT", "1"))
+# Bot API calls per second of the whole bot (the flood limit of telegram), shared by the workers of a sharded bot
+TELEGRAM_RATE_LIMIT = float(os.environ.get("TELEGRAM_RATE_LIMIT", "30")) / SHARD_COUNT
+# seconds between two refreshes of a live timer message and the edits per second of all of them
+LIVE_INTERVAL = float(os.environ.get("LIVE_INTERVAL", "60"))
+LIVE_EDITS_PER_SECOND = int(os.environ.get("LIVE_EDITS_PER_SECOND", "20"))
 
 
 
@@ -68,6 +130,13 @@ KEYBOARD_TIMER_PAUSED = InlineKeyboardMarkup([[
     ]])
 
 KEYBOARD_LOGS = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Today", callback_data=GOTO_LOGS_TODAY),
+        InlineKeyboardButton("This week", callback_data=GOTO_LOGS_WEEK),
+        InlineKeyboardButton("This month", callback_data=GOTO_LOGS_MONTH),
+    ],[
+        InlineKeyboardButton("Custom range", callback_data=GOTO_LOGS_RANGE),
+        InlineKeyboardButton("📈 Stats", callback_data=GOTO_STATS),
+    ],[
         InlineKeyboardButton("List all logs", callback_data=GOTO_LOGS_LIST),
     ],[
         InlineKeyboardButton("Export as CSV", callback_data=GOTO_LOGS_EXPORT),
@@ -80,13 +149,138 @@ KEYBOARD_SETTINGS = InlineKeyboardMarkup([[
         InlineKeyboardButton("Add Project", callback_data=GOTO_SETTINGS_ADD_PRJ),
         InlineKeyboardButton("Remove Project", callback_data=GOTO_SETTINGS_DEL_PRJ),
     ], [
-        InlineKeyboardButton("Timezone", callback_data=GOTO_SETTINGS_SET_TZ)
+        InlineKeyboardButton("Timezone", callback_data=GOTO_SETTINGS_SET_TZ),
+        InlineKeyboardButton("⏱ Live timer", callback_data=GOTO_SETTINGS_LIVE),
+    ], [
+        InlineKeyboardButton("⏰ Reminder & auto-stop", callback_data=GOTO_SETTINGS_DEADLINES),
     ], [
         InlineKeyboardButton("↩ Back", callback_data=GOTO_MAIN_MENU),
     ]])
 
 
 
+def timer_view(user_id: int) -> View:
+    ''' the live timer message of the user: their running log with its elapsed time and pause so far '''
+    log_id, log = db.current_log(user_id)
+    if log is None:
+        return None
+    duration, pause, paused = Storage.timer_state(log)
+    tz = db.settings(user_id)["timezone"]
+    text = f'''Timer {"paused" if paused else "running"}
+        📝 project: {log["name"]}
+        📅 start: {timestamp_to_str(log["start"], tz=tz, fmt="%d.%m.%Y %H:%M:%S")}
+        🕓 pause: {pause // 3600}:{pause % 3600 // 60:02d}
+        ⏱ elapsed: {duration // 3600}:{duration % 3600 // 60:02d}'''
+    return log_id, text, KEYBOARD_TIMER_PAUSED if paused else KEYBOARD_TIMER_STARTED
+
+
+def answer(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str = None) -> None:
+    ''' answer the query of a pressed button without waiting for the round-trip. The outbox sends it ahead of
+    the calls that follow, which run concurrently with it
+    '''
+    context.application.create_task(update.callback_query.answer(text=text), update=update)
+
+
+renders = RenderCache(RENDER_CACHE_SIZE)
+
+
+def rendered(user_id: int, key: Tuple, render: Callable[[], Any]) -> Any:
+    ''' `render()`, cached until the data of the user changes (see `RenderCache`) '''
+    # the version is read first, a change during the rendering must not be cached under the new one
+    version = db.version(user_id)
+    return renders.get((user_id,) + key, version, render)
+
+
+def settings_text(settings: dict) -> str:
+    msg = f'Settings:\n' + '-'*60 + '\n\tTimezone: ' + timezone_name(settings["timezone"]) + \
+          '\n\tLive timer: ' + ('on' if settings.get("live") else 'off') + \
+          '\n\tReminder: ' + (f'after {settings["remind"]} min' if settings.get("remind") else 'off') + \
+          '\n\tAuto-stop: ' + ({"midnight": 'at midnight', 0: 'off', None: 'off'}.get(settings.get("autostop"))
+                                or f'after {settings["autostop"]} h') + '\n\tProjects:'
+    for prj in sorted(settings["projects"]):
+        msg += "\n\t\t"+prj
+    return msg
+
+
+def project_keyboard(projects: List[str]) -> InlineKeyboardMarkup:
+    ''' a button per project, note that the project name will be send as a callback_data '''
+    keyboard = [[InlineKeyboardButton(prj, callback_data=prj)] for prj in projects]
+    keyboard.append([InlineKeyboardButton("↩ Back", callback_data=GOTO_MAIN_MENU)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def started_log_text(log: dict, tz: Timezone) -> str:
+    return f'''Timer started
+        📝 project: {log["name"]}
+        📅 start: {timestamp_to_str(log["start"], tz=tz, fmt="%d.%m.%Y %H:%M:%S")}'''
+
+
+def paused_log_text(log: dict) -> str:
+    return f'''Timer paused:
+        📝 project: {log["name"]}
+        📅 start:  {timestamp_to_str(log["start"])}
+        📅 paused: {timestamp_to_str(now_timestamp())}'''
+
+
+def resumed_log_text(log: dict) -> str:
+    return f'''Timer resumed:
+        📝 project: {log["name"]}
+        📅 start:  {timestamp_to_str(log["start"])}
+        🕓 pause: {timedelta_to_str(log["pause"])}'''
+
+
+def stopped_log_text(log: dict, tz: Timezone) -> str:
+    return f'''Log created:
+        📝 project:  {log["name"]}
+        📅 start:    {timestamp_to_str(log["start"], tz=tz)}
+        📅 stop:     {timestamp_to_str(log["stop"], tz=tz)}
+        🕓 pause:    {timedelta_to_str(log["pause"])}
+        🕓 duration: {timedelta_to_str(log["stop"] - log["start"] - log["pause"])}'''
+
+
+def update_deadlines(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    ''' move the reminder and the auto-stop of the user after their timer or their settings changed '''
+    _, log = db.current_log(user_id)
+    context.application.arm_deadlines(user_id, log, db.settings(user_id))
+
+
+def switch_timer(context: ContextTypes.DEFAULT_TYPE, user_id: int, project: str) -> Tuple[Optional[dict], dict]:
+    ''' stop the running timer of the user (if any) and start one of the project,
+    returns the stopped log (None if nothing ran) and the started one
+    '''
+    stopped = db.stop_log(user_id)
+    if stopped is not None:
+        context.application.live_timers.remove(user_id)
+    _, log = db.start_log(user_id, project)
+    update_deadlines(context, user_id)
+    return stopped, log
+
+
+def switched_log_text(stopped: Optional[dict], log: dict, tz: Timezone) -> str:
+    text = started_log_text(log, tz)
+    if stopped is not None:
+        text = "Timer stopped. " + stopped_log_text(stopped, tz) + "\n\n" + text
+    return text
+
+
+async def show_timer_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str,
+                             reply_markup: InlineKeyboardMarkup) -> None:
+    ''' show the timer in the message of the query (or a reply to a command), as the live view refreshed by
+    the scheduler if the user opted in
+    '''
+    user_id = update.effective_user.id
+    view = timer_view(user_id) if db.settings(user_id).get("live") else None
+    if view is not None:
+        log_id, text, reply_markup = view
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
+        message = update.callback_query.message
+    else:
+        message = await update.message.reply_text(text=text, reply_markup=reply_markup)
+    if view is not None:
+        context.application.live_timers.add(user_id, message.chat_id, message.message_id, log_id, text)
+
+
 # Define Callback-Functions
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, start_over: bool = False) -> int:
     ''' Initial callback function when we want to start the bot
@@ -117,7 +311,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, start_over:
         if query and not start_over:  # user pressed inline-keyboard-btn and we receive a query
             logger.info("update.callback_query is not None")
             # answer the query
-            await query.answer()
+            answer(update, context)
             # update the current conversation message
             await query.edit_message_text("Welcome to Time Tracker", reply_markup=KEYBOARD_START)
         else:  # user didnt press anything, hard-coded start over
@@ -129,15 +323,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, start_over:
 
 async def record(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer a query (when user clicked an inline-button)
-    await update.callback_query.answer()
-    # get useer data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    # build a keyboard with list of all projects from user database, note that the project name will be send as a callback_data
-    keyboard = [[InlineKeyboardButton(prj, callback_data=prj)] for prj in user_data["settings"]["projects"]]
-    keyboard.append([InlineKeyboardButton("↩ Back", callback_data=GOTO_MAIN_MENU)])
+    answer(update, context)
+    # build a keyboard with list of all projects from user database
+    user_id = update.effective_user.id
+    keyboard = rendered(user_id, ("projects",), lambda: project_keyboard(db.settings(user_id)["projects"]))
 
     # update message and a keyboard
-    await update.callback_query.edit_message_text(text="Select project to track", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.callback_query.edit_message_text(text="Select project to track", reply_markup=keyboard)
 
     # return a pointer to the next state in the conversation
     return STATE_PRJ_SELECTED
@@ -147,28 +339,15 @@ async def start_timer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     query = update.callback_query
 
     # answer the query
-    await query.answer()
-    # get useer data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    # start a log entry
-    log_id = str(uuid4())
-    user_data["logs"][log_id] = {}
-    #user_data["logs"][log_id]["start"] = query.message.edit_date  # integer, epoch time
-    user_data["logs"][log_id]["name"] = query.data  # name of the project (callback data)
-    user_data["logs"][log_id]["start"] = now_timestamp()  # integer, epoch time
-    user_data["logs"][log_id]["stop"] = user_data["logs"][log_id]["start"]  # DEFAULT VALUE
-    user_data["logs"][log_id]["pause"] = 0
-
-    # store the key of current log for quick access
-    user_data["recording"] = log_id
+    answer(update, context)
+    # start a log entry, the name of the project is sent as callback data. The buttons of /go lead here
+    # as well, with a timer that may still run
+    stopped, log = switch_timer(context, update.effective_user.id, query.data)
+    settings = db.settings(update.effective_user.id)
 
     # edit the message
-    await query.edit_message_text(
-        text=f'''Timer started
-        📝 project: {user_data["logs"][log_id]["name"]}
-        📅 start: {timestamp_to_str(user_data["logs"][log_id]["start"], tz=user_data["settings"]["timezone"],
-                    fmt="%d.%m.%Y %H:%M:%S")}''',
-        reply_markup=KEYBOARD_TIMER_STARTED)
+    await show_timer_message(update, context, switched_log_text(stopped, log, settings["timezone"]),
+                             KEYBOARD_TIMER_STARTED)
 
     return STATE_TIMER_STARTED
 
@@ -176,150 +355,376 @@ async def start_timer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 async def stop_timer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer the query
     query = update.callback_query
-    await query.answer(text="Timer stopped")
-    # get useer data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    # add stop log to the user_data
-    log_id = user_data["recording"]
-    user_data["logs"][log_id]["stop"] = now_timestamp()
-
-    # reset the current recording to be None
-    user_data["recording"] = None
-    
-    # make aliases
-    _start = user_data["logs"][log_id]["start"]
-    _stop = user_data["logs"][log_id]["stop"]
-    _pause = user_data["logs"][log_id]["pause"]
-    _tz = user_data["settings"]["timezone"]
+    answer(update, context, text="Timer stopped")
+    # add stop time to the running log and reset the current recording
+    log = db.stop_log(update.effective_user.id)
+    if log is None:  # the timer was already stopped (e.g. a double tap)
+        return await start(update, context)
+    context.application.live_timers.remove(update.effective_user.id)
+    update_deadlines(context, update.effective_user.id)
 
     # generate new text
-    msg_txt = f'''Timer stopped. Log created:
-        📝 project:  {user_data["logs"][log_id]["name"]}
-        📅 start:    {timestamp_to_str(_start, tz=_tz)}
-        📅 stop:     {timestamp_to_str(_stop, tz=_tz)}
-        🕓 pause:    {timedelta_to_str(_pause)}
-        🕓 duration: {timedelta_to_str(_stop - _start - _pause)}'''
-    
-    # edit text
-    await query.edit_message_text(text=msg_txt, reply_markup=None)
+    msg_txt = "Timer stopped. " + stopped_log_text(log, db.settings(update.effective_user.id)["timezone"])
 
-    # start over
-    return await start(update, context, start_over=True)
+    # edit the text and start over with a new message, the two calls are independent
+    _, state = await asyncio.gather(query.edit_message_text(text=msg_txt, reply_markup=None),
+                                    start(update, context, start_over=True))
+    return state
 
 
 async def pause_timer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     # query answer
-    await query.answer(text="Timer paused")
-    # get useer data from replit database
-    user_data = db.user_data(update.effective_user.id)
-
-    # get the id of current record
-    log_id = user_data["recording"]
-    
-    # get new starting point for pause duration
-    user_data["logs"][log_id]["pause"] = now_timestamp() - user_data["logs"][log_id]["pause"]
+    answer(update, context, text="Timer paused")
+    # get new starting point for pause duration of the current record
+    log = db.pause_log(update.effective_user.id)
+    if log is None:  # there is no running timer anymore
+        return await start(update, context)
+    # no reminder or auto-stop while paused
+    update_deadlines(context, update.effective_user.id)
 
     # edit msg
-    await query.edit_message_text(
-        text=f'''Timer paused:
-        📝 project: {user_data["logs"][log_id]["name"]}
-        📅 start:  {timestamp_to_str(user_data["logs"][log_id]["start"])}
-        📅 paused: {timestamp_to_str(now_timestamp())}''',
-        reply_markup=KEYBOARD_TIMER_PAUSED)
+    await show_timer_message(update, context, paused_log_text(log), KEYBOARD_TIMER_PAUSED)
     return STATE_START
 
 
 async def resume_timer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     # answer query
-    await query.answer(text="Timer resumed")
-    # get useer data from replit database
-    user_data = db.user_data(update.effective_user.id)
-
-    # get the id of current record
-    log_id = user_data["recording"]
-
-    # calculate pause duration
-    user_data["logs"][log_id]["pause"] = now_timestamp() - user_data["logs"][log_id]["pause"]
-
-    await query.edit_message_text(
-        text=f'''Timer resumed:
-        📝 project: {user_data["logs"][log_id]["name"]}
-        📅 start:  {timestamp_to_str(user_data["logs"][log_id]["start"])}
-        🕓 pause: {timedelta_to_str(user_data["logs"][log_id]["pause"])}''',
-        reply_markup=KEYBOARD_TIMER_STARTED)
+    answer(update, context, text="Timer resumed")
+    # calculate pause duration of the current record
+    log = db.resume_log(update.effective_user.id)
+    if log is None:  # there is no running timer anymore
+        return await start(update, context)
+    # the deadlines moved by the pause
+    update_deadlines(context, update.effective_user.id)
+
+    await show_timer_message(update, context, resumed_log_text(log), KEYBOARD_TIMER_STARTED)
     return STATE_TIMER_STARTED
 
     
+async def go_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    ''' /go <project> - start the timer of the project that matches the name best, in one step.
+    A running timer is stopped first, so /go also switches projects
+    '''
+    user_id = update.effective_user.id
+    settings = db.settings(user_id)
+    project, candidates = project_index(tuple(settings["projects"])).resolve(" ".join(context.args))
+    if project is None:
+        if not candidates:
+            await update.message.reply_text("No project matches. Your projects: " + ", ".join(settings["projects"]))
+            return None
+        # several projects match, the buttons work like the ones of "Record"
+        await update.message.reply_text(text="Select project to track", reply_markup=project_keyboard(candidates))
+        return STATE_PRJ_SELECTED
+
+    stopped, log = switch_timer(context, user_id, project)
+    await show_timer_message(update, context, switched_log_text(stopped, log, settings["timezone"]),
+                             KEYBOARD_TIMER_STARTED)
+    return STATE_TIMER_STARTED
+
+
+async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    ''' /stop - stop the running timer '''
+    user_id = update.effective_user.id
+    log = db.stop_log(user_id)
+    if log is None:
+        await update.message.reply_text("No timer is running")
+        return None
+    context.application.live_timers.remove(user_id)
+    update_deadlines(context, user_id)
+    await update.message.reply_text("Timer stopped. " + stopped_log_text(log, db.settings(user_id)["timezone"]),
+                                    reply_markup=KEYBOARD_START)
+    return STATE_START
+
+
+async def pause_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    ''' /pause - pause the running timer '''
+    user_id = update.effective_user.id
+    _, log = db.current_log(user_id)
+    if log is None or Storage.timer_state(log)[2]:
+        await update.message.reply_text("No timer is running" if log is None else "The timer is paused already")
+        return None
+    log = db.pause_log(user_id)
+    update_deadlines(context, user_id)
+    await show_timer_message(update, context, paused_log_text(log), KEYBOARD_TIMER_PAUSED)
+    return STATE_START
+
+
+async def resume_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    ''' /resume - resume the paused timer '''
+    user_id = update.effective_user.id
+    _, log = db.current_log(user_id)
+    if log is None or not Storage.timer_state(log)[2]:
+        await update.message.reply_text("No timer is running" if log is None else "The timer is running already")
+        return None
+    log = db.resume_log(user_id)
+    update_deadlines(context, user_id)
+    await show_timer_message(update, context, resumed_log_text(log), KEYBOARD_TIMER_STARTED)
+    return STATE_TIMER_STARTED
+
+
+def inline_article(result_id: str, title: str, description: str = None) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(id=result_id, title=title, description=description,
+                                    input_message_content=InputTextMessageContent(title))
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' inline mode, "@bot wor": the running timer to stop or pause and the matching projects to start '''
+    user_id = update.effective_user.id
+    settings = db.settings(user_id)
+    results = []
+    _, log = db.current_log(user_id)
+    if log is not None:
+        duration, _, paused = Storage.timer_state(log)
+        elapsed = timedelta_to_str(duration)
+        results.append(inline_article("stop", f'⏹ Stop {log["name"]}', elapsed))
+        if paused:
+            results.append(inline_article("resume", f'⏯ Resume {log["name"]}', elapsed))
+        else:
+            results.append(inline_article("pause", f'⏸ Pause {log["name"]}', elapsed))
+    projects = settings["projects"]
+    for _, prj in project_index(tuple(projects)).search(update.inline_query.query):
+        results.append(inline_article(f"go:{projects.index(prj)}", f"▶ {prj}"))
+    # the results depend on the running timer, they must not be cached
+    await update.inline_query.answer(results, cache_time=0, is_personal=True)
+
+
+async def inline_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' a result of the inline mode was sent, act on the timer (needs /setinlinefeedback at @BotFather) '''
+    user_id = update.effective_user.id
+    action, _, arg = update.chosen_inline_result.result_id.partition(":")
+    if action == "go":
+        projects = db.settings(user_id)["projects"]
+        if not arg.isdigit() or int(arg) >= len(projects):  # the projects changed meanwhile
+            return
+        switch_timer(context, user_id, projects[int(arg)])
+        return
+    elif action == "stop":
+        if db.stop_log(user_id) is not None:
+            context.application.live_timers.remove(user_id)
+    elif action == "pause":
+        db.pause_log(user_id)
+    elif action == "resume":
+        db.resume_log(user_id)
+    update_deadlines(context, user_id)
+
+
 async def logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     
     # answer query
-    await query.answer()
+    answer(update, context)
 
     # logic to aggregate logs
-    aggr_Logs, msg = db.aggregate_user_logs(update.effective_user.id)
+    user_id = update.effective_user.id
+    msg = rendered(user_id, ("summary",), lambda: db.aggregate_user_logs(user_id)[1])
     
     # update the logs section
     await query.edit_message_text(text=msg, reply_markup=KEYBOARD_LOGS)
     return STATE_LOG_MENU_ENTERED
 
 
+async def logs_period(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    # answer query
+    answer(update, context)
+
+    # the pressed button defines the period
+    period = {GOTO_LOGS_TODAY: "day", GOTO_LOGS_WEEK: "week", GOTO_LOGS_MONTH: "month"}[query.data]
+    tz = db.settings(update.effective_user.id)["timezone"]
+    since, until = period_bounds(period, tz=tz)
+
+    # summarise only the logs of the period
+    user_id = update.effective_user.id
+    msg = rendered(user_id, ("period", since, until), lambda: db.period_summary(user_id, since, until)[1])
+    await query.edit_message_text(text=msg, reply_markup=KEYBOARD_LOGS)
+    return STATE_LOG_MENU_ENTERED
+
+
+async def logs_range_choose(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    # answer query
+    answer(update, context)
+
+    msg = "Please enter a date range in the form dd.mm.yyyy - dd.mm.yyyy (or a single date)"
+    await query.edit_message_text(text=msg, reply_markup=None)
+    return STATE_LOG_RANGE
+
+
+async def logs_range_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    tz = db.settings(update.effective_user.id)["timezone"]
+    try:
+        since, until = parse_date_range(update.message.text, tz=tz)
+    except ValueError:  # wrong format, ask again
+        await update.message.reply_text("Please use the form dd.mm.yyyy - dd.mm.yyyy")
+        return STATE_LOG_RANGE
+
+    user_id = update.effective_user.id
+    msg = rendered(user_id, ("period", since, until), lambda: db.period_summary(user_id, since, until)[1])
+    # the prompt was a plain message, so answer with a new one
+    await update.message.reply_text(text=msg, reply_markup=KEYBOARD_LOGS)
+    return STATE_LOG_MENU_ENTERED
+
+
+def keyboard_logs_page(older: str, newer: str) -> InlineKeyboardMarkup:
+    ''' navigation keyboard of the log list, the cursors of the neighbour pages are sent as callback data '''
+    navigation = []
+    if older:
+        navigation.append(InlineKeyboardButton("◀", callback_data=PAGE_PREFIX + older))
+    if newer:
+        navigation.append(InlineKeyboardButton("▶", callback_data=PAGE_PREFIX + newer))
+    return InlineKeyboardMarkup([navigation, [InlineKeyboardButton("↩ Back", callback_data=GOTO_LOGS)]])
+
+
 async def logs_list_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     # answer query
-    await query.answer()
+    answer(update, context)
 
-    # logic to aggregate logs
-    log_list, msg = db.list_user_logs(update.effective_user.id)
+    # render a single page, the newest one unless a page button with a cursor was pressed
+    cursor = query.data[len(PAGE_PREFIX):] if query.data.startswith(PAGE_PREFIX) else None
+    user_id = update.effective_user.id
+    msg, older, newer = rendered(user_id, ("page", cursor), lambda: db.logs_page(user_id, cursor))
     # update the logs section
-    await query.edit_message_text(text=msg, reply_markup=KEYBOARD_LOGS)
+    await query.edit_message_text(text=msg, reply_markup=keyboard_logs_page(older, newer))
     return STATE_LOG_MENU_ENTERED
 
+async def send_export(update: Update, context: ContextTypes.DEFAULT_TYPE, since: int = 0, until: int = MAX_TIMESTAMP,
+                      project: str = None) -> None:
+    ''' Stream the logs of the user into an in-memory CSV file (gzipped for large histories) and send it '''
+    user_id = update.effective_user.id
+    # the number of logs is known from the aggregates, without reading them
+    n_logs = sum(item["n_logs"] for item in db.aggregate_user_logs(user_id)[0].values())
+    compress = n_logs > EXPORT_GZIP_ROWS
+    rows = db.iter_export_rows(user_id, since, until, project)
+    # encoding runs in a worker thread, so other users are not blocked by a large export
+    document = await asyncio.to_thread(stream_rows_to_csv, rows, compress)
+    with document:
+        await context.bot.send_document(update.effective_chat.id, document=document,
+                                        filename="export.csv.gz" if compress else "export.csv")
+
+
 async def logs_list_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     # answer query
-    await query.answer()
+    answer(update, context)
 
-    # logic to aggregate logs
-    log_list, msg = db.list_user_logs(update.effective_user.id)
-    # create a csv file
-    filename = save_list_of_rows_to_csv(log_list, "export.csv")
-    # update the logs section
-    await context.bot.send_document(query["message"]["chat"].id, document=open(filename, "rb"))
-    # remove the csv file
-    os.remove(filename)
+    # export every log
+    await send_export(update, context)
 
     return STATE_LOG_MENU_ENTERED
 
 
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' /export [dd.mm.yyyy[ - dd.mm.yyyy]] [project] - export logs of a date range and/or a project '''
+    tz = db.settings(update.effective_user.id)["timezone"]
+    dates, project = re.match(EXPORT_ARGS, " ".join(context.args)).groups()
+    try:
+        since, until = parse_date_range(dates, tz=tz) if dates else (0, MAX_TIMESTAMP)
+    except ValueError:
+        await update.message.reply_text("Usage: /export [dd.mm.yyyy - dd.mm.yyyy] [project]")
+        return
+    await send_export(update, context, since, until, project or None)
+    # NOTE returns None, so the state of the conversation stays as is
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' /import - explain how to import logs '''
+    await update.message.reply_text(
+        "Send me a CSV or JSON file (e.g. an export of this bot or of another tracker, gzipped or not) to "
+        "import its logs. A CSV needs a header with at least the columns START, STOP (or DURATION) and "
+        "PROJECT, times without an offset are in your timezone. Logs you already have are skipped.")
+
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' A file sent to the bot is imported into the logs of the user (see `importer.py`).
+    It is parsed in a worker thread, the progress is shown by editing a single message
+    '''
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("The file is too large, bots can only download files up to 20 MB")
+        return
+    message = await update.message.reply_text("Importing...")
+    loop = asyncio.get_running_loop()
+    edits = []
+    last_edit = time.monotonic()
+
+    def progress(report: ImportReport) -> None:
+        # runs in the worker thread, the edit is sent from the event loop
+        nonlocal last_edit
+        if time.monotonic() - last_edit >= IMPORT_PROGRESS_INTERVAL:
+            last_edit = time.monotonic()
+            edits.append(asyncio.run_coroutine_threadsafe(context.bot.edit_message_text(
+                report.text(done=False), message.chat_id, message.message_id, rate_limit_args=BACKGROUND), loop))
+
+    text = "Import failed, please try again later"  # e.g. the download broke off
+    try:
+        with SpooledTemporaryFile(max_size=IMPORT_MAX_BYTES) as data:
+            file = await context.bot.get_file(document.file_id)
+            await file.download(out=data)
+            data.seek(0)
+            report = await asyncio.to_thread(LogImporter(db, update.effective_user.id).run, data, progress)
+        text = report.text()
+    except ValueError as e:  # not a table with a header, broken JSON, CSV or gzip
+        text = f"Import failed: {e}"
+    finally:
+        # the message never stays at "Importing...", and a late progress edit must not replace the result
+        await asyncio.gather(*(asyncio.wrap_future(edit) for edit in edits), return_exceptions=True)
+        await message.edit_text(text)
+    # NOTE returns None, so the state of the conversation stays as is
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    # answer query
+    answer(update, context)
+
+    try:
+        # the whole history is loaded into arrays, keep it off the event loop
+        _, msg = await asyncio.to_thread(db.stats, update.effective_user.id)
+    except RuntimeError:
+        logger.exception("Stats are not available")
+        msg = "Stats are not available at the moment"
+    await query.edit_message_text(text=msg, reply_markup=KEYBOARD_LOGS)
+    return STATE_LOG_MENU_ENTERED
+
+
+async def global_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' /globalstats - statistics over every user, only for the users listed in ADMIN_IDS '''
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        _, msg = await asyncio.to_thread(db.global_stats)
+    except RuntimeError:
+        logger.exception("Global stats are not available")
+        msg = "Stats are not available at the moment"
+    await update.message.reply_text(msg)
+    # NOTE returns None, so the state of the conversation stays as is
+
+
 async def reset_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer()
+    answer(update, context)
 
     # actually reset logs
     db.reset_user_data(update.effective_user.id, only_logs=True)
+    update_deadlines(context, update.effective_user.id)
     
-    # edit the current converasation message
-    await query.edit_message_text(text="User Logs were cleared", reply_markup=None)
-
-    #start a new conversation
-    return await start(update, context, start_over=True)
+    # edit the current converasation message and start a new conversation at once
+    _, state = await asyncio.gather(query.edit_message_text(text="User Logs were cleared", reply_markup=None),
+                                    start(update, context, start_over=True))
+    return state
     
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer()
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
-
-    # generate a display message
-    msg = f'Settings:\n' + '-'*60 + '\n\tTimezone: +' + str(user_data["settings"]["timezone"]) + ' GMT' + '\n\tProjects:'
-    for prj in sorted(user_data["settings"]["projects"]):
-        msg += "\n\t\t"+prj
+    answer(update, context)
+    # generate a display message from the user settings
+    user_id = update.effective_user.id
+    msg = rendered(user_id, ("settings",), lambda: settings_text(db.settings(user_id)))
 
     # edit the msg text
     await query.edit_message_text(text=msg, reply_markup=KEYBOARD_SETTINGS)
@@ -327,14 +732,46 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return STATE_SETTINGS_OPENED
 
 
-async def settings_remove_project_choose(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def settings_toggle_live(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    ''' switch the live timer (the elapsed time of a running timer is refreshed every LIVE_INTERVAL seconds) '''
+    live = not db.settings(update.effective_user.id).get("live", False)
+    db.set_live(update.effective_user.id, live)
+    if not live:
+        context.application.live_timers.remove(update.effective_user.id)
+    # show the settings with the new value
+    return await settings(update, context)
+
+
+async def settings_deadlines(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer()
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
+    answer(update, context)
+    msg = ("Please enter after how many minutes a running timer reminds you and after how many hours "
+           "(or \"midnight\") it stops by itself, e.g. \"60 10\" or \"90 midnight\". 0 switches it off")
+    await query.edit_message_text(text=msg, reply_markup=None)
+    return STATE_SETTING_DEADLINES
+
+
+async def settings_deadlines_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    match = re.match(DEADLINE_ARGS, update.message.text.lower())
+    if match is None:  # wrong format, ask again
+        await update.message.reply_text("Please enter two numbers (minutes and hours), e.g. \"60 10\" or \"60 midnight\"")
+        return STATE_SETTING_DEADLINES
+    remind, autostop = match.groups()
+    db.set_deadlines(update.effective_user.id, int(remind), autostop if autostop == "midnight" else int(autostop))
+    # a running timer gets the new deadlines right away
+    update_deadlines(context, update.effective_user.id)
+    return await start(update, context)
+
 
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(pr, callback_data=pr)] for pr in sorted(user_data["settings"]["projects"])])
+async def settings_remove_project_choose(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # answer query
+    query = update.callback_query
+    answer(update, context)
+    # a button per project of the user settings
+    user_id = update.effective_user.id
+    keyboard = rendered(user_id, ("remove_projects",), lambda: InlineKeyboardMarkup(
+        [[InlineKeyboardButton(pr, callback_data=pr)] for pr in sorted(db.settings(user_id)["projects"])]))
     msg = "Choose a project to delete from database (entries will be preserved)"
     await update.callback_query.edit_message_text(text=msg, reply_markup=keyboard)
     
@@ -344,11 +781,9 @@ async def settings_remove_project_choose(update: Update, context: ContextTypes.D
 async def settings_remove_project_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer(text=f"Project {query.data} deleted from database")
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
+    answer(update, context, text=f"Project {query.data} deleted from database")
     # delete project from database, it was saved in query.data
-    user_data["settings"]["projects"].remove(query.data)
+    db.remove_project(update.effective_user.id, query.data)
     
     # start new conversation
     return await start(update, context)
@@ -357,7 +792,7 @@ async def settings_remove_project_confirm(update: Update, context: ContextTypes.
 async def settings_add_project_choose(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer()
+    answer(update, context)
 
     msg = "Please type a name of your new project"
     await update.callback_query.edit_message_text(text=msg, reply_markup=None)
@@ -368,11 +803,8 @@ async def settings_add_project_choose(update: Update, context: ContextTypes.DEFA
 async def settings_add_project_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # NOTE no need to answer query, since no inline-keyboard button was presses
     logger.info(f"settings_add_project_confirm {update.message.text}")
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    # add project to the database
-    if not (prj := update.message.text) in user_data["settings"]["projects"]:
-        user_data["settings"]["projects"].append(prj)
+    # add project to the database (duplicates are ignored)
+    db.add_project(update.effective_user.id, update.message.text)
 
     return await start(update, context)
 
@@ -380,10 +812,11 @@ async def settings_add_project_confirm(update: Update, context: ContextTypes.DEF
 async def settings_set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # answer query
     query = update.callback_query
-    await query.answer()
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    msg = f'Current timezone: +{user_data["settings"]["timezone"]} GMT.\n\nPlease enter new timezone (set 0 for UTC)'
+    answer(update, context)
+    # get user settings from the database
+    settings = db.settings(update.effective_user.id)
+    msg = f'Current timezone: {timezone_name(settings["timezone"])}.\n\nPlease enter new timezone: a name like ' \
+          f'Europe/Berlin (follows daylight saving time) or hours from UTC like 3, -5 or +5:30 (set 0 for UTC)'
     await update.callback_query.edit_message_text(text=msg, reply_markup=None)
 
     return STATE_SETTING_TZ
@@ -391,23 +824,213 @@ async def settings_set_timezone(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def settings_set_timezone_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        tz = int(update.message.text)
-    except ValueError:  # if we try to convert a string
-        #await update.callback_query.edit_message_text(text="Please enter an integer!", reply_markup=None)
+        tz = parse_timezone(update.message.text)
+    except ValueError:  # neither an offset nor a known zone name
+        await update.message.reply_text("Unknown timezone, please enter a name like Europe/Berlin or hours like +3")
         return STATE_SETTING_TZ
-    # get user data from replit database
-    user_data = db.user_data(update.effective_user.id)
-    user_data["settings"]["timezone"] = tz
+    # save the timezone in the database
+    db.set_timezone(update.effective_user.id, tz)
     return await start(update, context)
 
 
-def main(BOT_API_TOKEN) -> None:
-    """Run the bot."""
-    application = Application.builder().token(BOT_API_TOKEN).build()
+class UserOrderedApplication(Application):
+    ''' Application that processes the updates of a single user one after another.
+
+    With concurrent updates, updates of different users run in parallel, while the updates of a user are
+    chained: the next one is passed on when the one before it is done, and only the head of the chain waits
+    for one of the `concurrent_updates` slots, so a user sending a burst holds one slot and the other users
+    are not queued behind the burst. The whole processing of an update (the conversation state and the
+    read-modify-write of the storage) is also guarded by a lock of its user, which the live timers and the
+    deadlines take as well. A double tap of ⏹ or ⏸ thus sees the state left by the first tap instead of
+    racing it.
+    At most UPDATES_IN_FLIGHT updates are taken from the update queue before they are processed, so when
+    the bot falls behind the queue fills up and pushes back: the webhook answers 429, the workers of a
+    sharded bot and the poller wait
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_locks = KeyedLock()
+        # the updates of a user waiting for the one of the user that is processed
+        self.user_updates: Dict[int, Deque[object]] = {}
+        self.update_slots = asyncio.Semaphore(UPDATES_IN_FLIGHT)
+        self.updates_in_flight = 0
+        self.first_update_done = False
+        # one scheduler refreshes the messages of all live timers
+        self.live_timers = LiveTimers(self.bot, timer_view, self.user_locks, interval=LIVE_INTERVAL,
+                                      max_edits_per_second=LIVE_EDITS_PER_SECOND)
+        # one heap holds the reminders and auto-stops of all running timers
+        self.deadlines = DeadlineScheduler(self.fire_deadline)
+
+    async def start(self) -> None:
+        await super().start()
+        self.live_timers.start()
+        self.deadlines.start()
+        # in the background, the bot answers while the users are scanned
+        self.create_task(self.rebuild_deadlines())
+
+    async def stop(self) -> None:
+        # no edits after the bot stopped
+        await self.live_timers.stop()
+        await self.deadlines.stop()
+        await super().stop()
+
+    def arm_deadlines(self, user_id: int, log: Optional[dict], settings: dict, replace: bool = True) -> None:
+        ''' arm the reminder and the auto-stop of the running log of the user, disarm those it does not have
+        Args:
+            log : dict - the running log, None if nothing is recorded
+            replace : bool - False keeps the deadlines that are armed already
+        '''
+        now = now_timestamp()
+        deadlines = Storage.timer_deadlines(log, settings, now) if log is not None else {}
+        for kind in ("remind", "autostop"):
+            key = (user_id, kind)
+            if not replace and key in self.deadlines:
+                continue
+            when = deadlines.get(kind)
+            if when is None or (kind == "remind" and when <= now):  # a reminder that is over is not repeated
+                self.deadlines.disarm(key)
+            else:
+                self.deadlines.arm(key, when)
+
+    async def rebuild_deadlines(self) -> None:
+        ''' arm the deadlines of the timers that were running when the bot stopped '''
+        # other workers arm the timers of their users
+        select = lambda user_id: shard_of(user_id, SHARD_COUNT) == SHARD_INDEX
+        timers = await asyncio.to_thread(lambda: list(db.running_timers(select if SHARD_COUNT > 1 else None)))
+        for user_id, _, log, settings in timers:
+            self.arm_deadlines(user_id, log, settings, replace=False)
+        logger.info("Armed the deadlines of %d running timers", len(timers))
+
+    async def fire_deadline(self, key: Tuple[int, str], when: float) -> None:
+        ''' send the reminder or stop the timer, unless the timer changed since the deadline was armed '''
+        user_id, kind = key
+        # checked and applied under the lock, the message is sent without it: the updates of the user do
+        # not wait for the BACKGROUND send slots
+        async with self.user_locks(user_id):
+            _, log = db.current_log(user_id)
+            if log is None:
+                return
+            settings = db.settings(user_id)
+            now = now_timestamp()
+            when = Storage.timer_deadlines(log, settings, now).get(kind)
+            if when is None:
+                return
+            if when > now:  # moved meanwhile, e.g. armed before a restart and paused since
+                self.deadlines.arm(key, when)
+                return
+            if kind == "remind":
+                duration, _, _ = Storage.timer_state(log, now)
+                text = f'⏰ "{log["name"]}" is running for {timedelta_to_str(duration)}. Still on it?'
+                reply_markup = KEYBOARD_TIMER_STARTED
+            else:
+                # the log ends at the deadline, not when the message goes out
+                log = db.stop_log(user_id, at=when)
+                self.live_timers.remove(user_id)
+                self.deadlines.disarm((user_id, "remind"))
+                text = "⏹ Timer stopped automatically. " + stopped_log_text(log, settings["timezone"])
+                reply_markup = None
+        await self.bot.send_message(user_id, text=text, reply_markup=reply_markup, rate_limit_args=BACKGROUND)
+
+    async def _update_fetcher(self) -> None:
+        ''' the fetcher of `Application`, except that an update goes to the chain of its user '''
+        if not self.concurrent_updates:
+            await super()._update_fetcher()
+            return
+        while True:
+            await self.update_slots.acquire()
+            update = await self.update_queue.get()
+            if update is _STOP_SIGNAL:
+                # like `Application`, the updates still in the queue are dropped
+                while not self.update_queue.empty():
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                self.update_slots.release()
+                return
+            self.updates_in_flight += 1
+            user = update.effective_user if isinstance(update, Update) else None
+            if user is not None and user.id in self.user_updates:
+                self.user_updates[user.id].append(update)
+                continue
+            if user is not None:
+                self.user_updates[user.id] = deque()
+            self.create_task(self.process_chain(user.id if user is not None else None, update), update=update)
+
+    async def process_chain(self, user_id: Optional[int], update: object) -> None:
+        ''' process the update, then the updates of the user that came meanwhile, one slot at a time '''
+        while True:
+            try:
+                async with self._concurrent_updates_sem:
+                    await self.process_update(update)
+            except Exception as exc:  # the rest of the chain still runs
+                await self.process_error(update, exc)
+            finally:
+                self.update_queue.task_done()
+                self.updates_in_flight -= 1
+                self.update_slots.release()
+            pending = self.user_updates.get(user_id)
+            if not pending:
+                self.user_updates.pop(user_id, None)
+                return
+            update = pending.popleft()
+
+    async def process_update(self, update: object) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update)
+        else:
+            async with self.user_locks(user.id):
+                if isinstance(self.persistence, StoragePersistence):
+                    # the conversation states of a user are loaded on their first update, not at startup
+                    for name, states in self.persistence.load_user(user.id).items():
+                        if name in self._conversation_handler_conversations:
+                            self._conversation_handler_conversations[name].update_no_track(states)
+                await super().process_update(update)
+        if not self.first_update_done:
+            self.first_update_done = True
+            startup_phase("first_update")
+
+
+async def post_init(application: Application) -> None:
+    startup_phase("initialized")
+
+
+async def shutdown(application: Application) -> None:
+    ''' Final flush of the storage cache, called by the application on shutdown (e.g. SIGTERM) '''
+    db.close()
+
+
+def main(BOT_API_TOKEN, request: BaseRequest = None) -> None:
+    """Run the bot.
+    `request` replaces the HTTP transport to the Bot API, e.g. by `fakes.FakeRequest` in benchmarks
+    """
+    # Bot API calls are timed for /metrics, the default transports are the ones of the builder
+    builder = (
+        Application.builder()
+        .token(BOT_API_TOKEN)
+        .application_class(UserOrderedApplication)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .persistence(StoragePersistence(db, update_interval=PERSISTENCE_INTERVAL))
+        .request(metrics.InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+        .get_updates_request(metrics.InstrumentedRequest(request or HTTPXRequest()))
+        # flood limits, priorities and coalescing of the calls to the Bot API
+        .rate_limiter(Outbox(rate=TELEGRAM_RATE_LIMIT))
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+    )
+    application = builder.build()
+    metrics.UPDATE_QUEUE.set_function(application.update_queue.qsize)
+    metrics.UPDATES_IN_FLIGHT.set_function(lambda: application.updates_in_flight)
 
 
+    # the commands work in every state of the conversation
+    commands = [CommandHandler('start', start), CommandHandler('export', export_command),
+                CommandHandler('globalstats', global_stats_command), CommandHandler('go', go_command),
+                CommandHandler('stop', stop_command), CommandHandler('pause', pause_command),
+                CommandHandler('resume', resume_command), CommandHandler('import', import_command),
+                MessageHandler(filters.Document.ALL, import_document)]
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=commands,
         states={
             STATE_START: [
                 CallbackQueryHandler(record, pattern=GOTO_RECORD),
@@ -419,6 +1042,8 @@ def main(BOT_API_TOKEN) -> None:
                 CallbackQueryHandler(settings_add_project_choose, pattern=GOTO_SETTINGS_ADD_PRJ),
                 CallbackQueryHandler(settings_remove_project_choose, pattern=GOTO_SETTINGS_DEL_PRJ),
                 CallbackQueryHandler(settings_set_timezone, pattern=GOTO_SETTINGS_SET_TZ),
+                CallbackQueryHandler(settings_toggle_live, pattern=f"^{GOTO_SETTINGS_LIVE}$"),
+                CallbackQueryHandler(settings_deadlines, pattern=f"^{GOTO_SETTINGS_DEADLINES}$"),
                 CallbackQueryHandler(start, pattern=GOTO_MAIN_MENU),
             ],
             STATE_PRJ_SELECTED: [
@@ -426,7 +1051,11 @@ def main(BOT_API_TOKEN) -> None:
                 CallbackQueryHandler(start_timer),
             ],
             STATE_LOG_MENU_ENTERED: [
-                CallbackQueryHandler(logs_list_table, pattern=GOTO_LOGS_LIST),
+                CallbackQueryHandler(logs_period, pattern=f"^({GOTO_LOGS_TODAY}|{GOTO_LOGS_WEEK}|{GOTO_LOGS_MONTH})$"),
+                CallbackQueryHandler(logs_range_choose, pattern=f"^{GOTO_LOGS_RANGE}$"),
+                CallbackQueryHandler(stats, pattern=f"^{GOTO_STATS}$"),
+                CallbackQueryHandler(logs_list_table, pattern=f"^({GOTO_LOGS_LIST}$|{PAGE_PREFIX})"),
+                CallbackQueryHandler(logs, pattern=f"^{GOTO_LOGS}$"),
                 CallbackQueryHandler(logs_list_export, pattern=GOTO_LOGS_EXPORT),
                 CallbackQueryHandler(reset_logs, pattern=GOTO_RESET),
                 CallbackQueryHandler(start, pattern=GOTO_MAIN_MENU),
@@ -436,26 +1065,37 @@ def main(BOT_API_TOKEN) -> None:
                 CallbackQueryHandler(stop_timer, pattern=GOTO_TIMER_STOP),
             ],
             STATE_ADDING_PROJECT: [
-                MessageHandler(filters.ALL, settings_add_project_confirm),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, settings_add_project_confirm),
             ],
             STATE_SETTINGS_DEL_PRJ: [
                 CallbackQueryHandler(settings_remove_project_confirm),
             ],
             STATE_SETTING_TZ: [
-                MessageHandler(filters.ALL, settings_set_timezone_confirm),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, settings_set_timezone_confirm),
+            ],
+            STATE_SETTING_DEADLINES: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, settings_deadlines_confirm),
+            ],
+            STATE_LOG_RANGE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, logs_range_confirm),
             ],
             ConversationHandler.TIMEOUT:  [
                 MessageHandler(None, start),
             ],
         },
-        fallbacks=[CommandHandler('start', start)],
+        fallbacks=commands,
+        # the states survive restarts (see persistence.py)
+        name="main",
+        persistent=True,
     )
 
-    # Register conv handler
+    # inline mode, outside of the conversation
+    inline_handlers = [InlineQueryHandler(inline_query), ChosenInlineResultHandler(inline_chosen)]
+
+    # Register the handlers, every callback reports its latency to /metrics
+    metrics.instrument_handlers([conv_handler] + inline_handlers)
     application.add_handler(conv_handler)
+    application.add_handlers(inline_handlers)
 
-    # Start the Bot
-    #application.run_polling()
-    for k in db.db.keys():
-        del db.db[k]
-    return application
\ No newline at end of file
+    startup_phase("built")
+    return application
@@ -0,0 +1,340 @@
+import atexit
+import copy
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from backends import Backend
+from columnar import LogColumns
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()  # marks a part of the user that was not loaded from the engine yet
+
+
+class _UserEntry():
+    ''' Cached parts of a single user together with the changes that are not written yet '''
+    __slots__ = ("settings", "recording", "logs", "meta", "dirty_settings", "dirty_recording", "dirty_logs", "dirty_meta")
+
+    def __init__(self):
+        self.settings = _MISSING
+        self.recording = _MISSING
+        self.logs = {}  # log_id -> log, only the logs that were touched recently
+        self.meta = {}  # key -> value, loaded on demand
+        self.dirty_settings = False
+        self.dirty_recording = False
+        self.dirty_logs = set()
+        self.dirty_meta = set()
+
+    @property
+    def dirty(self) -> bool:
+        return self.dirty_settings or self.dirty_recording or bool(self.dirty_logs) or bool(self.dirty_meta)
+
+
+class CachedBackend(Backend):
+    ''' Write-behind LRU cache in front of another engine.
+
+    Reads of settings, the recording pointer and single logs are served from memory once loaded,
+    writes only mark the user as dirty. Dirty users are written to the wrapped engine in batches by
+    a background thread every `flush_interval` seconds or as soon as `flush_count` changes are pending.
+    Full scans (`iter_logs`) and destructive operations write the pending changes of the user first.
+    Args:
+        backend        : Backend - the wrapped engine
+        capacity       : int - max number of users kept in memory (dirty users are never evicted)
+        flush_interval : float - seconds between two background flushes
+        flush_count    : int - number of pending changes that triggers an early flush
+    '''
+    def __init__(self, backend: Backend, capacity: int = 10000, flush_interval: float = 5.0, flush_count: int = 500):
+        self.backend = backend
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+
+        self.users: "OrderedDict[str, _UserEntry]" = OrderedDict()
+        self.pending = 0
+        self.lock = threading.RLock()  # guards the cache itself
+        self.flush_lock = threading.RLock()  # serialises writes to the wrapped engine
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="storage-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        metrics.CACHE_USERS.set_function(lambda: len(self.users))
+        metrics.CACHE_PENDING.set_function(lambda: self.pending)
+
+    # ---------------------------------------------------------------- internals
+    def _entry(self, user_id: str, create: bool = True) -> Optional[_UserEntry]:
+        ''' get (or create) the cache entry of the user and mark it as recently used. An entry means the engine
+        has the user (see `has_user`), so reads pass `create=False` and add it only once the engine returned data
+        of the user or `_known` confirmed them
+        '''
+        entry = self.users.get(user_id)
+        if entry is None:
+            if not create:
+                return None
+            entry = self.users[user_id] = _UserEntry()
+            self._evict()
+        else:
+            self.users.move_to_end(user_id)
+        return entry
+
+    def _known(self, user_id: str) -> bool:
+        ''' the user is cached or the engine has them, asked when a read of the engine found nothing '''
+        with self.lock:
+            if user_id in self.users:
+                return True
+        return self.backend.has_user(user_id)
+
+    def _evict(self) -> None:
+        ''' drop least recently used clean users, until the cache fits its capacity '''
+        while len(self.users) > self.capacity:
+            for user_id, entry in self.users.items():
+                if not entry.dirty:
+                    break
+            else:
+                return  # everything is dirty, the next flush makes room
+            del self.users[user_id]
+
+    def _changed(self) -> None:
+        self.pending += 1
+        if self.pending >= self.flush_count:
+            self._wakeup.set()
+
+    def _flush_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Background flush of the storage cache failed")
+
+    def _take_changes(self, entry: _UserEntry) -> dict:
+        ''' copy the pending changes of the entry and mark it clean (call with `self.lock` held) '''
+        changes = {"logs": {log_id: dict(entry.logs[log_id]) for log_id in entry.dirty_logs}}
+        if entry.dirty_settings:
+            changes["settings"] = copy.deepcopy(entry.settings)
+        if entry.dirty_recording:
+            changes["recording"] = entry.recording
+        if entry.dirty_meta:
+            changes["meta"] = {key: copy.deepcopy(entry.meta[key]) for key in entry.dirty_meta}
+        entry.dirty_settings = entry.dirty_recording = False
+        entry.dirty_logs = set()
+        entry.dirty_meta = set()
+        # keep only the running log in memory, the rest is in the engine now
+        entry.logs = {k: v for k, v in entry.logs.items() if k == entry.recording}
+        return changes
+
+    def _restore_changes(self, batch: Dict[str, dict]) -> None:
+        ''' mark the changes of a failed flush as dirty again, unless they were overwritten meanwhile '''
+        for user_id, changes in batch.items():
+            entry = self._entry(user_id)
+            for log_id, log in changes["logs"].items():
+                if log_id not in entry.dirty_logs:
+                    entry.logs[log_id] = log
+                    entry.dirty_logs.add(log_id)
+            if "settings" in changes and not entry.dirty_settings:
+                entry.settings, entry.dirty_settings = changes["settings"], True
+            if "recording" in changes and not entry.dirty_recording:
+                entry.recording, entry.dirty_recording = changes["recording"], True
+            for key, value in changes.get("meta", {}).items():
+                if key not in entry.dirty_meta:
+                    entry.meta[key] = value
+                    entry.dirty_meta.add(key)
+
+    def flush(self, user_id: Optional[str] = None) -> int:
+        ''' Write pending changes of all users (or of a single user) to the wrapped engine.
+        Returns the number of written users
+        '''
+        with self.flush_lock:
+            with self.lock:
+                if user_id is not None:
+                    entry = self.users.get(user_id)
+                    dirty = [user_id] if entry is not None and entry.dirty else []
+                else:
+                    dirty = [uid for uid, entry in self.users.items() if entry.dirty]
+                    self.pending = 0
+                batch = {uid: self._take_changes(self.users[uid]) for uid in dirty}
+            # the engine is called without the cache lock, so handlers are not blocked by the round-trips
+            if batch:
+                try:
+                    self.backend.write_batch(batch)
+                except Exception:
+                    with self.lock:
+                        self._restore_changes(batch)
+                    raise
+            with self.lock:
+                self._evict()
+        return len(batch)
+
+    def close(self) -> None:
+        ''' Stop the background thread, write everything and close the wrapped engine '''
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self.backend.close()
+
+    # ---------------------------------------------------------------- Backend interface
+    def has_user(self, user_id: str) -> bool:
+        with self.lock:
+            if user_id in self.users:
+                return True
+        # a direct key lookup, the user is cached afterwards
+        if not self.backend.has_user(user_id):
+            return False
+        with self.lock:
+            self._entry(user_id)
+        return True
+
+    def add_user(self, user_id: str, settings: dict) -> None:
+        with self.flush_lock:
+            self.backend.add_user(user_id, settings)
+            with self.lock:
+                self.users.pop(user_id, None)
+                entry = self._entry(user_id)
+                entry.settings = copy.deepcopy(settings)
+                entry.recording = None
+
+    def delete_user(self, user_id: str) -> None:
+        with self.flush_lock:
+            with self.lock:
+                self.users.pop(user_id, None)
+            self.backend.delete_user(user_id)
+
+    def user_ids(self) -> Iterator[str]:
+        self.flush()
+        return self.backend.user_ids()
+
+    def get_settings(self, user_id: str) -> dict:
+        with self.lock:
+            entry = self._entry(user_id, create=False)
+            if entry is not None and entry.settings is not _MISSING:
+                metrics.CACHE_REQUESTS.inc("settings", "hit")
+                return copy.deepcopy(entry.settings)
+        metrics.CACHE_REQUESTS.inc("settings", "miss")
+        settings = self.backend.get_settings(user_id)  # KeyError for an unknown user
+        with self.lock:
+            entry = self._entry(user_id)
+            if entry.settings is _MISSING:
+                entry.settings = settings
+            return copy.deepcopy(entry.settings)
+
+    def set_settings(self, user_id: str, settings: dict) -> None:
+        with self.lock:
+            entry = self._entry(user_id)
+            entry.settings = copy.deepcopy(settings)
+            entry.dirty_settings = True
+            self._changed()
+
+    def get_recording(self, user_id: str) -> Optional[str]:
+        with self.lock:
+            entry = self._entry(user_id, create=False)
+            if entry is not None and entry.recording is not _MISSING:
+                metrics.CACHE_REQUESTS.inc("recording", "hit")
+                return entry.recording
+        metrics.CACHE_REQUESTS.inc("recording", "miss")
+        recording = self.backend.get_recording(user_id)  # KeyError for an unknown user
+        with self.lock:
+            entry = self._entry(user_id)
+            if entry.recording is _MISSING:
+                entry.recording = recording
+            return entry.recording
+
+    def set_recording(self, user_id: str, log_id: Optional[str]) -> None:
+        with self.lock:
+            entry = self._entry(user_id)
+            entry.recording = log_id
+            entry.dirty_recording = True
+            self._changed()
+
+    def get_log(self, user_id: str, log_id: str) -> Optional[dict]:
+        with self.lock:
+            entry = self._entry(user_id, create=False)
+            if entry is not None and log_id in entry.logs:
+                metrics.CACHE_REQUESTS.inc("log", "hit")
+                return dict(entry.logs[log_id])
+        metrics.CACHE_REQUESTS.inc("log", "miss")
+        log = self.backend.get_log(user_id, log_id)
+        if log is None:
+            return None
+        with self.lock:
+            entry = self._entry(user_id)
+            entry.logs.setdefault(log_id, log)
+            return dict(entry.logs[log_id])
+
+    def put_log(self, user_id: str, log_id: str, log: dict) -> None:
+        self.put_logs(user_id, {log_id: log})
+
+    def put_logs(self, user_id: str, logs: Dict[str, dict]) -> None:
+        with self.lock:
+            entry = self._entry(user_id)
+            for log_id, log in logs.items():
+                entry.logs[log_id] = dict(log)
+                entry.dirty_logs.add(log_id)
+                self._changed()
+
+    def delete_log(self, user_id: str, log_id: str) -> None:
+        with self.flush_lock:
+            self.flush(user_id)
+            with self.lock:
+                entry = self._entry(user_id, create=False)
+                if entry is not None:
+                    entry.logs.pop(log_id, None)
+            self.backend.delete_log(user_id, log_id)
+
+    def clear_logs(self, user_id: str) -> None:
+        with self.flush_lock:
+            with self.lock:
+                entry = self._entry(user_id, create=False)
+                if entry is not None:
+                    entry.logs = {}
+                    entry.dirty_logs = set()
+            self.flush(user_id)
+            self.backend.clear_logs(user_id)
+
+    def iter_logs(self, user_id: str) -> Iterator[Tuple[str, dict]]:
+        self.flush(user_id)
+        return self.backend.iter_logs(user_id)
+
+    def log_columns(self, user_id: str) -> LogColumns:
+        self.flush(user_id)
+        return self.backend.log_columns(user_id)
+
+    def iter_logs_range(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                        reverse: bool = False, limit: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+        self.flush(user_id)
+        return self.backend.iter_logs_range(user_id, since, until, project, reverse, limit)
+
+    def period_totals(self, user_id: str, since: int, until: int, project: Optional[str] = None,
+                      skip: Optional[str] = None) -> Dict[str, List[int]]:
+        self.flush(user_id)
+        return self.backend.period_totals(user_id, since, until, project, skip)
+
+    def get_meta(self, user_id: str, key: str) -> Any:
+        with self.lock:
+            entry = self._entry(user_id, create=False)
+            if entry is not None and key in entry.meta:
+                metrics.CACHE_REQUESTS.inc("meta", "hit")
+                return copy.deepcopy(entry.meta[key])
+        metrics.CACHE_REQUESTS.inc("meta", "miss")
+        value = self.backend.get_meta(user_id, key)
+        if value is None and not self._known(user_id):
+            return None
+        with self.lock:
+            entry = self._entry(user_id)
+            entry.meta.setdefault(key, value)
+            return copy.deepcopy(entry.meta[key])
+
+    def set_meta(self, user_id: str, key: str, value: Any) -> None:
+        with self.lock:
+            entry = self._entry(user_id)
+            entry.meta[key] = copy.deepcopy(value)
+            entry.dirty_meta.add(key)
+            self._changed()
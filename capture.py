@@ -0,0 +1,156 @@
+''' Capture of the inbound updates of the running bot, anonymised, for `replay.py`.
+
+Every accepted update is appended as one JSON line {"t": arrival time, "u": update} to the file in
+CAPTURE_PATH. Ids of users and chats are replaced by stable pseudonyms (a keyed hash, the key is
+CAPTURE_SALT or derived from the bot token), names and media are dropped, and words of texts and
+callback data are replaced by pseudonyms too, except the vocabulary of the bot (commands, numbers,
+dates, the callback data of its buttons and the default projects). A word always gets the same
+pseudonym, so a project typed as a text and later picked by its button still match in a replay.
+'''
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+import metrics
+
+CAPTURED = metrics.Counter("capture_updates_total", "Inbound updates written to the capture file", ["result"])
+
+# texts without a word carry no identity: numbers, times, dates, UTC offsets, date ranges
+_PLAIN = re.compile(r"[\d\s.:,+\-/]*$")
+# parts of an update that are a person or a chat
+_PEOPLE = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+# parts of an update with personal data the bot does not read
+_DROP = {"last_name", "bio", "contact", "location", "venue", "photo", "voice", "video", "video_note",
+         "audio", "sticker", "animation", "reply_to_message", "pinned_message"}
+_TEXTS = {"text", "caption", "query", "data"}
+
+
+class Anonymiser():
+    ''' Replaces what identifies a person in a raw update by pseudonyms (see the module docstring).
+    Args:
+        salt : bytes - key of the pseudonyms, the same key gives the same pseudonyms
+        keep : Iterable[str] - words and texts kept as they are
+        keep_prefixes : Iterable[str] - texts with these prefixes are kept, e.g. the callback data of pages
+    '''
+    def __init__(self, salt: bytes, keep: Iterable[str] = (), keep_prefixes: Iterable[str] = ()):
+        self.salt = hashlib.sha256(salt).digest()
+        self.keep = set(keep)
+        self.keep_prefixes = tuple(keep_prefixes)
+
+    def _digest(self, value: str) -> bytes:
+        return hashlib.blake2b(value.encode(), key=self.salt, digest_size=8).digest()
+
+    def id(self, value: int) -> int:
+        ''' a pseudonym of the id of a user or chat, group chats keep their negative sign '''
+        pseudonym = int.from_bytes(self._digest(str(abs(value))), "big") % 10 ** 12 + 1
+        return -pseudonym if value < 0 else pseudonym
+
+    def word(self, word: str) -> str:
+        return "w" + self._digest(word).hex()[:8]
+
+    def text(self, text: str) -> str:
+        if text in self.keep or _PLAIN.match(text) or text.startswith(self.keep_prefixes):
+            return text
+        return " ".join(w if w in self.keep or w.startswith("/") or _PLAIN.match(w) else self.word(w)
+                        for w in text.split(" "))
+
+    def update(self, update: dict) -> dict:
+        ''' an anonymised copy of a raw update '''
+        return self._walk(update, None)
+
+    def _walk(self, value: Any, key: Optional[str]) -> Any:
+        if isinstance(value, list):
+            return [self._walk(item, key) for item in value]
+        if not isinstance(value, dict):
+            return value
+        out = {}
+        for k, v in value.items():
+            if k in _DROP:
+                continue
+            if k == "id" and key in _PEOPLE and isinstance(v, int):
+                v = self.id(v)
+            elif k in _TEXTS and isinstance(v, str):
+                v = self.text(v)
+            elif k == "entities":  # the offsets of the others do not fit the pseudonyms
+                v = [e for e in v if e.get("type") == "bot_command"]
+            elif k in ("first_name", "title"):
+                v = "user" if k == "first_name" else "chat"
+            elif k in ("username", "chat_instance", "file_id", "file_unique_id") and isinstance(v, str):
+                v = self.word(v)
+            elif k == "file_name" and isinstance(v, str):
+                v = "file" + os.path.splitext(v)[1]
+            else:
+                v = self._walk(v, k)
+            out[k] = v
+        return out
+
+
+class UpdateRecorder():
+    ''' Appends the anonymised updates with their arrival time to a JSON lines file.
+    The file is only appended to, so the bot can be restarted into the same capture. Once it holds
+    `max_bytes`, further updates are counted but not written
+    Args:
+        path : str - of the capture
+        anonymiser : Anonymiser
+        max_bytes : int - size of the file after which nothing is written
+    '''
+    def __init__(self, path: str, anonymiser: Anonymiser, max_bytes: int = 100 << 20):
+        self.path = path
+        self.anonymiser = anonymiser
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+
+    def record(self, update: dict, at: Optional[float] = None) -> None:
+        if self.size >= self.max_bytes:
+            CAPTURED.inc("full")
+            return
+        line = json.dumps({"t": round(time.time() if at is None else at, 3), "u": self.anonymiser.update(update)},
+                          separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+        CAPTURED.inc("written")
+
+    def record_raw(self, body: bytes) -> None:
+        ''' record the body of a webhook request '''
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return
+        if isinstance(update, dict):
+            self.record(update)
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, dict]]:
+    ''' (arrival time, update) of a capture, gzipped or not. A torn last line (a crash while writing) is skipped '''
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            record = json.loads(line)
+            yield record["t"], record["u"]
+
+
+def make_recorder(token: str, keep: Iterable[str] = (), keep_prefixes: Iterable[str] = ()) -> Optional[UpdateRecorder]:
+    ''' The recorder into CAPTURE_PATH, None if it is not set. The pseudonyms are keyed by CAPTURE_SALT,
+    by the bot token if it is not set, so they stay the same across restarts. At most CAPTURE_MAX_MB are written
+    '''
+    path = os.environ.get("CAPTURE_PATH")
+    if not path:
+        return None
+    salt = os.environ.get("CAPTURE_SALT") or token
+    return UpdateRecorder(path, Anonymiser(salt.encode(), keep, keep_prefixes),
+                          max_bytes=int(float(os.environ.get("CAPTURE_MAX_MB", "100")) * (1 << 20)))
@@ -0,0 +1,210 @@
+import base64
+import sys
+import uuid
+import zlib
+from array import array
+from itertools import accumulate
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zlib is always there, zstd is optional
+    zstandard = None
+
+
+def compress(data: bytes, codec: str = "zlib") -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("the zstd codec needs `pip install zstandard`")
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9 if codec == "zlib9" else 6)
+
+
+def decompress(data: bytes, codec: str = "zlib") -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("the zstd codec needs `pip install zstandard`")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class LogColumns():
+    ''' Compact columnar layout of the logs of a single user.
+
+    Instead of a dict per log, start/stop/pause times are kept in `array('q')` columns and the project
+    of every log is a small integer pointing into a project table. Log IDs generated by the bot are UUIDs,
+    they are packed as 16 raw bytes each (arbitrary IDs fall back to a list of strings).
+    A log takes about 45 bytes in memory this way, and the conversion from and to the dict format
+    ({log_id: {"name", "start", "stop", "pause"}}) is lossless.
+    '''
+    __slots__ = ("starts", "stops", "pauses", "project_ids", "projects", "_project_index", "_uuids", "_ids")
+
+    def __init__(self):
+        self.starts = array("q")
+        self.stops = array("q")
+        self.pauses = array("q")
+        self.project_ids = array("I")
+        self.projects: List[str] = []  # project table, project_ids point into it
+        self._project_index: Dict[str, int] = {}
+        self._uuids = bytearray()  # 16 bytes per log while all the IDs are UUIDs
+        self._ids = None  # list of str once a non-UUID ID shows up
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def project_id(self, name: str) -> int:
+        ''' index of the project in the project table, the project is added if it is new '''
+        pid = self._project_index.get(name)
+        if pid is None:
+            pid = self._project_index[name] = len(self.projects)
+            self.projects.append(name)
+        return pid
+
+    def _append_id(self, log_id: str) -> None:
+        if self._ids is None:
+            try:
+                packed = uuid.UUID(log_id)
+            except ValueError:
+                packed = None
+            if packed is not None and str(packed) == log_id:
+                self._uuids += packed.bytes
+                return
+            # switch to plain strings for good
+            self._ids = self.ids
+            self._uuids = bytearray()
+        self._ids.append(log_id)
+
+    @property
+    def ids(self) -> List[str]:
+        if self._ids is not None:
+            return list(self._ids)
+        return [str(uuid.UUID(bytes=bytes(self._uuids[i:i + 16]))) for i in range(0, len(self._uuids), 16)]
+
+    def position(self, log_id: str) -> int:
+        ''' row of the log in the columns, -1 if there is no such log '''
+        if self._ids is not None:
+            return self._ids.index(log_id) if log_id in self._ids else -1
+        try:
+            packed = uuid.UUID(log_id).bytes
+        except ValueError:
+            return -1
+        i = self._uuids.find(packed)
+        while i != -1 and i % 16:  # a match across two IDs, look further
+            i = self._uuids.find(packed, i + 1)
+        return -1 if i == -1 else i // 16
+
+    def append(self, log_id: str, log: dict) -> None:
+        self.append_row(log_id, log["name"], log["start"], log["stop"], log["pause"])
+
+    def append_row(self, log_id: str, name: str, start: int, stop: int, pause: int) -> None:
+        self._append_id(log_id)
+        self.starts.append(start)
+        self.stops.append(stop)
+        self.pauses.append(pause)
+        self.project_ids.append(self.project_id(name))
+
+    def extend(self, items: Iterable[Tuple[str, dict]]) -> None:
+        for log_id, log in items:
+            self.append(log_id, log)
+
+    @classmethod
+    def concatenate(cls, parts: Iterable["LogColumns"]) -> "LogColumns":
+        ''' the rows of all parts in one layout, project IDs are remapped to a common project table '''
+        columns = cls()
+        for part in parts:
+            remap = [columns.project_id(name) for name in part.projects]
+            columns.starts.extend(part.starts)
+            columns.stops.extend(part.stops)
+            columns.pauses.extend(part.pauses)
+            columns.project_ids.extend(remap[pid] for pid in part.project_ids)
+            if columns._ids is None and part._ids is None:
+                columns._uuids += part._uuids
+            else:
+                if columns._ids is None:
+                    columns._ids = columns.ids
+                    columns._uuids = bytearray()
+                columns._ids.extend(part.ids)
+        return columns
+
+    @classmethod
+    def from_dict(cls, logs: Dict[str, dict]) -> "LogColumns":
+        columns = cls()
+        columns.extend(logs.items())
+        return columns
+
+    def log(self, i: int) -> dict:
+        ''' the log of a row in the dict format '''
+        return {"name": self.projects[self.project_ids[i]], "start": self.starts[i], "stop": self.stops[i],
+                "pause": self.pauses[i]}
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        ''' (log_id, log) pairs in the dict format '''
+        projects = self.projects
+        return (
+            (log_id, {"name": projects[pid], "start": start, "stop": stop, "pause": pause})
+            for log_id, start, stop, pause, pid in zip(self.ids, self.starts, self.stops, self.pauses, self.project_ids)
+        )
+
+    def to_dict(self) -> Dict[str, dict]:
+        return dict(self.items())
+
+    def durations(self) -> array:
+        return array("q", (stop - start - pause for start, stop, pause in zip(self.starts, self.stops, self.pauses)))
+
+    # ---------------------------------------------------------------- serialisation
+    @staticmethod
+    def _le_bytes(column: array) -> bytes:
+        ''' raw bytes of the column in little-endian order, whatever the platform '''
+        if sys.byteorder == "big":
+            column = array(column.typecode, column)
+            column.byteswap()
+        return column.tobytes()
+
+    @staticmethod
+    def _from_le_bytes(typecode: str, data: bytes) -> array:
+        column = array(typecode)
+        column.frombytes(data)
+        if sys.byteorder == "big":
+            column.byteswap()
+        return column
+
+    def dump(self, codec: str = "zlib") -> dict:
+        ''' JSON-serialisable representation, e.g. for a replit value.
+        Starts are delta-encoded and stops stored as the length of the log, so zlib squeezes the numbers well.
+        `codec` is "zlib", "zlib9" (slower, smaller) or "zstd" (needs the zstandard package)
+        '''
+        starts = array("q", (b - a for a, b in zip([0] + list(self.starts[:-1]), self.starts)))
+        lengths = array("q", (stop - start for start, stop in zip(self.starts, self.stops)))
+        numbers = b"".join(self._le_bytes(column) for column in (starts, lengths, self.pauses, self.project_ids))
+        out = {
+            "v": 1,
+            "n": len(self),
+            "projects": self.projects,
+            "data": base64.b64encode(compress(numbers, codec)).decode("ascii"),
+        }
+        if codec != "zlib":
+            out["codec"] = codec
+        if self._ids is None:
+            out["uuids"] = base64.b64encode(bytes(self._uuids)).decode("ascii")
+        else:
+            out["ids"] = self._ids
+        return out
+
+    @classmethod
+    def load(cls, dumped: dict) -> "LogColumns":
+        columns = cls()
+        n = dumped["n"]
+        numbers = decompress(base64.b64decode(dumped["data"]), dumped.get("codec", "zlib"))
+        deltas = cls._from_le_bytes("q", numbers[:8 * n])
+        lengths = cls._from_le_bytes("q", numbers[8 * n:16 * n])
+        columns.pauses = cls._from_le_bytes("q", numbers[16 * n:24 * n])
+        columns.project_ids = cls._from_le_bytes("I", numbers[24 * n:])
+        columns.starts = array("q", accumulate(deltas))
+        columns.stops = array("q", (start + length for start, length in zip(columns.starts, lengths)))
+        columns.projects = list(dumped["projects"])
+        columns._project_index = {name: i for i, name in enumerate(columns.projects)}
+        if "ids" in dumped:
+            columns._ids = list(dumped["ids"])
+        else:
+            columns._uuids = bytearray(base64.b64decode(dumped["uuids"]))
+        return columns
@@ -1,116 +1,733 @@
-from replit import db
-from helpers import now_timestamp, timestamp_to_str, timedelta_to_str
-from telegram.ext import ContextTypes
-from itertools import groupby
-from typing import Tuple, List
+from helpers import Timezone, now_timestamp, timestamp_to_str, timedelta_to_str, period_bounds
+from backends import Backend, make_backend
+from columnar import LogColumns
+from journal import Journal, make_journal
+import aggregates
+import journal as events
+import metrics
+import timefmt
+from typing import Callable, Dict, Iterable, Iterator, Tuple, List, Optional, Sequence
+from collections import OrderedDict
+from uuid import uuid4
+import functools
+import itertools
+import threading
 
 
+MAX_TIMESTAMP = 2**62  # upper bound for open time ranges (fits SQLite INTEGER with room to spare)
+MESSAGE_LIMIT = 4096  # max length of a telegram message
+
 PROJECTLIST = [
     "Work",
     "Sport",
     "Education",
     "Portfolio"
 ]
+VERSIONS_SIZE = 100000  # users whose data version is remembered
+
+
+def mutation(method: Callable) -> Callable:
+    ''' a `Storage` method that changes the data of the user (its first argument), it bumps their version.
+    Once the change is applied, the journal compacts the shards that are due (see `Journal.compact`)
+    '''
+    @functools.wraps(method)
+    def wrapper(self, user_id, *args, **kwargs):
+        try:
+            result = method(self, user_id, *args, **kwargs)
+        finally:
+            self.bump_version(user_id)
+        if self._journal is not None:
+            self._journal.compact()
+        return result
+    return wrapper
 
 
 class Storage():
-    ''' A wrapper to the replit internal database. Note that in order to use it outside REPLIT platform,
-    you must provide a URL to the storage (line `self.db = db` will not work)
+    ''' A wrapper around the storage engine of the bot (see `backends.py`).
+    By default the engine is chosen with the STORAGE_BACKEND environment variable: the replit internal
+    database ("replit") or a local SQLite file ("sqlite"). Note that in order to use replit outside REPLIT
+    platform, you must provide a URL to the storage (REPLIT_DB_URL).
+    With a journal (STORAGE_JOURNAL, see `journal.py`) the running timers are not kept in the engine but
+    appended as events to the journal, a finished log is written to the engine when it is stopped.
+    The engine is created on first use, so creating a `Storage` costs nothing
     '''
-    def __init__(self):
-        self.db = db
-    
+    def __init__(self, backend: Backend = None, journal: Journal = None):
+        self._backend = backend
+        self._backend_lock = threading.Lock()
+        self._journal = journal
+        self._journal_opened = False
+        self._journal_lock = threading.Lock()
+        self._versions: "OrderedDict[str, int]" = OrderedDict()
+        self._version_counter = itertools.count(1)
+        self._versions_lock = threading.Lock()  # mutations may run in worker threads
+
+    @property
+    def backend(self) -> Backend:
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = make_backend()
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend: Backend) -> None:
+        self._backend = backend
+
+    @property
+    def journal(self) -> Optional[Journal]:
+        ''' The journal of the timers, opened and replayed on first use, None without STORAGE_JOURNAL '''
+        if not self._journal_opened:
+            with self._journal_lock:
+                if not self._journal_opened:
+                    journal = self._journal if self._journal is not None else make_journal()
+                    if journal is not None:
+                        journal.checkpoint = journal.checkpoint or self._checkpoint
+                        self._recover(journal)
+                    self._journal = journal
+                    self._journal_opened = True
+        return self._journal
+
+    def _checkpoint(self) -> None:
+        # the journal drops events only after their effects reached the engine
+        flush = getattr(self.backend, "flush", None)
+        if flush is not None:
+            flush()
+
+    def _recover(self, journal: Journal) -> None:
+        ''' Redo the effects of the replayed events the engine may have lost in a crash (the write-behind
+        cache was not flushed): finished logs that are missing and project edits. Undone effects are
+        skipped, i.e. logs deleted later and everything before a reset of the user
+        '''
+        deleted, reset = set(), set()
+        redo = []
+        for event, finished in reversed(journal.tail):
+            user_id, kind = event["u"], event["k"]
+            if user_id in reset:
+                continue
+            if kind == events.RESET:
+                reset.add(user_id)
+            elif kind == events.DELETE:
+                deleted.add(event["id"])
+            elif (finished is not None and finished[0] not in deleted) or kind in (events.ADD_PROJECT,
+                                                                                    events.REMOVE_PROJECT):
+                redo.append((event, finished))
+        for event, finished in reversed(redo):
+            user_id = event["u"]
+            if not self.backend.has_user(user_id):
+                continue
+            if finished is not None:
+                if self.backend.get_log(user_id, finished[0]) is None:
+                    self._finish(user_id, *finished)
+                continue
+            settings = self.backend.get_settings(user_id)
+            projects = settings["projects"]
+            if event["k"] == events.ADD_PROJECT and event["name"] not in projects:
+                projects.append(event["name"])
+            elif event["k"] == events.REMOVE_PROJECT and event["name"] in projects:
+                projects.remove(event["name"])
+            else:
+                continue
+            self.backend.set_settings(user_id, settings)
+        journal.tail.clear()
+
+    def close(self) -> None:
+        ''' Write pending changes and close the journal and the storage engine (if they were ever used) '''
+        if self._journal is not None and self._journal_opened:
+            self._journal.close()
+        if self._backend is not None:
+            self._backend.close()
+
+    def wipe(self) -> int:
+        ''' Delete every user with all their data, return the number of deleted users. Destructive! '''
+        user_ids = list(self.backend.user_ids())
+        for user_id in user_ids:
+            self.backend.delete_user(user_id)
+        if self.journal is not None:
+            self.journal.clear()
+        self._versions.clear()
+        return len(user_ids)
+
+    def version(self, user_id: int) -> int:
+        ''' A number that changes with every change of the data of the user (methods marked as `mutation`),
+        so whatever is rendered from the data can be cached under it. The versions come from one counter,
+        so a user forgotten by the bounded table gets a number no old render was cached under
+        '''
+        user_id = str(user_id)
+        with self._versions_lock:
+            version = self._versions.get(user_id)
+            if version is not None:
+                self._versions.move_to_end(user_id)
+                return version
+        return self.bump_version(user_id)
+
+    def bump_version(self, user_id: int) -> int:
+        user_id = str(user_id)
+        with self._versions_lock:
+            version = self._versions[user_id] = next(self._version_counter)
+            self._versions.move_to_end(user_id)
+            if len(self._versions) > VERSIONS_SIZE:
+                self._versions.popitem(last=False)
+        return version
+
+    @mutation
     def add_user(self, user_id: int):
         user_id = str(user_id)
-        if user_id not in self.db.keys():
-            self.db[user_id] = {}
-            self.init_user_data(user_id)
+        if not self.backend.has_user(user_id):
+            # the engine creates the settings, an empty log list and the "recording" placeholder at once
+            self.backend.add_user(user_id, {"timezone": 0, "projects": list(PROJECTLIST)})
+            self._save_aggregates(user_id, aggregates.empty())
         else:
             print(f"Cannot add user with the Id {user_id}. This Id already exists in the Database")
-    
-    def user_data(self, user_id: int) -> dict:
+
+    def _ensure_user(self, user_id: int) -> str:
         user_id = str(user_id)
-        if user_id not in self.db.keys():
+        if not self.backend.has_user(user_id):
             self.add_user(user_id)
-        return self.db[user_id]
-    
+        return user_id
+
+    def user_data(self, user_id: int) -> dict:
+        ''' Return the whole document of the user {"settings": ..., "logs": ..., "recording": ...}.
+        Note that it reads every log of the user, prefer the narrower methods below
+        '''
+        user_id = self._ensure_user(user_id)
+        return {
+            "settings": self.backend.get_settings(user_id),
+            "logs": dict(self.backend.iter_logs(user_id)),
+            "recording": self.current_log(user_id)[0],
+        }
 
+    def settings(self, user_id: int) -> dict:
+        user_id = self._ensure_user(user_id)
+        return self.backend.get_settings(user_id)
+
+    @mutation
     def init_user_data(self, user_id: int) -> None:
         ''' Function to initialise the data-structure of the current TG-User
         '''
         user_id = str(user_id)
-        if not "settings" in self.db[user_id].keys():
-            self.db[user_id]["settings"] = {}
-            self.db[user_id]["settings"]["timezone"] = 0
-            self.db[user_id]["settings"]["projects"] = PROJECTLIST
-        if not "logs" in self.db[user_id].keys():
-            self.db[user_id]["logs"] = {}  # a placeholder-dict for future logs
-        
-        self.db[user_id]["recording"] = None  # a placeholder to hold the ID of the current log
+        settings = self.backend.get_settings(user_id)
+        if not settings:
+            settings["timezone"] = 0
+            settings["projects"] = list(PROJECTLIST)
+            self.backend.set_settings(user_id, settings)
+
+        self.backend.set_recording(user_id, None)  # a placeholder to hold the ID of the current log
 
+    @mutation
     def reset_user_data(self, user_id: int, only_logs: bool=False) -> None:
         ''' Function to clear the data of the current TG-User
         '''
         user_id = str(user_id)
+        if self.journal is not None:
+            if self.journal.timer(user_id) is not None:
+                metrics.ACTIVE_TIMERS.dec()
+            self.journal.append(user_id, events.RESET, now_timestamp())
         if only_logs:
-            self.db[user_id]["logs"].clear()
-            self.db[user_id]["recording"] = None
+            self.backend.clear_logs(user_id)
+            self.backend.set_recording(user_id, None)
+            self._save_aggregates(user_id, aggregates.empty())
         else:
-            self.db[user_id].clear()
-            self.init_user_data(user_id)
+            self.backend.delete_user(user_id)
+            self.add_user(user_id)
 
+    def current_log(self, user_id: int) -> Tuple[Optional[str], Optional[dict]]:
+        ''' Return the ID and the entry of the running log, (None, None) if nothing is recorded
+        '''
+        user_id = self._ensure_user(user_id)
+        journal = self.journal
+        if journal is not None:
+            timer = journal.timer(user_id)
+            if timer is not None:
+                return timer["id"], self._timer_log(timer)
+        # with a journal, a timer started before it was switched on is still in the engine until it changes
+        log_id = self.backend.get_recording(user_id)
+        if log_id is None:
+            return None, None
+        return log_id, self.backend.get_log(user_id, log_id)
 
-    def aggregate_user_logs(self, user_id: int) -> Tuple[dict, str]:
-        ''' Cerate a summary of user logs and return a dictionary + a string
+    @staticmethod
+    def _timer_log(timer: dict) -> dict:
+        ''' the running log of a journal timer, it has a "paused_at" field (see `timer_state`) '''
+        return {"name": timer["name"], "start": timer["start"], "stop": timer["start"], "pause": timer["pause"],
+                "paused_at": timer["paused_at"]}
+
+    @mutation
+    def adopt_timer(self, user_id: int) -> None:
+        ''' Move a timer started before the journal was switched on from the engine to the journal.
+        Called by the changes of the running timer, reads leave it in the engine
+        '''
+        user_id = str(user_id)
+        if self.journal is None or self.journal.timer(user_id) is not None:
+            return
+        log_id = self.backend.get_recording(user_id)
+        log = self.backend.get_log(user_id, log_id) if log_id is not None else None
+        if log is None:
+            return
+        paused = self.timer_state(log)[2]
+        # while paused, the field is the begin of a pause that follows no earlier pause
+        fields = {"pause": 0, "paused_at": log["pause"]} if paused else {"pause": log["pause"]}
+        self.journal.append(user_id, events.START, log["start"], id=log_id, name=log["name"], **fields)
+        self.backend.set_recording(user_id, None)
+        self.backend.delete_log(user_id, log_id)
+
+    @mutation
+    def start_log(self, user_id: int, project: str) -> Tuple[str, dict]:
+        ''' Create a new log entry for the project and mark it as the running one.
+        A running log is stopped first, so its time is never lost (call `stop_log` before to get it)
+        '''
+        user_id = self._ensure_user(user_id)
+        self.stop_log(user_id)
+        log_id = str(uuid4())
+        start = now_timestamp()  # integer, epoch time
+        log = {"name": project, "start": start, "stop": start, "pause": 0}
+        metrics.ACTIVE_TIMERS.inc()
+        if self.journal is not None:
+            self.journal.append(user_id, events.START, start, id=log_id, name=project)
+            return log_id, self._timer_log(self.journal.timer(user_id))
+        self.backend.put_log(user_id, log_id, log)
+        # store the key of current log for quick access
+        self.backend.set_recording(user_id, log_id)
+        return log_id, log
+
+    @mutation
+    def stop_log(self, user_id: int, at: int = None) -> Optional[dict]:
+        ''' Finish the running log and return it (None if there is no running log)
+        Args:
+            at : int - stop time for a deadline in the past (auto-stop), defaults to now
         '''
+        self.adopt_timer(user_id)
+        log_id, log = self.current_log(user_id)
+        if log is None:
+            return None
         user_id = str(user_id)
-        data = self.db[user_id]["logs"].values()
-        out = {}
+        # load the aggregates while the log is still excluded from them as the running one
+        aggr = self.aggregates(user_id)
+        if self.journal is not None:
+            # a stop in the past may not fall into the pause or before the start
+            floor = log["paused_at"] if log["paused_at"] is not None else log["start"] + log["pause"]
+            stop = now_timestamp() if at is None else max(at, floor)
+            log_id, log = self.journal.append(user_id, events.STOP, stop)
+            metrics.ACTIVE_TIMERS.dec()
+            self._finish(user_id, log_id, log, aggr)
+            return log
+        if self.timer_state(log)[2]:  # stopped while paused, the pause ends now
+            log["pause"] = now_timestamp() - log["pause"]
+        # the duration of a log stopped in the past must not become negative
+        log["stop"] = now_timestamp() if at is None else max(at, log["start"] + log["pause"])
+        # reset the current recording to be None
+        self.backend.set_recording(user_id, None)
+        metrics.ACTIVE_TIMERS.dec()
+        self._finish(user_id, log_id, log, aggr)
+        return log
 
+    def _finish(self, user_id: str, log_id: str, log: dict, aggr: dict = None) -> None:
+        ''' store a finished log and account it in the running aggregates '''
+        aggr = self.aggregates(user_id) if aggr is None else aggr
+        self.backend.put_log(user_id, log_id, log)
+        aggregates.add_log(aggr, log)
+        self._save_aggregates(user_id, aggr)
+
+    @mutation
+    def import_logs(self, user_id: int, batches: Iterable[Dict[str, dict]]) -> int:
+        ''' Store finished logs (see `importer.py`) with one write per batch. The aggregates are updated in
+        memory and saved once at the end, also when a batch fails. Returns the number of stored logs
+        '''
+        user_id = str(user_id)
+        aggr = self.aggregates(user_id)
+        n = 0
+        try:
+            for logs in batches:
+                self.backend.put_logs(user_id, logs)
+                for log in logs.values():
+                    aggregates.add_log(aggr, log)
+                n += len(logs)
+        finally:
+            self._save_aggregates(user_id, aggr)
+        return n
+
+    @mutation
+    def delete_log(self, user_id: int, log_id: str) -> None:
+        user_id = str(user_id)
+        if self.journal is not None:
+            self.adopt_timer(user_id)
+            if self.current_log(user_id)[0] == log_id:
+                self.journal.append(user_id, events.DROP, now_timestamp())
+                metrics.ACTIVE_TIMERS.dec()
+                return
+            self.journal.append(user_id, events.DELETE, now_timestamp(), id=log_id)
+        log = self.backend.get_log(user_id, log_id)
+        if log is None:
+            return
+        if self.backend.get_recording(user_id) == log_id:
+            self.backend.set_recording(user_id, None)
+            metrics.ACTIVE_TIMERS.dec()
+        else:  # only finished logs are aggregated
+            aggr = self.aggregates(user_id)
+            aggregates.remove_log(aggr, log)
+            self._save_aggregates(user_id, aggr)
+        self.backend.delete_log(user_id, log_id)
+
+    @mutation
+    def pause_log(self, user_id: int) -> Optional[dict]:
+        ''' Pause the running log. While paused, the "pause" field of a log in the engine holds the time
+        the pause began (see `timer_state`), a journal appends the event
+        '''
+        self.adopt_timer(user_id)
+        log_id, log = self.current_log(user_id)
+        if log is None:
+            return None
+        if self.timer_state(log)[2]:  # paused already
+            return log
+        if self.journal is not None:
+            self.journal.append(str(user_id), events.PAUSE, now_timestamp())
+            return self.current_log(user_id)[1]
+        # get new starting point for pause duration
+        log["pause"] = now_timestamp() - log["pause"]
+        self.backend.put_log(str(user_id), log_id, log)
+        return log
+
+    @mutation
+    def resume_log(self, user_id: int) -> Optional[dict]:
+        ''' Resume the running log, the "pause" field holds the total pause duration again
+        '''
+        self.adopt_timer(user_id)
+        log_id, log = self.current_log(user_id)
+        if log is None:
+            return None
+        if not self.timer_state(log)[2]:  # running already
+            return log
+        if self.journal is not None:
+            self.journal.append(str(user_id), events.RESUME, now_timestamp())
+            return self.current_log(user_id)[1]
+        # calculate pause duration
+        log["pause"] = now_timestamp() - log["pause"]
+        self.backend.put_log(str(user_id), log_id, log)
+        return log
+
+    @staticmethod
+    def timer_state(log: dict, now: int = None) -> Tuple[int, int, bool]:
+        ''' (duration, pause, paused) of the running log at `now`.
+        A log of the journal has "paused_at", the begin of the current pause (None while running), and the
+        total of the earlier pauses in "pause". In a log of the engine, while paused the "pause" field holds
+        the begin of the pause minus the pause before it, an epoch timestamp never smaller than the start,
+        otherwise the total pause, a duration smaller than it
+        '''
+        now = now_timestamp() if now is None else now
+        if "paused_at" in log:
+            paused_at, pause = log["paused_at"], log["pause"]
+        elif log["pause"] >= log["start"]:  # paused, as if the pause before it was 0
+            paused_at, pause = log["pause"], 0
+        else:
+            paused_at, pause = None, log["pause"]
+        if paused_at is not None:
+            return paused_at - log["start"] - pause, now - paused_at + pause, True
+        return now - log["start"] - pause, pause, False
+
+    @staticmethod
+    def timer_deadlines(log: dict, settings: dict, now: int = None) -> Dict[str, int]:
+        ''' Deadlines of the running log by the settings of the user, {"remind": ts, "autostop": ts}.
+        "remind" (minutes) and an "autostop" after hours count the time the timer ran, so they move with
+        every pause, an "autostop" at "midnight" is the local midnight after the start. A paused log
+        has no deadlines. Deadlines in the past are returned as well
+        '''
+        now = now_timestamp() if now is None else now
+        duration, _, paused = Storage.timer_state(log, now)
+        deadlines = {}
+        if paused:
+            return deadlines
+        remind = settings.get("remind") or 0
+        if remind:
+            deadlines["remind"] = now + remind * 60 - duration
+        autostop = settings.get("autostop") or 0
+        if autostop == "midnight":
+            deadlines["autostop"] = period_bounds("day", tz=settings["timezone"], now=log["start"])[1]
+        elif autostop:
+            deadlines["autostop"] = now + autostop * 3600 - duration
+        return deadlines
+
+    def running_timers(self, select: Optional[Callable[[str], bool]] = None) -> Iterator[Tuple[int, str, dict, dict]]:
+        ''' (user_id, log_id, log, settings) of every running timer of a user with reminders or an auto-stop,
+        a full scan of the users to rebuild the deadlines after a restart (of the timers in memory with a journal).
+        `select` skips the users it returns False for, e.g. those of other workers (see `shard.py`)
+        '''
+        if self.journal is not None:
+            for user_id, timer in self.journal.running():
+                if select is not None and not select(user_id):
+                    continue
+                settings = self.backend.get_settings(user_id)
+                if settings.get("remind") or settings.get("autostop"):
+                    yield int(user_id), timer["id"], self._timer_log(timer), settings
+            return
+        for user_id in self.backend.user_ids():
+            if select is not None and not select(user_id):
+                continue
+            settings = self.backend.get_settings(user_id)
+            if not (settings.get("remind") or settings.get("autostop")):
+                continue
+            log_id = self.backend.get_recording(user_id)
+            log = self.backend.get_log(user_id, log_id) if log_id is not None else None
+            if log is not None:
+                yield int(user_id), log_id, log, settings
+
+    @mutation
+    def add_project(self, user_id: int, project: str) -> None:
+        settings = self.settings(user_id)
+        if project not in settings["projects"]:
+            if self.journal is not None:
+                self.journal.append(str(user_id), events.ADD_PROJECT, now_timestamp(), name=project)
+            settings["projects"].append(project)
+            self.backend.set_settings(str(user_id), settings)
+
+    @mutation
+    def remove_project(self, user_id: int, project: str) -> None:
+        settings = self.settings(user_id)
+        if project in settings["projects"]:
+            if self.journal is not None:
+                self.journal.append(str(user_id), events.REMOVE_PROJECT, now_timestamp(), name=project)
+            settings["projects"].remove(project)
+            self.backend.set_settings(str(user_id), settings)
+
+    @mutation
+    def set_timezone(self, user_id: int, tz: Timezone) -> None:
+        settings = self.settings(user_id)
+        settings["timezone"] = tz
+        self.backend.set_settings(str(user_id), settings)
+
+    @mutation
+    def set_live(self, user_id: int, live: bool) -> None:
+        settings = self.settings(user_id)
+        settings["live"] = live
+        self.backend.set_settings(str(user_id), settings)
+
+    @mutation
+    def set_deadlines(self, user_id: int, remind: int, autostop) -> None:
+        ''' remind after `remind` minutes and stop after `autostop` hours or at "midnight", 0 switches them off '''
+        settings = self.settings(user_id)
+        settings["remind"] = remind
+        settings["autostop"] = autostop
+        self.backend.set_settings(str(user_id), settings)
+
+    def _finished_logs(self, user_id: str):
+        recording = self.backend.get_recording(user_id)
+        return (log for log_id, log in self.backend.iter_logs(user_id) if log_id != recording)
+
+    def log_columns(self, user_id: int) -> LogColumns:
+        ''' All logs of the user in the compact columnar layout (see `columnar.py`) '''
+        return self.backend.log_columns(str(user_id))
+
+    def _save_aggregates(self, user_id: str, aggr: dict) -> None:
+        for part, value in aggr.items():
+            self.backend.set_meta(user_id, "aggr:" + part, value)
+
+    def aggregates(self, user_id: int, parts: Sequence[str] = aggregates.PARTS) -> dict:
+        ''' Return the running aggregates of finished logs (see `aggregates.py`).
+        Users created before the aggregates existed get them computed from raw logs on the first access
+        '''
+        user_id = str(user_id)
+        aggr = {part: self.backend.get_meta(user_id, "aggr:" + part) for part in parts}
+        if any(value is None for value in aggr.values()):
+            aggr = self.rebuild_aggregates(user_id)
+        return {part: aggr[part] for part in parts}
+
+    @mutation
+    def rebuild_aggregates(self, user_id: int) -> dict:
+        ''' Recompute the aggregates from raw logs and store them '''
+        user_id = str(user_id)
+        aggr = aggregates.rebuild_columns(self.backend.log_columns(user_id), skip=self.backend.get_recording(user_id))
+        self._save_aggregates(user_id, aggr)
+        return aggr
+
+    @mutation
+    def verify_aggregates(self, user_id: int, repair: bool = True) -> bool:
+        ''' Check the stored aggregates against raw logs, optionally store the recomputed ones on mismatch '''
+        user_id = str(user_id)
+        valid, expected = aggregates.verify(self.aggregates(user_id), self._finished_logs(user_id))
+        if not valid and repair:
+            self._save_aggregates(user_id, expected)
+        return valid
+
+
+    def aggregate_user_logs(self, user_id: int) -> Tuple[dict, str]:
+        ''' Cerate a summary of user logs and return a dictionary + a string.
+        The totals are read from the running aggregates, so the cost does not depend on the number of logs
+        '''
         # populate the output dictionary
-        for prj_name, grouped_logs in groupby(data, key=lambda x: x["name"]):
-            item = {}
-            grouped_logs = list(grouped_logs)
-            out[prj_name] = {
-                "duration": sum((log["stop"] - log["start"] - log["pause"]) for log in grouped_logs),
-                "n_logs": len(grouped_logs)
-                }
+        out = aggregates.totals(self.aggregates(user_id))
+        return (out, self._summary_msg("Summary (Project Total Duration)", out))
+
+    @staticmethod
+    def _summary_msg(title: str, out: dict) -> str:
         # generate a nice string
-        msg = f"Summary (Project Total Duration):\n" + "-"*60 +"\n"
+        msg = f"{title}:\n" + "-"*60 +"\n"
         for prj_name in sorted(out.keys()):
             msg += f"📝 {prj_name} ({out[prj_name]['n_logs']:3d} logs): {timedelta_to_str(out[prj_name]['duration'])}\n"
+        return msg
 
-        return (out, msg)
+    def stats(self, user_id: int, now: int = None) -> Tuple[dict, str]:
+        ''' Statistics of the finished logs of the user (see `analytics.py`), needs numpy '''
+        import analytics  # numpy is only imported when somebody looks at the stats
+        user_id = str(user_id)
+        arrays = analytics.LogArrays.from_columns(
+            self.backend.log_columns(user_id), skip=self.backend.get_recording(user_id))
+        out = analytics.user_stats(arrays, self.settings(user_id)["timezone"], now)
+        return (out, analytics.render_stats(out))
 
+    def global_stats(self, now: int = None) -> Tuple[dict, str]:
+        ''' Statistics over the finished logs of every user (in UTC), needs numpy '''
+        import analytics
+        user_ids = list(self.backend.user_ids())
+        arrays = analytics.LogArrays.concatenate(
+            analytics.LogArrays.from_columns(self.backend.log_columns(uid), skip=self.backend.get_recording(uid))
+            for uid in user_ids)
+        out = analytics.global_stats(arrays, len(user_ids), now)
+        return (out, analytics.render_stats(out, title="Global stats"))
 
-    def list_user_logs(self, user_id: int) -> Tuple[list, str]:
-        ''' Helper function to collect user logs into a 2-d table (list of rows) and a string-representation
+    def query_logs(self, user_id: int, since: int, until: int, project: Optional[str] = None,
+                   include_running: bool = False) -> Iterator[Tuple[str, dict]]:
+        ''' Iterate over (log_id, log) pairs of the user with since <= start < until, ordered by start time.
+        The engine looks the range up in a sorted start-time index, the rest of the history is not scanned
+        '''
+        user_id = str(user_id)
+        recording = None if include_running else self.backend.get_recording(user_id)
+        for log_id, log in self.backend.iter_logs_range(user_id, since, until, project):
+            if log_id != recording:
+                yield log_id, log
+
+    def period_summary(self, user_id: int, since: int, until: int, project: Optional[str] = None) -> Tuple[dict, str]:
+        ''' Summary of finished logs started within [since, until) in the format of `aggregate_user_logs`
+        '''
+        # the engine may answer whole months from precomputed totals, the running log is not counted
+        key = str(user_id)
+        totals = self.backend.period_totals(key, since, until, project, skip=self.backend.get_recording(key))
+        out = {name: {"duration": duration, "pause": pause, "n_logs": n}
+               for name, (duration, pause, n) in totals.items()}
+        tz = self.settings(user_id)["timezone"]
+        # `until` is exclusive, show the last second of the period
+        title = f"Summary {timestamp_to_str(since, tz=tz, fmt='%d.%m.%Y')} - {timestamp_to_str(until - 1, tz=tz, fmt='%d.%m.%Y')}"
+        return (out, self._summary_msg(title, out))
+
+
+    def _iter_logs_from(self, user_id: str, key: Tuple[int, str], reverse: bool = False, chunk: int = 32,
+                        bound: Optional[int] = None, project: Optional[str] = None) -> Iterator[Tuple[str, dict]]:
+        ''' Lazily iterate over logs strictly after (or before, if reversed) the (start, log_id) key,
+        up to the `bound` start time (exclusive "until" going forward, inclusive "since" going back).
+        The engine is asked for small chunks of its start-time index, so the cost depends on how many
+        logs are consumed and not on the size of the history
+        '''
+        while True:
+            start, log_id = key
+            if reverse:
+                items = list(self.backend.iter_logs_range(
+                    user_id, bound or 0, start + 1, project, reverse=True, limit=chunk))
+                beyond = [item for item in items if (item[1]["start"], item[0]) < key]
+            else:
+                items = list(self.backend.iter_logs_range(
+                    user_id, start, MAX_TIMESTAMP if bound is None else bound, project, limit=chunk))
+                beyond = [item for item in items if (item[1]["start"], item[0]) > key]
+            yield from beyond
+            if len(items) < chunk:
+                return
+            if beyond:
+                key = (beyond[-1][1]["start"], beyond[-1][0])
+            else:  # a run of logs with the same start time is longer than the chunk
+                chunk *= 2
+
+    def iter_export_rows(self, user_id: int, since: int = 0, until: int = MAX_TIMESTAMP,
+                         project: Optional[str] = None, chunk: int = 1000) -> Iterator[list]:
+        ''' Generate the rows of a CSV export (header first) of finished logs started within [since, until).
+        Logs are read from the engine `chunk` at a time, so memory does not grow with the number of rows
         '''
         user_id = str(user_id)
-        rows = []
-        header = ["id", "START", "STOP", "PROJECT", "DURATION", "PAUSE"]
-        rows.append(header)
-        rows_to_print = []
-        header_to_print = ["START", "STOP", "PROJECT", "DURATION"]
-        rows_to_print.append(header_to_print)
-        rows_to_print.append("-" * 60)  # horizontal line
-        
-        # generate data
-        for i, log in enumerate(self.db[user_id]["logs"].values()):
-            row = [str(i), timestamp_to_str(log["start"]), timestamp_to_str(log["stop"]), log["name"], timedelta_to_str(log["stop"] - log["start"] - log["pause"]), timedelta_to_str(log["pause"])]
-            row_to_print = [timestamp_to_str(log["start"]), timestamp_to_str(log["stop"]), log["name"], timedelta_to_str(log["stop"] - log["start"] - log["pause"])]
-            rows.append(row)
-            rows_to_print.append(row_to_print)
-
-        # create a message
-        msg = ""
-        for row in rows_to_print:
-            if isinstance(row, str):
-                msg += row+'\n'
+        tz = self.settings(user_id)["timezone"]
+        recording = self.backend.get_recording(user_id)
+        yield ["id", "START", "STOP", "PROJECT", "DURATION", "PAUSE"]
+        # the key just before the first log of the range
+        logs = self._iter_logs_from(user_id, (since, ""), chunk=chunk, bound=until, project=project)
+        logs = (log for log_id, log in logs if log_id != recording)
+        fmt = timefmt.formatter(tz)
+        i = 0
+        # every chunk is formatted column by column
+        while True:
+            batch = list(itertools.islice(logs, chunk))
+            if not batch:
+                return
+            starts = fmt.column([log["start"] for log in batch])
+            stops = fmt.column([log["stop"] for log in batch])
+            durations = timefmt.durations([log["stop"] - log["start"] - log["pause"] for log in batch])
+            pauses = timefmt.durations([log["pause"] for log in batch])
+            for row in zip(range(i, i + len(batch)), starts, stops, (log["name"] for log in batch), durations, pauses):
+                yield [str(row[0]), *row[1:]]
+            i += len(batch)
+
+    @staticmethod
+    def encode_cursor(direction: str, start: int, log_id: str) -> str:
+        ''' an opaque cursor short enough for the callback data of a button (64 bytes) '''
+        return f"{direction}{start:x}.{log_id}"
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, Tuple[int, str]]:
+        start, _, log_id = cursor[1:].partition(".")
+        return cursor[0], (int(start, 16), log_id)
+
+    def logs_page(self, user_id: int, cursor: Optional[str] = None, page_size: int = 20,
+                  max_length: int = MESSAGE_LIMIT - 200) -> Tuple[str, Optional[str], Optional[str]]:
+        ''' Render a single page of the log list, the newest page if no cursor is given.
+        Returns the message, the cursor of the older page and the cursor of the newer one (None if there is
+        no such page). A page holds at most `page_size` logs and `max_length` characters
+        '''
+        user_id = str(user_id)
+        fmt = timefmt.formatter(self.settings(user_id)["timezone"])
+        recording = self.backend.get_recording(user_id)
+        direction, key = ("b", (MAX_TIMESTAMP, "")) if cursor is None else self.decode_cursor(cursor)
+
+        # walk away from the cursor: to older logs for "b"(efore), to newer ones for "a"(fter)
+        page, length = [], 0
+        more = False
+        for log_id, log in self._iter_logs_from(user_id, key, reverse=(direction == "b")):
+            if log_id == recording:
                 continue
+            line = " - ".join(self._row_to_print(log, fmt)) + "\n"
+            if len(page) == page_size or length + len(line) > max_length:
+                more = True
+                break
+            page.append((log_id, log, line))
+            length += len(line)
+        if direction == "b":
+            page.reverse()
 
-            line = " - ".join(row)
-            line += '\n'
-            msg += line
+        if not page:
+            return "No logs yet", None, None
+        first, last = page[0], page[-1]
+        older = self.encode_cursor("b", first[1]["start"], first[0])
+        newer = self.encode_cursor("a", last[1]["start"], last[0])
+        # the end of the history in the walking direction is known, the other side exists unless it is the first page
+        has_older = more if direction == "b" else True
+        has_newer = more if direction == "a" else cursor is not None
+        msg = " - ".join(["START", "STOP", "PROJECT", "DURATION"]) + "\n" + "-" * 60 + "\n"
+        msg += "".join(line for _, _, line in page)
+        return msg, (older if has_older else None), (newer if has_newer else None)
+
+    @staticmethod
+    def _row_to_print(log: dict, fmt: timefmt.TimestampFormatter) -> List[str]:
+        return [fmt.format(log["start"]), fmt.format(log["stop"]), log["name"],
+                timefmt.duration(log["stop"] - log["start"] - log["pause"])]
+
+    def list_user_logs(self, user_id: int) -> Tuple[list, str]:
+        ''' Helper function to collect user logs into a 2-d table (list of rows) and a string-representation
+        '''
+        user_id = str(user_id)
+        # format every column in one pass over the columnar layout, the printed rows reuse the cells
+        columns = self.backend.log_columns(user_id)
+        fmt = timefmt.formatter(self.backend.get_settings(user_id)["timezone"])
+        starts, stops = fmt.column(columns.starts), fmt.column(columns.stops)
+        projects = [columns.projects[pid] for pid in columns.project_ids]
+        durations = timefmt.durations([stop - start - pause for start, stop, pause
+                                       in zip(columns.starts, columns.stops, columns.pauses)])
+        pauses = timefmt.durations(columns.pauses)
 
+        rows = [["id", "START", "STOP", "PROJECT", "DURATION", "PAUSE"]]
+        rows.extend([str(i), *row] for i, row in enumerate(zip(starts, stops, projects, durations, pauses)))
+        lines = [" - ".join(["START", "STOP", "PROJECT", "DURATION"]), "-" * 60]  # header and horizontal line
+        lines.extend(" - ".join(row) for row in zip(starts, stops, projects, durations))
+        msg = "\n".join(lines) + "\n"
         return rows, msg
@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEADLINES = metrics.Gauge("bot_deadlines_armed", "Deadlines (reminders, auto-stops) waiting in the scheduler")
+DEADLINES_FIRED = metrics.Counter("bot_deadlines_fired_total", "Deadlines that were due")
+
+
+class DeadlineScheduler():
+    ''' One min-heap of deadlines (epoch seconds) for any number of keys, e.g. (user_id, "remind").
+
+    Arming or disarming a key is O(log n) and O(1): a key has at most one valid deadline, older heap
+    entries of it are not searched for but skipped when they reach the top (lazy deletion), and the heap
+    is rebuilt from the valid entries when the stale ones outnumber them. The scheduler sleeps until the
+    earliest deadline, or until an earlier one is armed, so an idle bot does not poll anything.
+    Due keys are passed to `fire(key, when)` in tasks of their own, at most `max_firing` at a time, so a
+    slow callback (e.g. a message waiting for the rate limiter) never holds up the deadlines after it.
+    Args:
+        fire : Callable[[Hashable, float], Awaitable] - called with a due key and its deadline
+        max_sleep : float - seconds after which the clock is read again (it may have jumped)
+        max_firing : int - callbacks running at once, further due keys wait for a free slot
+    '''
+    def __init__(self, fire: Callable[[Hashable, float], Awaitable], max_sleep: float = 60, max_firing: int = 64):
+        self.fire = fire
+        self.max_sleep = max_sleep
+        self.max_firing = max_firing
+        self.firing: Set[asyncio.Task] = set()
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        self.armed: Dict[Hashable, Tuple[float, int]] = {}  # key -> (deadline, seq) of its valid entry
+        self.counter = itertools.count()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        DEADLINES.set_function(self.__len__)
+
+    def __len__(self) -> int:
+        return len(self.armed)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.armed
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        item = self.armed.get(key)
+        return None if item is None else item[0]
+
+    def arm(self, key: Hashable, when: float) -> None:
+        ''' set the deadline of the key, replacing its previous one '''
+        seq = next(self.counter)
+        self.armed[key] = (when, seq)
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (when, seq, key))
+        if len(self.heap) > 2 * len(self.armed) + 1024:
+            self._compact()
+        if self.wakeup is not None and (earliest is None or when < earliest):
+            self.wakeup.set()
+
+    def disarm(self, key: Hashable) -> None:
+        self.armed.pop(key, None)
+
+    def _compact(self) -> None:
+        self.heap = [(when, seq, key) for key, (when, seq) in self.armed.items()]
+        heapq.heapify(self.heap)
+
+    def pop_due(self, now: float) -> List[Tuple[Hashable, float]]:
+        ''' remove and return the keys whose deadline is not after `now` '''
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, seq, key = heapq.heappop(self.heap)
+            if self.armed.get(key, (None, None))[1] == seq:  # not replaced or disarmed since
+                del self.armed[key]
+                due.append((key, when))
+        return due
+
+    # ---------------------------------------------------------------- scheduling
+    def start(self) -> None:
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.slots = asyncio.Semaphore(self.max_firing)
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            self.wakeup = None
+        # callbacks still running are cancelled like the loop
+        for task in list(self.firing):
+            task.cancel()
+        await asyncio.gather(*self.firing, return_exceptions=True)
+
+    async def run(self) -> None:
+        while True:
+            # stale entries at the top would cut the sleep short for nothing
+            while self.heap and self.armed.get(self.heap[0][2], (None, None))[1] != self.heap[0][1]:
+                heapq.heappop(self.heap)
+            timeout = self.max_sleep if not self.heap else min(self.max_sleep, self.heap[0][0] - time.time())
+            self.wakeup.clear()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            due = self.pop_due(time.time())
+            if due:
+                DEADLINES_FIRED.inc(amount=len(due))
+                for key, when in due:
+                    task = asyncio.create_task(self._fire(key, when))
+                    self.firing.add(task)
+                    task.add_done_callback(self.firing.discard)
+
+    async def _fire(self, key: Hashable, when: float) -> None:
+        async with self.slots:
+            try:
+                await self.fire(key, when)
+            except Exception:
+                logger.exception("Deadline of %s failed", key)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+
+class FakeReplitDB(dict):
+    ''' In-memory stand-in for `replit.db` with the raw methods `ReplitBackend` uses '''
+    def get_raw(self, key: str) -> str:
+        return self[key]
+
+    def set_raw(self, key: str, value: str) -> None:
+        self[key] = value
+
+    def set_bulk_raw(self, values: Dict[str, str]) -> None:
+        self.update(values)
+
+    def prefix(self, prefix: str) -> Tuple[str, ...]:
+        return tuple(key for key in self if key.startswith(prefix))
+
+
+class FakeRequest(BaseRequest):
+    ''' Bot API transport that never leaves the process.
+    Every call is answered with a plausible result and recorded in `calls` as (method, parameters),
+    so handlers can be driven through `Application.process_update` without a network or a real token.
+    Args:
+        latency : float - seconds every call takes, to imitate the round-trip to telegram
+        keep : int - number of recorded calls kept (the oldest are dropped)
+    '''
+    def __init__(self, latency: float = 0.0, keep: int = 1000):
+        self.latency = latency
+        self.keep = keep
+        self.calls: List[Tuple[str, dict]] = []
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot", "can_join_groups": True,
+                    "can_read_all_group_messages": False, "supports_inline_queries": True}
+        if method.startswith(("answer", "delete", "set")):
+            return True
+        if method == "getUpdates":
+            return []
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return {"message_id": self._message_id, "date": int(time.time()), "text": str(params.get("text", "")),
+                "chat": {"id": chat_id, "type": "private"}}
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        api_method = url.rsplit("/", 1)[-1]
+        params = dict(request_data.parameters) if request_data is not None else {}
+        self.calls.append((api_method, params))
+        if len(self.calls) > self.keep:
+            del self.calls[:len(self.calls) - self.keep]
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+
+# ---------------------------------------------------------------- raw updates
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str, update_id: int = 0, message_id: int = 1) -> dict:
+    ''' raw telegram update of a private text message, commands get their entity '''
+    message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": _user(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(user_id: int, data: str, update_id: int = 0, message_id: int = 1) -> dict:
+    ''' raw telegram update of a pressed inline button '''
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(user_id), "data": data, "from": _user(user_id),
+        "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "text": "..."}}}
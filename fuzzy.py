@@ -0,0 +1,83 @@
+import functools
+import unicodedata
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+# score tiers of a match, the fraction within a tier prefers the closer names
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING = 4, 3, 2, 1
+MIN_SIMILARITY = 0.3  # share of common bigrams below which a name does not match at all
+
+
+def normalize(text: str) -> str:
+    ''' lower case without accents and repeated whitespace, "  Müsli  Bar" -> "musli bar" '''
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return " ".join("".join(c for c in text if not unicodedata.combining(c)).split())
+
+
+def bigrams(text: str) -> Set[str]:
+    ''' the pairs of neighbouring letters, short project names need the small grams to survive a typo '''
+    padded = f" {text} "
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+class ProjectIndex():
+    ''' Fuzzy lookup of a project by a (partial, misspelled) name, built once per project list.
+
+    Exact names, prefixes, prefixes of a word and substrings rank first (in this order), any other name
+    is ranked by the share of common bigrams, found through an inverted index, so typos still match.
+    Args:
+        projects : Sequence[str] - the projects of a user
+    '''
+    def __init__(self, projects: Sequence[str]):
+        self.projects = list(projects)
+        self.names = [normalize(prj) for prj in self.projects]
+        self.exact: Dict[str, int] = {name: i for i, name in reversed(list(enumerate(self.names)))}
+        self.grams = [bigrams(name) for name in self.names]
+        self.inverted: Dict[str, List[int]] = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.inverted.setdefault(gram, []).append(i)
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[float, str]]:
+        ''' (score, project) of the matching projects, best first, every project for an empty query '''
+        query = normalize(query)
+        if not query:
+            return [(0.0, prj) for prj in self.projects[:limit]]
+        if query in self.exact:
+            return [(float(EXACT), self.projects[self.exact[query]])]
+
+        scores: Dict[int, float] = {}
+        for i, name in enumerate(self.names):
+            closeness = len(query) / len(name) if name else 0
+            if name.startswith(query):
+                scores[i] = PREFIX + closeness
+            elif any(word.startswith(query) for word in name.split()):
+                scores[i] = WORD_PREFIX + closeness
+            elif query in name:
+                scores[i] = SUBSTRING + closeness
+        query_grams = bigrams(query)
+        shared: Dict[int, int] = {}
+        for gram in query_grams:
+            for i in self.inverted.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        for i, n in shared.items():
+            if i not in scores:
+                similarity = n / (len(query_grams) + len(self.grams[i]) - n)
+                if similarity >= MIN_SIMILARITY:
+                    scores[i] = similarity
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(score, self.projects[i]) for i, score in ranked[:limit]]
+
+    def resolve(self, query: str) -> Tuple[Optional[str], List[str]]:
+        ''' (project, candidates): the project if a single one matches clearly better than the others
+        (a higher tier), otherwise None and the candidates to choose from
+        '''
+        matches = self.search(query)
+        if len(matches) == 1 or (len(matches) > 1 and int(matches[0][0]) > int(matches[1][0])):
+            return matches[0][1], [matches[0][1]]
+        return None, [prj for _, prj in matches]
+
+
+@functools.lru_cache(maxsize=4096)
+def project_index(projects: Tuple[str, ...]) -> ProjectIndex:
+    ''' the index of a project list, kept for the next lookup, so a changed list gets a new index '''
+    return ProjectIndex(projects)
@@ -1,6 +1,15 @@
-from datetime import datetime, timedelta
-from typing import Tuple, List
+from datetime import datetime, timedelta, timezone, tzinfo
+from tempfile import SpooledTemporaryFile
+from typing import IO, Dict, Iterable, Tuple, List, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 import csv
+import functools
+import gzip
+import io
+import re
+
+# timezone of a user: hours east of UTC (whole or fractional, the only option of older settings) or an IANA name
+Timezone = Union[int, float, str]
 
 
 def now_timestamp() -> int:
@@ -8,19 +17,117 @@ def now_timestamp() -> int:
     return int(round(datetime.now().timestamp()))
 
 
-def timestamp_to_str(ts: int, tz: int = 0, fmt: str = "%d.%m.%Y %H:%M") -> str:
+@functools.lru_cache(maxsize=1024)
+def zone(tz: Timezone = 0) -> tzinfo:
+    ''' the tzinfo of a timezone setting, loaded once per process (DST and half-hour offsets included) '''
+    if isinstance(tz, str):
+        return ZoneInfo(tz)
+    return timezone(timedelta(hours=tz))
+
+
+def utc_offset(ts: int, tz: Timezone = 0) -> int:
+    ''' seconds to add to the timestamp to get the local time of the timezone at that moment '''
+    if not isinstance(tz, str):
+        return int(tz * 3600)
+    return int(datetime.fromtimestamp(ts, zone(tz)).utcoffset().total_seconds())
+
+
+@functools.lru_cache(maxsize=1)
+def _zone_names() -> Dict[str, str]:
+    return {name.casefold(): name for name in available_timezones()}
+
+
+def parse_timezone(text: str) -> Timezone:
+    ''' parse a timezone typed by a user: hours east of UTC ("3", "-5", "+5:30", "5.75") or an IANA name
+    in any case ("Europe/Berlin", "asia/kolkata")
+    Raises:
+        ValueError if the text is neither
+    '''
+    text = text.strip()
+    match = re.fullmatch(r"([+-]?)(\d{1,2})(?:[:.](\d{1,2}))?", text)
+    if match:
+        sign, hours, fraction = match.groups()
+        if fraction is None:
+            offset = int(hours)
+        elif ":" in text:
+            offset = int(hours) + int(fraction) / 60
+        else:
+            offset = float(f"{hours}.{fraction}")
+        offset = -offset if sign == "-" else offset
+        if not -12 <= offset <= 14:
+            raise ValueError(f"No timezone has the offset {text!r}")
+        return offset
+    name = _zone_names().get(text.casefold())
+    if name is None:
+        raise ValueError(f"Unknown timezone {text!r}")
+    try:
+        zone(name)
+    except (ZoneInfoNotFoundError, ValueError):  # listed, but the tz database has no such file
+        raise ValueError(f"Unknown timezone {text!r}")
+    return name
+
+
+def timezone_name(tz: Timezone) -> str:
+    ''' "+3 GMT", "+5:30 GMT" or the IANA name '''
+    if isinstance(tz, str):
+        return tz
+    minutes = round(abs(tz) * 60)
+    hours = f"{'-' if tz < 0 else '+'}{minutes // 60}" + (f":{minutes % 60:02d}" if minutes % 60 else "")
+    return hours + " GMT"
+
+
+def timestamp_to_str(ts: int, tz: Timezone = 0, fmt: str = "%d.%m.%Y %H:%M") -> str:
     ''' convert a epoch timestamp to a human-readable string representation
     Args:
         ts : int - timestamp in seconds
-        tz : int - timezone in hours (0 to 23)
+        tz : Timezone - timezone of the user (see `zone`)
         fmt : str - format of the return string
     '''
-    return datetime.fromtimestamp(ts + tz*3600).strftime(fmt)
+    return datetime.fromtimestamp(ts, zone(tz)).strftime(fmt)
 
 def timedelta_to_str(sec: int) -> str:
     return str(timedelta(seconds = sec))
 
 
+def period_bounds(period: str, tz: Timezone = 0, now: int = None) -> Tuple[int, int]:
+    ''' return the (since, until) timestamps of the current day, week or month of the user
+    Args:
+        period : str - "day", "week" or "month"
+        tz : Timezone - timezone of the user
+        now : int - timestamp the period is taken around, defaults to now
+    '''
+    now = now_timestamp() if now is None else now
+    # work in local wall time of the user, a day around a DST change has 23 or 25 hours
+    local = datetime.fromtimestamp(now, zone(tz))
+    since = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "day":
+        until = since + timedelta(days=1)
+    elif period == "week":
+        since -= timedelta(days=since.weekday())
+        until = since + timedelta(days=7)
+    elif period == "month":
+        since = since.replace(day=1)
+        until = (since + timedelta(days=32)).replace(day=1)
+    else:
+        raise ValueError(f"Unknown period {period!r}")
+    return int(since.timestamp()), int(until.timestamp())
+
+
+def parse_date_range(text: str, tz: Timezone = 0, fmt: str = "%d.%m.%Y") -> Tuple[int, int]:
+    ''' parse "dd.mm.yyyy - dd.mm.yyyy" (both days included) into (since, until) timestamps
+    Raises:
+        ValueError if the text does not match the format or the range is empty
+    '''
+    first, sep, last = text.partition("-")
+    if not sep:
+        first = last = text
+    since = datetime.strptime(first.strip(), fmt).replace(tzinfo=zone(tz))
+    until = datetime.strptime(last.strip(), fmt).replace(tzinfo=zone(tz)) + timedelta(days=1)
+    if until <= since:
+        raise ValueError(f"Empty date range {text!r}")
+    return int(since.timestamp()), int(until.timestamp())
+
+
 def save_list_of_rows_to_csv(list_of_rows: List[list], filename: str = "dummy.csv") -> str:
     ''' function saves a list of lists into CSV file'''
     with open(filename, "w") as f:
@@ -28,3 +135,35 @@ def save_list_of_rows_to_csv(list_of_rows: List[list], filename: str = "dummy.cs
         writer.writerows(list_of_rows)
     return filename
 
+
+def stream_rows_to_csv(rows: Iterable[list], compress: bool = False, chunk_size: int = 1000,
+                       max_memory: int = 1024 * 1024) -> IO[bytes]:
+    ''' function writes rows (e.g. a generator) into an in-memory CSV file, that is moved to disk when it
+    grows over `max_memory` bytes. Rows are encoded `chunk_size` at a time, so only one chunk of rows is held
+    in memory. Every call gets its own buffer, so concurrent exports do not interfere.
+    Args:
+        rows : iterable of lists - rows of the table
+        compress : bool - gzip the CSV
+    Returns:
+        binary file object positioned at the beginning
+    '''
+    out = SpooledTemporaryFile(max_size=max_memory)
+    sink = gzip.GzipFile(fileobj=out, mode="wb") if compress else out
+    text = io.StringIO()
+    writer = csv.writer(text)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            sink.write(text.getvalue().encode())
+            text.seek(0)
+            text.truncate()
+    sink.write(text.getvalue().encode())
+    if compress:
+        sink.close()  # writes the gzip trailer, `out` stays open
+    out.seek(0)
+    return out
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    ''' the worker process serving a user in a sharded deployment (see `shard.py`), stable across processes '''
+    return hash(int(user_id)) % shards
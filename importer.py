@@ -0,0 +1,323 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import uuid
+import zlib
+from collections import Counter
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from fuzzy import normalize
+from helpers import now_timestamp
+import metrics
+import timefmt
+
+IMPORT_ROWS = metrics.Counter("bot_import_rows_total", "Rows of imported files", ["result"])
+
+# column names (after `fuzzy.normalize`) of this bot and of other trackers -> field of a row
+COLUMNS = {
+    "project": "project", "name": "project", "activity": "project", "task": "project",
+    "start": "start", "begin": "start", "started": "start", "from": "start", "start datetime": "start",
+    "start date": "start_date", "start time": "start_time",
+    "stop": "stop", "end": "stop", "stopped": "stop", "to": "stop", "end datetime": "stop",
+    "end date": "stop_date", "end time": "stop_time", "stop date": "stop_date", "stop time": "stop_time",
+    "pause": "pause", "break": "pause", "paused": "pause",
+    "duration": "duration",
+}
+CHUNK = 1 << 16  # characters read from a file at once
+MINUTE = 60  # exports show minutes, logs whose start and stop fall into the same minutes are the same
+UNPACKED_MAX_BYTES = 100 * 1024 * 1024  # a gzipped file is unpacked up to this size, a larger one is refused
+
+
+class _Capped(io.RawIOBase):
+    ''' a binary file that raises ValueError once more than `limit` bytes were read from it '''
+    def __init__(self, stream: IO[bytes], limit: int):
+        self.stream = stream
+        self.limit = limit
+        self.count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = self.stream.readinto(buffer)
+        self.count += n
+        if self.count > self.limit:
+            raise ValueError(f"the unpacked file is larger than {self.limit >> 20} MB")
+        return n
+
+
+def _open_text(stream: IO[bytes], max_bytes: int = UNPACKED_MAX_BYTES) -> IO[str]:
+    ''' the text of a (seekable) binary file, a gzipped one is unpacked on the fly up to `max_bytes` '''
+    gzipped = stream.read(2) == b"\x1f\x8b"
+    stream.seek(0)
+    if gzipped:
+        stream = io.BufferedReader(_Capped(gzip.GzipFile(fileobj=stream, mode="rb"), max_bytes))
+    return io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+
+def iter_json(text: IO[str], buffer: str = "") -> Iterator[Any]:
+    ''' The values of a JSON array, of JSON lines or of concatenated documents, decoded one at a time.
+    A value is decoded once the buffer holds all of it, the buffer grows by doubling reads until a value
+    is decoded, so a large single document is decoded a logarithmic number of times, not once per chunk
+    '''
+    decoder = json.JSONDecoder()
+    pos, eof, size = 0, False, CHUNK
+    in_array = None  # a top-level array is unpacked
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof, size
+        chunk = text.read(size)
+        buffer, pos = buffer[pos:] + chunk, 0
+        eof = not chunk
+        return not eof
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            if eof or not fill():
+                return
+            continue
+        if in_array is None:
+            in_array = buffer[pos] == "["
+            if in_array:
+                pos += 1
+                continue
+        if in_array and buffer[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            end = None
+        if end is None or (end == len(buffer) and not eof):
+            # cut by the end of the buffer (a number may look complete), read twice as much next time
+            if eof:
+                raise ValueError("invalid JSON")
+            size *= 2
+            fill()
+            continue
+        pos, size = end, CHUNK
+        yield value
+
+
+def _json_rows(values: Iterable[Any]) -> Iterator[Tuple[int, dict]]:
+    ''' rows of JSON values: objects, lists of them or documents of this bot {"logs": {log_id: log}} '''
+    i = 0
+    for value in values:
+        if isinstance(value, dict) and isinstance(value.get("logs"), (dict, list)):
+            value = value["logs"]
+        if isinstance(value, list):
+            items = value
+        elif isinstance(value, dict) and value and all(isinstance(v, dict) for v in value.values()):
+            items = list(value.values())  # log_id -> log
+        else:
+            items = [value]
+        for item in items:
+            i += 1
+            if not isinstance(item, dict):
+                yield i, {}
+                continue
+            row = {}
+            for key, v in item.items():
+                row.setdefault(COLUMNS.get(normalize(str(key))), v)
+            row.pop(None, None)
+            yield i, row
+
+
+def _csv_rows(lines: Iterable[str]) -> Iterator[Tuple[int, dict]]:
+    ''' rows of a CSV table with a header, keyed by the fields of `COLUMNS` '''
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    fields: List[Optional[str]] = []
+    for name in header:  # the first of several columns of a field counts, e.g. "Project" before "Task"
+        field = COLUMNS.get(normalize(name))
+        fields.append(field if field not in fields else None)
+    if "project" not in fields or not {"start", "start_date", "start_time"} & set(fields):
+        raise ValueError("the first line must name the columns, e.g. START, STOP, PROJECT, PAUSE")
+    try:
+        for row in reader:
+            if row:
+                yield reader.line_num, {field: value for field, value in zip(fields, row) if field is not None}
+    except csv.Error as e:  # e.g. a field over the size limit of the csv module, or an unclosed quote
+        raise ValueError(f"broken CSV in line {reader.line_num}: {e}") from e
+
+
+def read_rows(stream: IO[bytes]) -> Iterator[Tuple[int, dict]]:
+    ''' (line or item number, fields) of the rows of a CSV or JSON file, gzipped or not, read as a stream.
+    The format is told by the first character: "[" or "{" start JSON, anything else is a CSV table.
+    A file that cannot be read raises ValueError with the reason, also when it is found in the middle
+    '''
+    try:
+        text = _open_text(stream)
+        head = text.read(CHUNK)
+        if head.lstrip()[:1] in ("[", "{"):
+            yield from _json_rows(iter_json(text, head))
+        else:
+            # complete the last line of the first chunk, the rest of the file follows line by line
+            yield from _csv_rows(itertools.chain(io.StringIO(head + text.readline()), text))
+    except UnicodeDecodeError as e:  # a ValueError, but its text is meant for programmers
+        raise ValueError("the file is not UTF-8 text") from e
+    except gzip.BadGzipFile as e:
+        raise ValueError("the file is not a valid gzip file") from e
+    except (EOFError, zlib.error) as e:
+        raise ValueError("the gzipped file is cut off or damaged") from e
+
+
+class ImportReport():
+    ''' counts of an import, rendered into the progress message '''
+    def __init__(self, max_errors: int = 5):
+        self.rows = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid: Counter = Counter()  # reason -> rows
+        self.errors: List[str] = []  # the first rejected rows
+        self.max_errors = max_errors
+        self.new_projects: List[str] = []
+
+    def reject(self, line: int, reason: str) -> None:
+        self.invalid[reason] += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(f"{line}: {reason}")
+
+    def text(self, done: bool = True) -> str:
+        msg = "Import finished" if done else "Importing..."
+        msg += f"\n{self.rows} rows read, {self.imported} logs imported, {self.duplicates} duplicates skipped"
+        if self.invalid:
+            msg += f", {sum(self.invalid.values())} invalid rows"
+        if self.new_projects:
+            msg += "\nNew projects: " + ", ".join(self.new_projects)
+        if done and self.errors:
+            msg += "\nFirst rejected rows:\n" + "\n".join(self.errors)
+        return msg
+
+
+class LogImporter():
+    ''' Imports the rows of a CSV or JSON file (see `read_rows`) into the finished logs of a user.
+
+    Every row is validated and turned into a log: times without an offset are in the timezone of the user,
+    a missing stop is the start plus the duration and the pause. Projects are matched against the projects
+    of the user ignoring case and accents, unknown ones are added (up to `max_new_projects`). A row whose
+    start and stop fall into the same minutes as those of a stored log (or of an earlier row) is skipped,
+    so importing an export of the bot twice adds nothing. The logs are written `batch_size` at a time by
+    `Storage.import_logs`, `progress` is called with the report after every batch.
+    Args:
+        storage : db.Storage
+        user_id : int
+        batch_size : int - logs per write to the storage
+        max_new_projects : int - projects that may be created, rows of further unknown projects are rejected
+    '''
+    def __init__(self, storage, user_id: int, batch_size: int = 5000, max_new_projects: int = 100):
+        self.storage = storage
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.max_new_projects = max_new_projects
+        settings = storage.settings(user_id)
+        self.parser = timefmt.parser(settings["timezone"])
+        self.projects: Dict[str, str] = {normalize(name): name for name in settings["projects"]}
+        self.resolved: Dict[str, Optional[str]] = {}  # name in the file -> project, None if rejected
+        self.now = now_timestamp()
+
+    def _seen(self) -> Set[Tuple[int, int]]:
+        columns = self.storage.log_columns(self.user_id)
+        return {(start // MINUTE, stop // MINUTE) for start, stop in zip(columns.starts, columns.stops)}
+
+    def _project(self, name: Any, report: ImportReport) -> str:
+        name = str(name or "").strip()
+        if name not in self.resolved:
+            key = normalize(name)
+            project = self.projects.get(key)
+            if project is None and key and len(report.new_projects) < self.max_new_projects:
+                project = self.projects[key] = name
+                self.storage.add_project(self.user_id, name)
+                report.new_projects.append(name)
+            self.resolved[name] = project
+        project = self.resolved[name]
+        if project is None:
+            raise ValueError("no project" if not name else "too many new projects")
+        return project
+
+    def _time(self, row: dict, field: str) -> Optional[int]:
+        value = row.get(field)
+        if value in (None, ""):
+            date, time = row.get(field + "_date"), row.get(field + "_time")
+            if not date and not time:
+                return None
+            value = f"{date} {time}" if date and time else date or time
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value // 1000 if value > 10 ** 11 else value)
+        return self.parser.parse(str(value))
+
+    @staticmethod
+    def _seconds(value: Any) -> int:
+        if value in (None, ""):
+            return 0
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+        return timefmt.parse_duration(str(value))
+
+    def to_log(self, row: dict, report: ImportReport) -> dict:
+        ''' the log of a row, ValueError with the reason if it is not valid '''
+        start = self._time(row, "start")
+        if start is None:
+            raise ValueError("no start")
+        pause = self._seconds(row.get("pause"))
+        stop = self._time(row, "stop")
+        if stop is None:
+            if row.get("duration") in (None, ""):
+                raise ValueError("no stop or duration")
+            stop = start + self._seconds(row["duration"]) + pause
+        if stop <= start:
+            raise ValueError("stop before start" if stop < start else "empty log")
+        if pause < 0 or pause > stop - start:
+            raise ValueError("pause longer than the log")
+        if stop > self.now:
+            raise ValueError("in the future")
+        return {"name": self._project(row.get("project"), report), "start": start, "stop": stop, "pause": pause}
+
+    def run(self, stream: IO[bytes], progress: Optional[Callable[[ImportReport], None]] = None) -> ImportReport:
+        ''' import the file, ValueError if it is neither a CSV table with a header nor JSON '''
+        report = ImportReport()
+        try:
+            self.storage.import_logs(self.user_id, self._batches(stream, report, progress))
+        finally:
+            IMPORT_ROWS.inc("imported", amount=report.imported)
+            IMPORT_ROWS.inc("duplicate", amount=report.duplicates)
+            IMPORT_ROWS.inc("invalid", amount=sum(report.invalid.values()))
+        return report
+
+    def _batches(self, stream: IO[bytes], report: ImportReport,
+                 progress: Optional[Callable[[ImportReport], None]]) -> Iterator[Dict[str, dict]]:
+        ''' the valid new logs of the file, `batch_size` at a time, a batch is written once the next is asked for '''
+        seen = self._seen()
+        batch: Dict[str, dict] = {}
+        for line, row in read_rows(stream):
+            report.rows += 1
+            try:
+                log = self.to_log(row, report)
+            except ValueError as e:
+                report.reject(line, str(e))
+                continue
+            key = (log["start"] // MINUTE, log["stop"] // MINUTE)
+            if key in seen:
+                report.duplicates += 1
+                continue
+            seen.add(key)
+            batch[str(uuid.uuid4())] = log
+            if len(batch) >= self.batch_size:
+                yield batch
+                self._written(batch, report, progress)
+                batch = {}
+        if batch:
+            yield batch
+            self._written(batch, report, progress)
+
+    @staticmethod
+    def _written(batch: Dict[str, dict], report: ImportReport,
+                 progress: Optional[Callable[[ImportReport], None]]) -> None:
+        report.imported += len(batch)
+        if progress is not None:
+            progress(report)
@@ -0,0 +1,61 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, Iterator, List, Tuple
+
+
+class StartIndex():
+    ''' Sorted index of the log start times of a single user.
+
+    Start times are kept in an `array('q')` sorted ascending, the IDs of the logs in a parallel list,
+    so a time range is found with two binary searches instead of a scan over the whole history.
+    Logs with equal start times are ordered by ID, which makes the order stable between calls.
+    '''
+    __slots__ = ("starts", "ids", "start_of")
+
+    def __init__(self, items: Iterable[Tuple[int, str]] = ()):
+        pairs = sorted(items)
+        self.starts = array("q", (start for start, _ in pairs))
+        self.ids: List[str] = [log_id for _, log_id in pairs]
+        self.start_of = {log_id: start for start, log_id in pairs}  # log_id -> start, to find it again
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, log_id: str) -> bool:
+        return log_id in self.start_of
+
+    def _locate(self, start: int, log_id: str) -> int:
+        ''' position of the (start, log_id) pair in the sorted arrays '''
+        lo = bisect_left(self.starts, start)
+        hi = bisect_right(self.starts, start)
+        return bisect_left(self.ids, log_id, lo, hi)
+
+    def add(self, log_id: str, start: int) -> None:
+        if log_id in self.start_of:
+            if self.start_of[log_id] == start:
+                return
+            self.remove(log_id)
+        i = self._locate(start, log_id)
+        self.starts.insert(i, start)
+        self.ids.insert(i, log_id)
+        self.start_of[log_id] = start
+
+    def remove(self, log_id: str) -> None:
+        start = self.start_of.pop(log_id, None)
+        if start is None:
+            return
+        i = self._locate(start, log_id)
+        del self.starts[i]
+        del self.ids[i]
+
+    def clear(self) -> None:
+        self.starts = array("q")
+        self.ids = []
+        self.start_of = {}
+
+    def range(self, since: int, until: int, reverse: bool = False) -> Iterator[str]:
+        ''' IDs of the logs with since <= start < until, ordered by start time '''
+        lo = bisect_left(self.starts, since)
+        hi = bisect_left(self.starts, until)
+        indices = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+        return (self.ids[i] for i in indices)
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import zlib
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+
+# kinds of events, a record is {"s": seq, "u": user_id, "k": kind, "t": timestamp, ...}
+START, PAUSE, RESUME, STOP = "start", "pause", "resume", "stop"  # the running timer
+DROP, DELETE, RESET = "drop", "delete", "reset"  # running timer deleted, finished log deleted, logs cleared
+ADD_PROJECT, REMOVE_PROJECT = "project+", "project-"
+
+JOURNAL_EVENTS = metrics.Counter("storage_journal_events_total", "Events appended to the storage journal", ["kind"])
+JOURNAL_SNAPSHOTS = metrics.Counter("storage_journal_snapshots_total", "Journal shards compacted into a snapshot")
+
+# a finished log as (log_id, log)
+Finished = Tuple[str, dict]
+
+
+def apply(timers: Dict[str, dict], event: dict) -> Optional[Finished]:
+    ''' apply an event to the running timers (user_id -> timer), return the log finished by a "stop".
+    A timer is {"id", "name", "start", "pause", "paused_at"}: "pause" is always the total pause of the
+    pauses that ended, "paused_at" the begin of the current pause or None while the timer runs
+    '''
+    user_id, kind = event["u"], event["k"]
+    if kind == START:
+        timers[user_id] = {"id": event["id"], "name": event["name"], "start": event["t"],
+                           "pause": event.get("pause", 0), "paused_at": event.get("paused_at")}
+        return None
+    timer = timers.get(user_id)
+    if timer is None:
+        return None
+    if kind == PAUSE and timer["paused_at"] is None:
+        timer["paused_at"] = event["t"]
+    elif kind == RESUME and timer["paused_at"] is not None:
+        timer["pause"] += event["t"] - timer["paused_at"]
+        timer["paused_at"] = None
+    elif kind == STOP:
+        del timers[user_id]
+        pause = timer["pause"] + (event["t"] - timer["paused_at"] if timer["paused_at"] is not None else 0)
+        return timer["id"], {"name": timer["name"], "start": timer["start"], "stop": event["t"], "pause": pause}
+    elif kind in (DROP, RESET):
+        del timers[user_id]
+    return None
+
+
+class _Shard():
+    ''' one journal file with its snapshot '''
+    def __init__(self, path: str, index: int):
+        self.index = index
+        self.log_path = os.path.join(path, f"journal-{index:03d}.log")
+        self.snapshot_path = os.path.join(path, f"journal-{index:03d}.snapshot")
+        self.lock = threading.Lock()
+        self.seq = 0  # of the last event
+        self.pending = 0  # events since the snapshot
+        self.file: Optional[BinaryIO] = None
+
+    def load(self, timers: Dict[str, dict], tail: List[Tuple[dict, Optional[Finished]]]) -> None:
+        ''' read the snapshot and replay the events after it '''
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = json.load(f)
+            snapshot_seq = self.seq = snapshot["seq"]
+            timers.update(snapshot["timers"])
+        data = b""
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+        # an event is written together with its newline, a last line without it was torn by a crash
+        valid = data.rfind(b"\n") + 1
+        lines = data[:valid].splitlines()
+        try:
+            replayed = json.loads(b"[" + b",".join(lines) + b"]")  # one decoder call for the whole file
+        except ValueError:
+            replayed = []
+            for line in lines:  # keep the events before the damaged one
+                try:
+                    replayed.append(json.loads(line))
+                except ValueError:
+                    break
+            valid = sum(len(line) + 1 for line in lines[:len(replayed)])
+        for event in replayed:
+            # a crash between writing a snapshot and truncating the file leaves events already in it
+            if event["s"] > snapshot_seq:
+                tail.append((event, apply(timers, event)))
+                self.seq = event["s"]
+                self.pending += 1
+        self.file = open(self.log_path, "ab")
+        self.file.truncate(valid)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Journal():
+    ''' Append-only journal of the timer actions (start, pause, resume, stop) and project edits of all users.
+
+    Events are appended as one JSON line to the file of the shard of the user, with no read-modify-write
+    of a stored document, and applied to the running timers kept in memory (see `apply`), which are thus
+    rebuilt exactly after a crash by replaying the files. After `snapshot_every` events a shard is due
+    for compaction, which `compact` does once the caller has applied the effects of the events (e.g.
+    written the finished log): `checkpoint` makes those effects durable elsewhere (the finished logs and
+    the settings written by `db.Storage`), then the running timers of the shard are written to a snapshot
+    file and the journal file starts empty, so a replay reads about one snapshot and `snapshot_every`
+    events per shard. The events replayed at startup stay in `tail` for `db.Storage` to redo what the
+    checkpoint may have missed.
+    Args:
+        path : str - directory of the journal files
+        shards : int - number of journal files, the events of a user always go to the same one
+        snapshot_every : int - events of a shard after which it is compacted
+        fsync : bool - fsync every event, so it survives a power loss and not only a crash of the bot
+        checkpoint : Callable[[], None] - called before a snapshot drops events
+    '''
+    def __init__(self, path: str, shards: int = 16, snapshot_every: int = 10000, fsync: bool = False,
+                 checkpoint: Optional[Callable[[], None]] = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.checkpoint = checkpoint
+        self.timers: Dict[str, dict] = {}
+        self.tail: List[Tuple[dict, Optional[Finished]]] = []
+        self.shards = [_Shard(path, i) for i in range(shards)]
+        for shard in self.shards:
+            shard.load(self.timers, self.tail)
+
+    def _shard(self, user_id: str) -> _Shard:
+        return self.shards[zlib.crc32(user_id.encode()) % len(self.shards)]
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def timer(self, user_id: str) -> Optional[dict]:
+        ''' a copy of the running timer of the user, None if nothing is recorded '''
+        timer = self.timers.get(user_id)
+        return None if timer is None else dict(timer)
+
+    def running(self) -> Iterator[Tuple[str, dict]]:
+        ''' (user_id, timer) of every running timer '''
+        for user_id, timer in list(self.timers.items()):
+            yield user_id, dict(timer)
+
+    def append(self, user_id: str, kind: str, t: int, **fields) -> Optional[Finished]:
+        ''' write an event and apply it, return the log finished by a "stop" '''
+        shard = self._shard(user_id)
+        with shard.lock:
+            shard.seq += 1
+            event = {"s": shard.seq, "u": user_id, "k": kind, "t": t, **fields}
+            shard.file.write(json.dumps(event, separators=(",", ":")).encode() + b"\n")
+            shard.file.flush()
+            if self.fsync:
+                os.fsync(shard.file.fileno())
+            finished = apply(self.timers, event)
+            shard.pending += 1
+        JOURNAL_EVENTS.inc(kind)
+        return finished
+
+    def compact(self) -> None:
+        ''' Compact the shards with `snapshot_every` events or more. Never call it between appending an event
+        and applying its effects: the checkpoint would miss them and the snapshot drops the event
+        '''
+        for shard in self.shards:
+            if shard.pending >= self.snapshot_every:
+                with shard.lock:
+                    if shard.pending >= self.snapshot_every:
+                        self._snapshot(shard)
+
+    def snapshot(self) -> None:
+        ''' compact every shard '''
+        for shard in self.shards:
+            with shard.lock:
+                if shard.pending:
+                    self._snapshot(shard)
+
+    def _snapshot(self, shard: _Shard) -> None:
+        # appends to the shard wait for the checkpoint, the other shards go on
+        if self.checkpoint is not None:
+            self.checkpoint()
+        timers = {user_id: timer for user_id, timer in list(self.timers.items()) if self._shard(user_id) is shard}
+        temporary = shard.snapshot_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"seq": shard.seq, "timers": timers}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, shard.snapshot_path)
+        shard.file.truncate(0)
+        shard.pending = 0
+        JOURNAL_SNAPSHOTS.inc()
+
+    def clear(self) -> None:
+        ''' forget every timer and event. Destructive! '''
+        for shard in self.shards:
+            with shard.lock:
+                shard.file.truncate(0)
+                shard.pending = 0
+                if os.path.exists(shard.snapshot_path):
+                    os.remove(shard.snapshot_path)
+        self.timers.clear()
+        self.tail.clear()
+
+    def close(self) -> None:
+        ''' compact and close the files, the next start reads the snapshots only '''
+        self.snapshot()
+        for shard in self.shards:
+            shard.close()
+
+
+def journal_path(path: str, index: int = 0, count: int = 1) -> str:
+    ''' directory of the journal of a worker of a sharded bot (see `shard.py`), `path` itself without sharding '''
+    return path if count <= 1 else os.path.join(path, f"shard-{index}-of-{count}")
+
+
+def rebalance(path: str, count: int, shard_of: Callable[[str], int]) -> int:
+    ''' Move the running timers of the journals of another number of workers under `path` into the journals of
+    `count` workers, `shard_of(user_id)` is the worker of a user. Only journals closed cleanly (snapshots without
+    events after them) are moved, for the others RuntimeError is raised: the bot has to run once more with the
+    old number of workers to recover their events. Returns the number of moved timers
+    '''
+    if not os.path.isdir(path):
+        return 0
+    wanted = {journal_path(path, i, count) for i in range(count)}
+    old = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.startswith("shard-")]
+    old = [directory for directory in old if directory not in wanted]
+    if path not in wanted:
+        old.append(path)
+    targets: Dict[str, Journal] = {}
+    moved = 0
+    for directory in old:
+        files = [name for name in os.listdir(directory) if name.startswith("journal-")]
+        if not files:
+            continue
+        journal = Journal(directory, shards=max(int(name[8:11]) for name in files) + 1)
+        if journal.tail:
+            journal.close()
+            raise RuntimeError(f"the journal in {directory} has events that are not recovered, "
+                               f"start the bot with its old number of workers once")
+        for user_id, timer in journal.running():
+            target = journal_path(path, shard_of(user_id), count)
+            if target not in targets:
+                targets[target] = Journal(target, shards=int(os.environ.get("JOURNAL_SHARDS", "16")))
+            targets[target].append(user_id, START, timer["start"], id=timer["id"], name=timer["name"],
+                                   pause=timer["pause"], paused_at=timer["paused_at"])
+            moved += 1
+        journal.clear()
+        journal.close()
+        for name in os.listdir(directory):
+            if name.startswith("journal-"):
+                os.remove(os.path.join(directory, name))
+        if directory != path:
+            os.rmdir(directory)
+    for journal in targets.values():
+        journal.close()
+    return moved
+
+
+def make_journal(checkpoint: Optional[Callable[[], None]] = None) -> Optional[Journal]:
+    ''' The journal in the STORAGE_JOURNAL directory, None if it is not set (timers live in the engine).
+    JOURNAL_SHARDS files, compacted every JOURNAL_SNAPSHOT_EVERY events, JOURNAL_FSYNC=1 syncs every event.
+    A worker of a sharded bot (SHARD_INDEX of SHARD_COUNT) keeps its own journal in a subdirectory
+    '''
+    path = os.environ.get("STORAGE_JOURNAL")
+    if not path:
+        return None
+    path = journal_path(path, int(os.environ.get("SHARD_INDEX", "0")), int(os.environ.get("SHARD_COUNT", "1")))
+    return Journal(path, shards=int(os.environ.get("JOURNAL_SHARDS", "16")),
+                   snapshot_every=int(os.environ.get("JOURNAL_SNAPSHOT_EVERY", "10000")),
+                   fsync=os.environ.get("JOURNAL_FSYNC", "0") == "1", checkpoint=checkpoint)
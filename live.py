@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import metrics
+from outbox import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# (log_id, text, keyboard) of the running timer of a user, None if nothing is recorded
+View = Optional[Tuple[str, str, Optional[InlineKeyboardMarkup]]]
+
+LIVE_TIMERS = metrics.Gauge("bot_live_timers", "Timer messages refreshed by the live scheduler")
+LIVE_EDITS = metrics.Counter("bot_live_edits_total", "Refreshes of live timer messages by result", ["result"])
+
+
+class _Entry():
+    __slots__ = ("user_id", "chat_id", "message_id", "log_id", "text")
+
+    def __init__(self, user_id: int, chat_id: int, message_id: int, log_id: str, text: str):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.log_id = log_id
+        self.text = text  # the text the message shows right now
+
+
+class LiveTimers():
+    ''' One scheduler that keeps the messages of all running timers up to date.
+
+    The timer messages sit in a timer wheel of `interval / tick` slots. Every tick the wheel advances
+    by one slot and refreshes the messages in it, so every message is refreshed once per `interval`
+    and the refreshes are spread evenly over the ticks. A refresh renders the message anew (`render`,
+    from the running log of the user) and edits it only if the text changed, e.g. not while the minute
+    has not turned. At most `max_edits_per_second` edits are sent per second, the rest waits for the
+    next tick ahead of the slot, and a RetryAfter of telegram pauses the whole wheel. Every chat has
+    one timer message edited once per `interval`, well within the per-chat flood limit.
+    A message leaves the wheel when its timer is stopped, replaced by a newer timer or cannot be edited.
+    Args:
+        bot : telegram.Bot - sends the edits
+        render : Callable[[int], View] - the current view of the timer of a user
+        locks : Callable[[int], asyncio.Lock] - the lock of a user, held while their message is rendered
+        interval : float - seconds between two refreshes of a message
+        max_edits_per_second : int - edits sent by the scheduler per second
+        tick : float - seconds between two steps of the wheel
+    '''
+    def __init__(self, bot: Bot, render: Callable[[int], View], locks: Callable[[int], asyncio.Lock],
+                 interval: float = 60, max_edits_per_second: int = 20, tick: float = 1.0):
+        self.bot = bot
+        self.render = render
+        self.locks = locks
+        self.tick = tick
+        self.max_edits = max(1, int(max_edits_per_second * tick))
+        self.slots: List[Dict[int, _Entry]] = [{} for _ in range(max(1, round(interval / tick)))]
+        self.slot_of: Dict[int, int] = {}  # user_id -> slot
+        self.backlog: "OrderedDict[int, _Entry]" = OrderedDict()  # due, but over the budget of their tick
+        self.position = 0
+        self.paused_until = 0.0
+        self.task: Optional[asyncio.Task] = None
+        LIVE_TIMERS.set_function(self.__len__)
+
+    def __len__(self) -> int:
+        return len(self.slot_of)
+
+    def add(self, user_id: int, chat_id: int, message_id: int, log_id: str, text: str) -> None:
+        ''' refresh the timer message of the user from now on (replaces an older message of the user) '''
+        self.remove(user_id)
+        # the current slot was just processed, so the first refresh is one interval later
+        self.slots[self.position][user_id] = _Entry(user_id, chat_id, message_id, log_id, text)
+        self.slot_of[user_id] = self.position
+
+    def entry(self, user_id: int) -> Optional[_Entry]:
+        slot = self.slot_of.get(user_id)
+        return None if slot is None else self.slots[slot][user_id]
+
+    def remove(self, user_id: int) -> None:
+        slot = self.slot_of.pop(user_id, None)
+        if slot is not None:
+            del self.slots[slot][user_id]
+        self.backlog.pop(user_id, None)
+
+    # ---------------------------------------------------------------- scheduling
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            deadline += self.tick
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            try:
+                await self.advance()
+            except Exception:  # the scheduler must survive a broken refresh
+                logger.exception("Refreshing live timers failed")
+
+    async def advance(self) -> None:
+        ''' one step of the wheel: refresh the due messages whose text changed, within the rate limit '''
+        self.position = (self.position + 1) % len(self.slots)
+        # the messages left over from the previous ticks go first
+        for user_id, entry in self.slots[self.position].items():
+            self.backlog.setdefault(user_id, entry)
+        if asyncio.get_running_loop().time() < self.paused_until:
+            return
+
+        changed = []
+        while self.backlog and len(changed) < self.max_edits:
+            _, entry = self.backlog.popitem(last=False)
+            view = self.render(entry.user_id)
+            if view is None or view[0] != entry.log_id:  # the timer was stopped or replaced
+                self.remove(entry.user_id)
+                LIVE_EDITS.inc("finished")
+            elif view[1] == entry.text:
+                LIVE_EDITS.inc("unchanged")
+            else:
+                changed.append(entry)
+        if self.backlog:
+            LIVE_EDITS.inc("deferred", amount=len(self.backlog))
+        # the edits of different chats are independent, send them at once
+        await asyncio.gather(*(self.refresh(entry) for entry in changed))
+
+    async def refresh(self, entry: _Entry) -> None:
+        async with self.locks(entry.user_id):
+            # render again under the lock, a handler of the user may have changed the timer meanwhile
+            if self.entry(entry.user_id) is not entry:  # removed or replaced meanwhile
+                return
+            view = self.render(entry.user_id)
+            if view is None or view[0] != entry.log_id:
+                self.remove(entry.user_id)
+                return
+            _, text, keyboard = view
+        # sent without the lock, the updates of the user do not wait for the flood limits. A handler that edits
+        # the message meanwhile replaces this edit in the outbox, only its newer text is sent
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=entry.chat_id, message_id=entry.message_id,
+                                             reply_markup=keyboard, rate_limit_args=BACKGROUND)
+        except RetryAfter as e:
+            # flood limit hit: no edits until telegram allows them again, the entry goes first then
+            self.paused_until = asyncio.get_running_loop().time() + e.retry_after
+            if self.entry(entry.user_id) is entry:
+                self.backlog[entry.user_id] = entry
+                self.backlog.move_to_end(entry.user_id, last=False)
+            LIVE_EDITS.inc("retry_after")
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():  # deleted or too old to edit
+                self.discard(entry)
+                LIVE_EDITS.inc("failed")
+                return
+        except Forbidden:  # the user blocked the bot
+            self.discard(entry)
+            LIVE_EDITS.inc("failed")
+            return
+        entry.text = text
+        LIVE_EDITS.inc("edited")
+
+    def discard(self, entry: _Entry) -> None:
+        ''' remove the message unless the user has a newer one '''
+        if self.entry(entry.user_id) is entry:
+            self.remove(entry.user_id)
@@ -0,0 +1,23 @@
+import asyncio
+from typing import Hashable, List
+
+
+class KeyedLock():
+    ''' Sharded asyncio mutex keyed by e.g. a user ID.
+
+    Every key maps to one of `shards` `asyncio.Lock`s, so the memory does not grow with the number of
+    users and no lock has to be cleaned up. Two keys sharing a shard only wait for each other, which is
+    rare with enough shards. `asyncio.Lock` wakes waiters in FIFO order, so the critical sections of a key
+    run in the order they were entered.
+    Usage:
+        async with locks(user_id):
+            ...
+    '''
+    def __init__(self, shards: int = 1024):
+        self.shards: List[asyncio.Lock] = [asyncio.Lock() for _ in range(shards)]
+
+    def __call__(self, key: Hashable) -> asyncio.Lock:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def locked(self, key: Hashable) -> bool:
+        return self(key).locked()
@@ -0,0 +1,304 @@
+import functools
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+
+# Process-wide metrics in the Prometheus text format, served by `app.py` on /metrics.
+# Only the three kinds the bot needs are implemented, so there is no extra dependency.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric():
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        return (f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in items)
+
+
+class Gauge(_Metric):
+    ''' a value that goes up and down, or a function that is called on every scrape '''
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, fn: Callable[[], float], *labels: str) -> None:
+        with self.lock:
+            self.functions[labels] = fn
+
+    def get(self, *labels: str) -> float:
+        fn = self.functions.get(labels)
+        return fn() if fn is not None else self.values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = dict(self.values)
+            functions = dict(self.functions)
+        for labels, fn in functions.items():
+            try:
+                items[labels] = fn()
+            except Exception:  # a broken callback must not break the whole scrape
+                continue
+        return (f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in sorted(items.items()))
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], List[float]] = {}  # labels -> bucket counts + [sum, count]
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = sorted((labels, list(counts)) for labels, counts in self.values.items())
+        for labels, counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {counts[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {counts[-2]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {counts[-1]}"
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    ''' all metrics in the Prometheus text exposition format '''
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def merge(texts: Dict[str, str], label: str = "shard") -> str:
+    ''' One exposition of the rendered metrics of several processes (the workers of `shard.py`),
+    keyed by the value of `label` given to their samples, "" keeps the samples of a process as they are.
+    The samples of a metric stay together under one HELP and TYPE, as the format requires
+    '''
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for value, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("#"):
+                family = line.split()[2]
+                headers, _ = families.setdefault(family, ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line and family is not None:
+                if value:
+                    brace, space = line.find("{"), line.find(" ")
+                    pair = f'{label}="{_escape(value)}"'
+                    if 0 <= brace < space:
+                        line = f"{line[:brace + 1]}{pair},{line[brace + 1:]}"
+                    else:
+                        line = f"{line[:space]}{{{pair}}}{line[space:]}"
+                families[family][1].append(line)
+    return "\n".join(line for headers, samples in families.values() for line in headers + samples) + "\n"
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Latency of the bot callbacks", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Callbacks that raised an exception", ["handler"])
+TELEGRAM_SECONDS = Histogram("telegram_api_seconds", "Latency of the Bot API calls", ["method"])
+TELEGRAM_CALLS = Counter("telegram_api_calls_total", "Bot API calls by HTTP status", ["method", "status"])
+STORAGE_SECONDS = Histogram("storage_seconds", "Latency of the round-trips to the storage engine", ["operation"])
+STORAGE_ERRORS = Counter("storage_errors_total", "Round-trips to the storage engine that failed", ["operation"])
+STORAGE_BYTES = Counter("storage_bytes_total", "Bytes read from and written to the replit database", ["direction"])
+CACHE_REQUESTS = Counter("storage_cache_requests_total", "Reads of the write-behind cache", ["part", "result"])
+CACHE_USERS = Gauge("storage_cache_users", "Users kept in the write-behind cache")
+CACHE_PENDING = Gauge("storage_cache_pending_changes", "Changes waiting for the next flush")
+ACTIVE_TIMERS = Gauge("bot_active_timers", "Timers started and not stopped since the process started")
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Seconds from the import of the bot to a startup phase", ["phase"])
+UPDATE_QUEUE = Gauge("bot_update_queue_size", "Updates waiting in the update queue of the application")
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates taken from the update queue and not processed yet")
+
+
+# ---------------------------------------------------------------- instrumentation
+def timed_callback(callback: Callable) -> Callable:
+    ''' wrap an async bot callback, so its latency and errors are recorded under its name '''
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+def instrument_handlers(handlers: Iterable) -> None:
+    ''' replace the callbacks of handlers (and of the handlers inside conversations) with timed ones '''
+    for handler in handlers:
+        if hasattr(handler, "states"):  # a ConversationHandler, its own callback is not called
+            instrument_handlers(handler.entry_points)
+            instrument_handlers(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+        elif not getattr(handler.callback, "__wrapped__", None):
+            handler.callback = timed_callback(handler.callback)
+
+
+class InstrumentedRequest(BaseRequest):
+    ''' Bot API transport that records the count and the latency of every call of the wrapped one '''
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        status = "error"
+        try:
+            status, payload = await self.request.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+            return status, payload
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - start, api_method)
+            TELEGRAM_CALLS.inc(api_method, str(status))
+
+
+def timed_call(operation: str, fn: Callable, *args, **kwargs):
+    ''' call a storage engine and record the latency (and a failure) of the round-trip '''
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        STORAGE_ERRORS.inc(operation)
+        raise
+    finally:
+        STORAGE_SECONDS.observe(time.perf_counter() - start, operation)
+
+
+class ByteCountingClient():
+    ''' replit database client that counts the bytes of the raw values it moves '''
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
+
+    def __delitem__(self, key: str) -> None:
+        del self.client[key]
+
+    def get_raw(self, key: str) -> str:
+        value = self.client.get_raw(key)
+        STORAGE_BYTES.inc("read", amount=len(value))
+        return value
+
+    def set_raw(self, key: str, value: str) -> None:
+        STORAGE_BYTES.inc("write", amount=len(value))
+        self.client.set_raw(key, value)
+
+    def set_bulk_raw(self, values: Dict[str, str]) -> None:
+        STORAGE_BYTES.inc("write", amount=sum(len(value) for value in values.values()))
+        self.client.set_bulk_raw(values)
+
+
+# ---------------------------------------------------------------- profiling
+def sample_profile(seconds: float = 10.0, interval: float = 0.005, thread_ids: Optional[Sequence[int]] = None) -> str:
+    ''' Sample the stacks of all the other threads every `interval` seconds for `seconds` seconds.
+    Returns the stacks in the collapsed format ("outer;inner;innermost count" per line, most frequent first),
+    which flame graph tools read directly. Unlike cProfile it sees the event loop of the bot from any thread
+    '''
+    own = threading.get_ident()
+    stacks = _Tally()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
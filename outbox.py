@@ -0,0 +1,283 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, Hashable, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# priorities of the requests, lower goes first. Pass BACKGROUND as `rate_limit_args` of a bot method
+# for requests nobody is waiting for (live timers, reminders)
+INTERACTIVE, USER, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", USER: "user", BACKGROUND: "background"}
+# the spinner on the button of the user stops with these, they go ahead of everything else
+INTERACTIVE_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery"}
+# an edit waiting in the queue is replaced by a newer edit of the same message
+COALESCED_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup"}
+
+OUTBOX_QUEUE = metrics.Gauge("telegram_outbox_queue", "Bot API calls waiting for a send slot")
+OUTBOX_WAIT = metrics.Histogram("telegram_outbox_wait_seconds", "Seconds a Bot API call waited for a send slot",
+                                ["priority"])
+OUTBOX_COALESCED = metrics.Counter("telegram_outbox_coalesced_total", "Edits replaced by a newer edit of the message")
+OUTBOX_RETRIES = metrics.Counter("telegram_outbox_retries_total", "Bot API calls repeated after a RetryAfter")
+
+
+class TokenBucket():
+    ''' `rate` tokens per second, at most `burst` of them saved up. `reserve` books the next token and
+    returns the seconds until it is available, so the waiters of a bucket are served in order without a lock
+    '''
+    def __init__(self, rate: float, burst: float):
+        self.interval = 1 / rate
+        self.burst = burst
+        self.available_at = 0.0  # theoretical time the next token is available
+
+    def reserve(self, now: float) -> float:
+        start = max(self.available_at, now - (self.burst - 1) * self.interval)
+        self.available_at = start + self.interval
+        return max(0.0, start - now)
+
+    def refund(self) -> None:
+        ''' give back the token of the last `reserve`, it was not used '''
+        self.available_at -= self.interval
+
+    def idle(self, now: float) -> bool:
+        ''' the bucket is full again, i.e. no different from a new one '''
+        return self.available_at + (self.burst - 1) * self.interval <= now
+
+
+class _Request():
+    __slots__ = ("priority", "key", "granted", "done", "replaced_by")
+
+    def __init__(self, priority: int, key: Optional[Hashable]):
+        self.priority = priority
+        self.key = key  # message of a coalesced edit
+        self.granted: Optional[asyncio.Future] = None  # a send slot, or the newer edit to wait for
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()  # result of the call, for replaced edits
+        self.replaced_by: Optional["_Request"] = None
+
+    def replace_with(self, newer: "_Request") -> None:
+        ''' the newer edit is sent instead, its result becomes the one of this request (and of those it replaced) '''
+        self.replaced_by = newer
+        newer.done.add_done_callback(self._pass_on)
+
+    def _pass_on(self, newer: asyncio.Future) -> None:
+        if self.done.done():
+            return
+        if newer.cancelled():
+            self.done.cancel()
+        elif newer.exception() is not None:
+            self.done.set_exception(newer.exception())
+            self.done.exception()  # retrieved, its caller may be gone
+        else:
+            self.done.set_result(newer.result())
+
+
+class Outbox(BaseRateLimiter):
+    ''' Rate limiter of all Bot API calls of the bot (`ApplicationBuilder.rate_limiter`).
+
+    A call first waits for a token of its chat (`group_rate` per second in groups, `chat_rate` in private
+    chats, both with a burst of `chat_burst`), then for a global send slot (`rate` per second). In private
+    chats only BACKGROUND calls wait for the chat: the other ones answer the taps of the user, who thus
+    sets their pace, and should not lag behind them. The global
+    slots go to the waiting calls by priority: answers to button presses first, then the other calls of
+    handlers and last the BACKGROUND ones, which are still guaranteed `background_share` of the slots
+    while they wait (in their order), so a steady stream of other calls does not starve them. An edit that is still waiting (for its chat or a slot) is
+    replaced by a newer edit of the same message, only the newer one is sent and both callers get its
+    result. A RetryAfter stops
+    all sending for the given time, then the call is repeated (at most `max_retries` times).
+    The calls themselves run concurrently, so a handler can send independent calls at once
+    (`asyncio.gather`) and pay one round-trip instead of several.
+    '''
+    def __init__(self, rate: float = 30, chat_rate: float = 1, group_rate: float = 20 / 60, chat_burst: float = 3,
+                 max_retries: int = 3, background_share: float = 0.1):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.queue: List[Tuple[int, int, _Request]] = []  # (priority, seq, request)
+        self.background: Deque[_Request] = deque()  # the BACKGROUND requests in their order
+        # a waiting BACKGROUND request gets at least every this many slots
+        self.background_every = max(1, round(1 / background_share))
+        self.since_background = 0  # slots given to others while BACKGROUND requests waited
+        self.counter = itertools.count()
+        self.pending_edits: Dict[Hashable, _Request] = {}
+        self.blocked_until = 0.0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        OUTBOX_QUEUE.set_function(lambda: len(self.queue) + len(self.background))
+
+    async def initialize(self) -> None:
+        self._start()
+
+    async def shutdown(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _start(self) -> None:
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._dispatch())
+
+    # ---------------------------------------------------------------- limits
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:  # forget the chats that are quiet again
+                now = time.monotonic()
+                self.chat_buckets = {chat: b for chat, b in self.chat_buckets.items() if not b.idle(now)}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                self.group_rate if self._is_group(chat_id) else self.chat_rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    def _is_group(chat_id: Any) -> bool:
+        # groups have negative IDs, channels may be addressed by "@name"
+        return str(chat_id).startswith(("-", "@"))
+
+    async def _dispatch(self) -> None:
+        ''' hand the global send slots to the waiting requests, highest priority first '''
+        while True:
+            while not self.queue and not self.background:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            # replaced edits and cancelled calls take no slot
+            self._drop_dead()
+            if not self.queue and not self.background:
+                continue
+            # wait for the slot first, the request is picked when it is free, so later urgent ones still go first
+            delay = self.global_bucket.reserve(now)
+            if delay:
+                await asyncio.sleep(delay)
+            self._drop_dead()
+            if not self.queue and not self.background:  # every waiting request went away meanwhile
+                self.global_bucket.refund()
+                continue
+            request = self._pick()
+            if request.key is not None and self.pending_edits.get(request.key) is request:
+                del self.pending_edits[request.key]
+            request.granted.set_result(None)
+
+    def _pick(self) -> _Request:
+        ''' the next request to send: by priority, but the oldest BACKGROUND one once it is its turn '''
+        if self.background and (not self.queue or self.since_background + 1 >= self.background_every):
+            self.since_background = 0
+            return self.background.popleft()
+        if self.background:
+            self.since_background += 1
+        return heapq.heappop(self.queue)[2]
+
+    def _drop_dead(self) -> None:
+        ''' pop the requests at the top of the queues that were replaced by a newer edit or whose caller is gone '''
+        while self.queue and self.queue[0][2].granted.done():
+            heapq.heappop(self.queue)
+        while self.background and self.background[0].granted.done():
+            self.background.popleft()
+
+    def _coalesce(self, request: _Request) -> None:
+        ''' the edit takes the place of an older edit of the message that still waits, for the flood limit of
+        the chat or a send slot. It keeps the better priority
+        '''
+        older = self.pending_edits.get(request.key)
+        if older is not None and older is not request and older.replaced_by is None and (
+                older.granted is None or not older.granted.done()):
+            older.replace_with(request)
+            if older.granted is not None:
+                older.granted.set_result(None)
+            request.priority = min(request.priority, older.priority)
+            OUTBOX_COALESCED.inc()
+        self.pending_edits[request.key] = request
+
+    def _enqueue(self, request: _Request) -> None:
+        request.granted = asyncio.get_running_loop().create_future()
+        if request.key is not None:
+            self.pending_edits[request.key] = request
+        if request.priority >= BACKGROUND:
+            self.background.append(request)
+        else:
+            heapq.heappush(self.queue, (request.priority, next(self.counter), request))
+        self.wakeup.set()
+
+    # ---------------------------------------------------------------- BaseRateLimiter
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Union[bool, dict, None]]],
+                              args: Any, kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[int]) -> Union[bool, dict, None]:
+        self._start()
+        if endpoint in INTERACTIVE_ENDPOINTS:
+            priority = INTERACTIVE
+        else:
+            priority = USER if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        key = None
+        if endpoint in COALESCED_ENDPOINTS:
+            key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+
+        request = _Request(priority, key)
+        if key is not None:
+            # from the call on, so an edit rendered earlier that still waits for the chat never overtakes it
+            self._coalesce(request)
+        for attempt in itertools.count():
+            started = time.monotonic()
+            if chat_id is not None and (priority >= BACKGROUND or self._is_group(chat_id)):
+                delay = self._chat_bucket(chat_id).reserve(started)
+                if delay:
+                    try:
+                        await asyncio.sleep(delay)
+                    except asyncio.CancelledError:
+                        if self.pending_edits.get(key) is request:
+                            del self.pending_edits[key]
+                        raise
+            newer = self.pending_edits.get(key) if attempt and key is not None else None
+            if newer is not None and newer is not request and newer.replaced_by is None:
+                # a newer edit of the message came in while this one was sent and hit the flood limit
+                request.replace_with(newer)
+            if request.replaced_by is not None:
+                return await asyncio.shield(request.done)
+            self._enqueue(request)
+            try:
+                await request.granted
+            except asyncio.CancelledError:
+                request.done.cancel()
+                raise
+            OUTBOX_WAIT.observe(time.monotonic() - started, PRIORITY_NAMES.get(priority, str(priority)))
+            if request.replaced_by is not None:
+                return await asyncio.shield(request.done)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # the flood limit of telegram applies to the whole bot, stop sending for a while
+                self.blocked_until = max(self.blocked_until, time.monotonic() + e.retry_after)
+                if attempt < self.max_retries:
+                    OUTBOX_RETRIES.inc()
+                    logger.warning("Flood limit hit by %s, sending again in %s s", endpoint, e.retry_after)
+                    continue
+                self._fail(request, e)
+                raise
+            except BaseException as e:
+                self._fail(request, e)
+                raise
+            request.done.set_result(result)
+            return result
+
+    @staticmethod
+    def _fail(request: _Request, error: BaseException) -> None:
+        request.done.set_exception(error)
+        request.done.exception()  # the caller raises it, the replaced edits may not be there to retrieve it
@@ -0,0 +1,129 @@
+import copy
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import Storage
+
+ConversationKey = Tuple[int, ...]
+
+
+class StoragePersistence(BasePersistence):
+    ''' Persistence of the conversation states and user/chat data in the bot's own storage.
+
+    Everything is kept in the meta of the user it belongs to ("conversations", "user_data", "chat_data"),
+    so nothing is read at startup: the data of a user is loaded the first time one of their updates
+    comes in (`load_user` for conversations, `refresh_user_data`/`refresh_chat_data` for the rest).
+    The application hands changes over once per `update_interval` seconds, only values that actually
+    changed are written, and the write-behind cache of the storage batches them further.
+    Data of chats and users without a record in the storage (e.g. groups) is kept in memory only.
+    Args:
+        storage : db.Storage - the storage of the bot
+        update_interval : float - seconds between two hand-overs of the application
+    '''
+    def __init__(self, storage: Storage, update_interval: float = 10):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.storage = storage
+        self.conversations: Dict[int, Dict[str, Dict[str, object]]] = {}  # user_id -> name -> chat_id -> state
+        self.user_data: Dict[int, dict] = {}  # last loaded or written values, to skip writes of unchanged data
+        self.chat_data: Dict[int, dict] = {}
+
+    def _get_meta(self, user_id: int, key: str) -> Optional[object]:
+        user_id = str(user_id)
+        if not self.storage.backend.has_user(user_id):
+            return None
+        return self.storage.backend.get_meta(user_id, key)
+
+    def _set_meta(self, user_id: int, key: str, value: object) -> None:
+        user_id = str(user_id)
+        if self.storage.backend.has_user(user_id):
+            self.storage.backend.set_meta(user_id, key, value)
+
+    # ---------------------------------------------------------------- lazy loading
+    def load_user(self, user_id: int) -> Dict[str, Dict[ConversationKey, object]]:
+        ''' Conversation states of the user, {name: {(chat_id, user_id): state}}, on the first call only
+        (afterwards the application keeps them up to date itself)
+        '''
+        if user_id in self.conversations:
+            return {}
+        stored = self._get_meta(user_id, "conversations") or {}
+        self.conversations[user_id] = stored
+        return {
+            name: {(int(chat_id), user_id): state for chat_id, state in states.items()}
+            for name, states in stored.items()
+        }
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id not in self.user_data:
+            self.user_data[user_id] = self._get_meta(user_id, "user_data") or {}
+            user_data.update(copy.deepcopy(self.user_data[user_id]))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        if chat_id not in self.chat_data:
+            self.chat_data[chat_id] = self._get_meta(chat_id, "chat_data") or {}
+            chat_data.update(copy.deepcopy(self.chat_data[chat_id]))
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # ---------------------------------------------------------------- nothing is loaded eagerly
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        return {}
+
+    # ---------------------------------------------------------------- writes
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        # the key is (chat_id, user_id) with the default per_chat and per_user of the conversation
+        chat_id, user_id = key[0], key[-1]
+        self.load_user(user_id)  # do not overwrite the stored states of other chats
+        states = self.conversations[user_id].setdefault(name, {})
+        if new_state is None:
+            if states.pop(str(chat_id), None) is None:
+                return
+        elif states.get(str(chat_id)) == new_state:
+            return
+        else:
+            states[str(chat_id)] = new_state
+        self._set_meta(user_id, "conversations", self.conversations[user_id])
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if self.user_data.get(user_id) != data:
+            self.user_data[user_id] = copy.deepcopy(data)
+            self._set_meta(user_id, "user_data", data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        if self.chat_data.get(chat_id) != data:
+            self.chat_data[chat_id] = copy.deepcopy(data)
+            self._set_meta(chat_id, "chat_data", data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.user_data.pop(user_id, None)
+        self._set_meta(user_id, "user_data", None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.chat_data.pop(chat_id, None)
+        self._set_meta(chat_id, "chat_data", None)
+
+    async def flush(self) -> None:
+        ''' called by the application when it stops, the pending writes go to the storage engine '''
+        flush = getattr(self.storage.backend, "flush", None)
+        if flush is not None:
+            flush()
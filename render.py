@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+
+import metrics
+
+RENDER_CACHE = metrics.Counter("bot_render_cache_requests_total", "Lookups of rendered texts and keyboards", ["result"])
+
+
+class RenderCache():
+    ''' LRU cache of what is rendered from the data of a user: texts of menus and summaries, keyboards.
+
+    An entry is stored with the version of the user's data it was rendered from (`Storage.version`), any
+    change of the data gives a new version, so an outdated entry is never returned but rendered anew.
+    Args:
+        capacity : int - max number of rendered items, the least recently used are evicted
+    '''
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self.entries: "OrderedDict[Tuple[Hashable, ...], Tuple[int, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Tuple[Hashable, ...], version: int, render: Callable[[], Any]) -> Any:
+        ''' the item of the key rendered from the data of `version`, `render()` builds it on a miss '''
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(key)
+            RENDER_CACHE.inc("hit")
+            return entry[1]
+        RENDER_CACHE.inc("miss")
+        value = render()
+        self.entries[key] = (version, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return value
@@ -0,0 +1,222 @@
+''' Replay of a capture of inbound updates (see `capture.py`) through the whole bot.
+
+The updates are fed into the update queue of `bot.main` at their original pace, N times faster
+(--speed N) or as fast as the queue takes them (--speed 0). The Bot API is `fakes.FakeRequest` and the
+storage is the stack of `backends.make_backend` (cache, instrumentation and the configured layout) over
+`fakes.FakeReplitDB`. Every user of the capture is created first with `--logs` synthetic logs and put
+into the state of the conversation that takes their first update, so the replay does not start with
+empty histories and ignored buttons. Printed are the throughput, the latency from the arrival of an
+update until it is processed (p50/p95/p99), and the storage round-trips and Bot API calls per update.
+
+    python replay.py capture.jsonl --speed 0 --json before.json
+    python replay.py capture.jsonl --speed 0 --compare before.json --threshold 0.2
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ConversationHandler
+
+import benchmark
+import bot
+import helpers
+import metrics
+from backends import make_backend
+from cache import CachedBackend
+from capture import read_capture
+from db import PROJECTLIST, Storage
+from fakes import FakeReplitDB, FakeRequest
+from shard import user_of
+
+
+def _calls(histogram: metrics.Histogram) -> Dict[str, float]:
+    ''' calls per label of a latency histogram '''
+    return {labels[0]: counts[-1] for labels, counts in list(histogram.values.items())}
+
+
+def _total(counter: metrics.Counter) -> float:
+    return sum(counter.values.values())
+
+
+def first_states(application: Application, records: List[Tuple[float, dict]]) -> Dict[int, Tuple[int, str]]:
+    ''' user_id -> (chat_id, state): the first state of the conversation with a handler for the first update
+    of the user, users whose first update is an entry point (a command) are not in it
+    '''
+    conversation = next(handler for handlers in application.handlers.values() for handler in handlers
+                        if isinstance(handler, ConversationHandler))
+    states = {}
+    seen = set()
+    for _, raw in records:
+        user_id = user_of(raw)
+        if user_id is None or user_id in seen:
+            continue
+        seen.add(user_id)
+        update = Update.de_json(raw, application.bot)
+        if update.effective_chat is None or any(h.check_update(update) not in (None, False)
+                                                for h in conversation.entry_points):
+            continue
+        for state, handlers in conversation.states.items():
+            if any(h.check_update(update) not in (None, False) for h in handlers):
+                states[user_id] = (update.effective_chat.id, state)
+                break
+    return states
+
+
+def seed(storage: Storage, application: Application, records: List[Tuple[float, dict]], logs: int,
+         rng: random.Random) -> int:
+    ''' create the users of the capture with their histories and conversation states, returns their number '''
+    users = {user_of(raw) for _, raw in records} - {None}
+    now = helpers.now_timestamp()
+    for user_id in sorted(users):
+        benchmark.populate_user(storage, user_id, list(PROJECTLIST), logs, rng, now)
+    name = next(handler.name for handlers in application.handlers.values() for handler in handlers
+                if isinstance(handler, ConversationHandler))
+    for user_id, (chat_id, state) in first_states(application, records).items():
+        storage.backend.set_meta(str(user_id), "conversations", {name: {str(chat_id): state}})
+    if isinstance(storage.backend, CachedBackend):
+        storage.backend.flush()
+    return len(users)
+
+
+async def replay(application: Application, storage: Storage, records: List[Tuple[float, dict]], speed: float,
+                 logs: int, rng: random.Random) -> dict:
+    ''' seed the storage, feed the records into the update queue and wait until all are processed '''
+    arrivals: Dict[int, float] = {}
+    latencies: List[float] = []
+    process_update = application.process_update
+
+    async def timed_process_update(update: object) -> None:
+        try:
+            await process_update(update)
+        finally:
+            latencies.append(time.perf_counter() - arrivals.pop(id(update)))
+
+    application.process_update = timed_process_update
+    await application.initialize()
+    users = seed(storage, application, records, logs, rng)  # the handlers need the initialized bot
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    storage_before = sum(_calls(metrics.STORAGE_SECONDS).values())
+    api_before, errors_before = _total(metrics.TELEGRAM_CALLS), _total(metrics.HANDLER_ERRORS)
+    operations_before = _calls(metrics.STORAGE_SECONDS)
+    first = records[0][0]
+    started = time.perf_counter()
+    for at, raw in records:
+        if speed > 0:
+            delay = started + (at - first) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(raw, application.bot)
+        arrivals[id(update)] = time.perf_counter()
+        await application.update_queue.put(update)  # waits while the queue is full
+    await application.update_queue.join()
+    wall = time.perf_counter() - started
+
+    await application.stop()
+    await application.shutdown()  # the final flush of the storage counts as well
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    n = len(records)
+    operations = {op: calls - operations_before.get(op, 0) for op, calls in _calls(metrics.STORAGE_SECONDS).items()}
+    return {
+        "replay.update": benchmark.summarize(latencies),
+        "replay.round": {
+            "n": n, "users": users, "wall_s": wall, "updates_per_s": n / wall if wall else 0.0, "speed": speed,
+            "storage_calls_per_update": (sum(_calls(metrics.STORAGE_SECONDS).values()) - storage_before) / n,
+            "api_calls_per_update": (_total(metrics.TELEGRAM_CALLS) - api_before) / n,
+            "errors": _total(metrics.HANDLER_ERRORS) - errors_before,
+            "storage_operations": {op: calls / n for op, calls in sorted(operations.items()) if calls},
+        },
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    ''' the regressions against a previous replay of the same capture: p50 and p99 latency, throughput
+    and calls per update that got worse by more than `threshold`
+    '''
+    regressions = []
+    for key in ("p50_ms", "p99_ms"):
+        old, new = baseline.get("replay.update", {}).get(key), results["replay.update"][key]
+        if old and new / old - 1 > threshold:
+            regressions.append(f"{key} {old:.3f} -> {new:.3f} ms (+{100 * (new / old - 1):.0f}%)")
+    old_round, new_round = baseline.get("replay.round", {}), results["replay.round"]
+    old = old_round.get("updates_per_s")
+    if old and 1 - new_round["updates_per_s"] / old > threshold:
+        regressions.append(f"throughput {old:.0f} -> {new_round['updates_per_s']:.0f} updates/s")
+    for key in ("storage_calls_per_update", "api_calls_per_update"):
+        old = old_round.get(key)
+        if old and new_round[key] / old - 1 > threshold:
+            regressions.append(f"{key} {old:.2f} -> {new_round[key]:.2f}")
+    return regressions
+
+
+def print_report(results: Dict[str, dict]) -> None:
+    benchmark.print_results({key: value for key, value in results.items() if key != "replay.round"})
+    r = results["replay.round"]
+    print(f"{r['n']} updates of {r['users']} users in {r['wall_s']:.2f}s, {r['updates_per_s']:.0f} updates/s, {r['errors']:.0f} errors")
+    print(f"storage calls per update {r['storage_calls_per_update']:.2f}, "
+          f"Bot API calls per update {r['api_calls_per_update']:.2f}")
+    for operation, calls in sorted(r["storage_operations"].items(), key=lambda item: -item[1])[:8]:
+        print(f"  {operation:30s} {calls:8.3f} per update")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="JSON lines of capture.py, gzipped or not")
+    parser.add_argument("--speed", type=float, default=1.0, help="times the original pace, 0 as fast as possible")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N updates")
+    parser.add_argument("--logs", type=int, default=200, help="synthetic finished logs per user of the capture")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    parser.add_argument("--journal", action="store_true", help="keep the running timers in an event journal")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="JSON of a previous replay, exit with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    records = list(read_capture(args.capture))
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("The capture is empty")
+        return 1
+    records.sort(key=lambda record: record[0])
+    # never the journal of the bot, a temporary one if asked for
+    journal = tempfile.mkdtemp(prefix="journal-") if args.journal else None
+    os.environ.pop("STORAGE_JOURNAL", None)
+    if journal:
+        os.environ["STORAGE_JOURNAL"] = journal
+    storage = Storage(make_backend("replit", db=FakeReplitDB()))
+    bot.db = storage
+    application = bot.main("123456:REPLAY", request=FakeRequest(latency=args.latency))
+    results = asyncio.run(replay(application, storage, records, args.speed, args.logs, random.Random(args.seed)))
+    if journal:
+        shutil.rmtree(journal)
+    print_report(results)
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ("json", "compare")}
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "python": sys.version.split()[0], "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+''' Sharded deployment of the bot: one dispatcher process and N worker processes.
+
+The dispatcher (`app.py --workers N`) receives the raw updates of the webhook or of long polling and
+routes every update to the worker of its user, `helpers.shard_of(user_id, N)`, over a bounded queue of
+that worker. A worker runs the whole bot of `bot.main`: its own `Application` with the conversation,
+its own write-behind cache of the `Storage` and its own journal of the running timers
+(STORAGE_JOURNAL/shard-<i>-of-<N>, see `journal.rebalance` for a change of N). All updates of a user
+reach the same worker in the order they came, so the per-user ordering of `bot.UserOrderedApplication`
+and the cache of a user stay within one process, and the workers share nothing but the storage engine.
+'''
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, List, Optional
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import journal
+import metrics
+from helpers import shard_of
+
+# seconds the queued updates get to be processed on shutdown
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+# updates waiting for a worker, the webhook refuses the updates of its users beyond it
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", "1000"))
+# seconds between two reports of the metrics of a worker to the dispatcher
+SHARD_METRICS_INTERVAL = float(os.environ.get("SHARD_METRICS_INTERVAL", "10"))
+
+SHARD_UPDATES = metrics.Counter("shard_updates_total", "Updates routed to the workers", ["shard"])
+SHARD_RESTARTS = metrics.Counter("shard_restarts_total", "Workers started again after they died", ["shard"])
+
+logger = logging.getLogger(__name__)
+
+# messages of a worker to the dispatcher over its own pipe, (kind, index, payload)
+READY, METRICS, DONE = "ready", "metrics", "done"
+
+
+def user_of(update: dict) -> Optional[int]:
+    ''' the id of the user of a raw update, "from" of messages and queries, "user" of poll answers '''
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            return user.get("id") if isinstance(user, dict) else None
+    return None
+
+
+class Dispatcher():
+    ''' Starts the worker processes and routes raw updates to them (see the module docstring).
+
+    The workers are spawned, not forked, so none of them inherits the event loop, the threads or the
+    open storage of the dispatcher. Every worker has a queue of updates and a pipe back to the dispatcher
+    of its own, so a worker that is killed leaves no lock behind that the others wait for. A worker that
+    dies is started again by `check` with a new queue, the updates waiting in the old one are lost.
+    Args:
+        token : str - of the bot
+        count : int - number of workers
+        queue_size : int - updates waiting per worker
+        setup : Callable[[], Optional[BaseRequest]] - picklable, called in a worker after `bot` is imported,
+                may replace `bot.db` and returns the transport to the Bot API (None for the real one),
+                e.g. the fakes of `benchmark.py --workers`
+    '''
+    def __init__(self, token: str, count: int, queue_size: int = SHARD_QUEUE_SIZE,
+                 setup: Optional[Callable[[], Optional[BaseRequest]]] = None):
+        self.token = token
+        self.count = count
+        self.setup = setup
+        self.context = multiprocessing.get_context("spawn")
+        self.queue_size = queue_size
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(count)]
+        self.pipes: List[Optional[Connection]] = [None] * count  # the dispatcher ends of the pipes
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * count
+        self.ready = [threading.Event() for _ in range(count)]
+        self.metrics: Dict[str, str] = {}  # shard -> last metrics of the worker
+        self.reports: Dict[int, dict] = {}  # shard -> report of a stopped worker
+        self.stopping = False
+        self._collector = threading.Thread(target=self._collect, name="shard-collector", daemon=True)
+
+    def start(self) -> None:
+        path = os.environ.get("STORAGE_JOURNAL")
+        if path:  # before any worker opens its journal
+            moved = journal.rebalance(path, self.count, lambda user_id: shard_of(user_id, self.count))
+            if moved:
+                logger.info("Moved %d running timers to the journals of %d workers", moved, self.count)
+        for index in range(self.count):
+            self._spawn(index)
+        self._collector.start()
+
+    def _spawn(self, index: int) -> None:
+        self.ready[index].clear()
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker, name=f"shard-{index}", daemon=True,
+            args=(self.token, index, self.count, self.queues[index], writer, self.setup, os.getpid()))
+        # a spawned worker imports the main module before `run_worker` runs, the bot must see its shard already
+        environ = {"SHARD_INDEX": str(index), "SHARD_COUNT": str(self.count)}
+        saved = {key: os.environ.get(key) for key in environ}
+        os.environ.update(environ)
+        try:
+            process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        writer.close()  # the pipe ends when the worker does
+        self.pipes[index] = reader
+        self.processes[index] = process
+
+    def _collect(self) -> None:
+        # until every worker is stopped and its pipe is read to the end
+        while not (self.stopping and not any(self.pipes)):
+            for pipe in wait([pipe for pipe in self.pipes if pipe is not None], timeout=0.5):
+                try:
+                    kind, index, payload = pipe.recv()
+                except (EOFError, OSError):
+                    pipe.close()
+                    for i, current in enumerate(self.pipes):  # unless the worker was started again meanwhile
+                        if current is pipe:
+                            self.pipes[i] = None
+                    continue
+                if kind == READY:
+                    self.ready[index].set()
+                elif kind == METRICS:
+                    self.metrics[str(index)] = payload
+                elif kind == DONE:
+                    self.reports[index] = payload
+                    self.metrics[str(index)] = payload["metrics"]
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        ''' wait until every worker has started its application '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return all(event.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+                   for event in self.ready)
+
+    def route(self, body: bytes) -> Optional[str]:
+        ''' queue a raw update for the worker of its user, the reason if it was not accepted '''
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return "malformed"
+        if not isinstance(update, dict):
+            return "malformed"
+        user_id = user_of(update)
+        # updates without a user (channel posts, ...) have no per-user state, the first worker takes them
+        index = shard_of(user_id, self.count) if user_id is not None else 0
+        try:
+            self.queues[index].put_nowait(body)
+        except queue.Full:
+            return "queue_full"
+        SHARD_UPDATES.inc(str(index))
+        return None
+
+    def check(self) -> None:
+        ''' start the workers that died again '''
+        for index, process in enumerate(self.processes):
+            if not self.stopping and process is not None and not process.is_alive():
+                logger.error("Worker %d exited with %s, starting it again", index, process.exitcode)
+                SHARD_RESTARTS.inc(str(index))
+                self.queues[index].cancel_join_thread()  # nobody reads it anymore
+                self.queues[index] = self.context.Queue(maxsize=self.queue_size)
+                self._spawn(index)
+
+    def health(self) -> dict:
+        workers = [{"alive": process is not None and process.is_alive(), "ready": self.ready[i].is_set(),
+                    "queue_size": self.queues[i].qsize()} for i, process in enumerate(self.processes)]
+        return {"accepting": not self.stopping and all(w["alive"] and w["ready"] for w in workers),
+                "workers": workers}
+
+    def render_metrics(self) -> str:
+        ''' the metrics of the dispatcher and the last reported ones of every worker, labelled by shard '''
+        return metrics.merge({"": metrics.render(), **dict(sorted(self.metrics.items()))})
+
+    def stop(self, timeout: float = DRAIN_TIMEOUT) -> Dict[int, dict]:
+        ''' Let every worker process its queue (for at most `timeout` seconds) and shut down,
+        returns the reports of the workers {"updates", "malformed"} by shard
+        '''
+        self.stopping = True
+        deadline = time.monotonic() + timeout
+        for index, updates in enumerate(self.queues):
+            if self.processes[index] is not None and self.processes[index].is_alive():
+                try:
+                    updates.put(None, timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Full:
+                    logger.warning("Worker %d did not take its queue in time", index)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            # the worker gets the drain of its application on top of reading its queue
+            process.join(max(0.0, deadline - time.monotonic()) + timeout)
+            if process.is_alive():
+                logger.warning("Worker %d did not stop, killing it", index)
+                process.kill()  # it ignores SIGTERM
+                process.join()
+        self._collector.join()
+        return dict(self.reports)
+
+
+def _send(results: Connection, message: tuple) -> None:
+    try:
+        results.send(message)
+    except OSError:  # the dispatcher is gone
+        pass
+
+
+def run_worker(token: str, index: int, count: int, updates: multiprocessing.Queue,
+               results: Connection, setup: Optional[Callable[[], Optional[BaseRequest]]],
+               parent: int) -> None:
+    ''' entry point of a worker process: the bot of `bot.main` fed by the queue of its shard '''
+    os.environ["SHARD_INDEX"], os.environ["SHARD_COUNT"] = str(index), str(count)
+    # the dispatcher stops the workers through their queues, after the updates waiting in them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import bot
+    request = setup() if setup is not None else None
+    application = bot.main(token, request)
+    report = asyncio.run(_work(application, index, updates, results, parent))
+    report["metrics"] = metrics.render()
+    _send(results, (DONE, index, report))
+
+
+async def _work(application, index: int, updates: multiprocessing.Queue, results: Connection,
+                parent: int) -> dict:
+    loop = asyncio.get_running_loop()
+    report = {"updates": 0, "malformed": 0}
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    _send(results, (READY, index, None))
+
+    def read() -> None:
+        # blocking reads of the process queue, put into the bounded update queue of the application:
+        # when the application falls behind, this thread waits and the queue of the dispatcher fills up
+        while True:
+            try:
+                body = updates.get(timeout=1.0)
+            except queue.Empty:
+                if os.getppid() != parent:  # the dispatcher is gone
+                    return
+                continue
+            if body is None:
+                return
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except ValueError:
+                report["malformed"] += 1
+                continue
+            asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop).result()
+            report["updates"] += 1
+
+    async def report_metrics() -> None:
+        while True:
+            await asyncio.sleep(SHARD_METRICS_INTERVAL)
+            _send(results, (METRICS, index, metrics.render()))
+
+    reporter = asyncio.create_task(report_metrics())
+    try:
+        with ThreadPoolExecutor(1, thread_name_prefix=f"shard-{index}") as reader:
+            await loop.run_in_executor(reader, read)
+    finally:
+        reporter.cancel()
+        try:
+            await asyncio.wait_for(application.update_queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("%d updates were not processed before shutdown", application.update_queue.qsize())
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    return report
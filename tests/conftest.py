@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the modules of the bot live in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# `bot` opens its storage from the environment: a throwaway one, without a journal
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_PATH", ":memory:")
+os.environ.pop("STORAGE_JOURNAL", None)
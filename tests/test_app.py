@@ -0,0 +1,45 @@
+import asyncio
+import json
+import os
+
+from telegram.ext import Application, MessageHandler, filters
+
+os.environ.setdefault("BOT_API_KEY", "1:TOKEN")
+os.environ.setdefault("APP_URL", "https://example.invalid/")
+
+from app import WebServer
+from bot import UserOrderedApplication
+from fakes import FakeRequest, message_update
+
+
+def test_webhook_is_refused_once_the_updates_in_flight_fill_the_queue():
+    async def run():
+        release = asyncio.Event()
+
+        async def handle(update, context):
+            await release.wait()
+
+        application = (Application.builder().token("1:TOKEN").application_class(UserOrderedApplication)
+                       .concurrent_updates(8).update_queue(asyncio.Queue(maxsize=3))
+                       .request(FakeRequest()).get_updates_request(FakeRequest()).build())
+        application.update_slots = asyncio.Semaphore(4)
+        application.add_handler(MessageHandler(filters.ALL, handle))
+        server = WebServer(application, "hook")
+        await application.initialize()
+        await application.start()
+        reasons = []
+        for i in range(10):
+            reasons.append(server.deliver(json.dumps(message_update(i, "hi", update_id=i)).encode()))
+            await asyncio.sleep(0.01)
+        status = server.status()
+        release.set()
+        await asyncio.wait_for(application.update_queue.join(), 5)
+        idle = server.status()
+        await application.stop()
+        await application.shutdown()
+        return reasons, status, idle
+
+    reasons, status, idle = asyncio.run(run())
+    assert reasons == [None] * 7 + ["queue_full"] * 3
+    assert status == {"queue_size": 3, "queue_max": 3, "in_flight": 4}
+    assert idle == {"queue_size": 0, "queue_max": 3, "in_flight": 0}
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+
+from bot import UserOrderedApplication
+from fakes import FakeRequest, message_update
+from outbox import Outbox
+
+
+def test_a_burst_of_one_user_neither_reorders_nor_blocks_other_users():
+    done = []
+
+    async def handle(update, context):
+        await asyncio.sleep(0.05)
+        done.append((update.effective_user.id, update.message.text, time.monotonic()))
+
+    async def run():
+        application = (Application.builder().token("1:TOKEN").application_class(UserOrderedApplication)
+                       .concurrent_updates(8).request(FakeRequest()).get_updates_request(FakeRequest()).build())
+        application.add_handler(MessageHandler(filters.ALL, handle))
+        await application.initialize()
+        await application.start()
+        started = time.monotonic()
+        for i in range(40):
+            await application.update_queue.put(Update.de_json(message_update(1, str(i), update_id=i), application.bot))
+        await application.update_queue.put(Update.de_json(message_update(2, "b", update_id=40), application.bot))
+        await application.update_queue.join()
+        await application.stop()
+        await application.shutdown()
+        return started
+
+    started = asyncio.run(run())
+    assert [text for user, text, _ in done if user == 1] == [str(i) for i in range(40)]
+    finished_b = next(t for user, _, t in done if user == 2)
+    assert finished_b - started < 0.5  # not after the 40 updates (2 s) of the first user
+
+
+def test_the_auto_stop_is_applied_under_the_lock_and_sent_without_it(monkeypatch):
+    import bot
+
+    bot.db.add_user(11)
+    bot.db.set_deadlines(11, 0, 1)
+    _, log = bot.db.start_log(11, "Work")
+    later = log["start"] + 3600 + 5
+    monkeypatch.setattr(bot, "now_timestamp", lambda: later)
+    monkeypatch.setattr("db.now_timestamp", lambda: later)
+
+    async def run():
+        request = FakeRequest(latency=0.3)
+        application = (Application.builder().token("1:TOKEN").application_class(UserOrderedApplication)
+                       .request(request).get_updates_request(FakeRequest()).rate_limiter(Outbox()).build())
+        await application.initialize()
+        fire = asyncio.create_task(application.fire_deadline((11, "autostop"), log["start"] + 3600))
+        await asyncio.sleep(0.1)
+        locked = application.user_locks.locked(11)
+        stopped = bot.db.current_log(11)[1] is None
+        await fire
+        await application.shutdown()
+        return locked, stopped, request.calls
+
+    locked, stopped, calls = asyncio.run(run())
+    assert not locked and stopped
+    assert [params["text"].split(".")[0] for method, params in calls if method == "sendMessage"] == [
+        "⏹ Timer stopped automatically"]
+    assert max(bot.db.backend.iter_logs("11"), key=lambda item: item[1]["start"])[1]["stop"] == log["start"] + 3600
@@ -0,0 +1,102 @@
+import pytest
+
+from backends import ReplitBackend, SQLiteBackend
+from cache import CachedBackend
+from fakes import FakeReplitDB
+
+SETTINGS = {"projects": ["Work"], "timezone": "UTC"}
+LOG = {"name": "Work", "start": 100, "stop": 200, "pause": 0}
+
+
+@pytest.fixture(params=["replit", "sqlite"])
+def engine(request):
+    return ReplitBackend(FakeReplitDB()) if request.param == "replit" else SQLiteBackend(":memory:")
+
+
+def make_cache(engine, **kwargs) -> CachedBackend:
+    return CachedBackend(engine, flush_interval=3600, **kwargs)
+
+
+def test_reads_of_an_unknown_user_do_not_make_them_known(engine):
+    cache = make_cache(engine)
+    for read in (lambda: cache.get_settings("9"), lambda: cache.get_recording("9"),
+                 lambda: cache.get_log("9", "a"), lambda: cache.get_meta("9", "aggregates")):
+        try:
+            assert read() is None
+        except KeyError:  # the engines tell an unknown user by KeyError or by nothing stored
+            pass
+    assert not cache.has_user("9")
+    assert "9" not in cache.users
+    cache.close()
+
+
+def test_changes_reach_the_engine_on_flush(engine):
+    cache = make_cache(engine)
+    cache.add_user("7", SETTINGS)
+    cache.put_log("7", "a", LOG)
+    cache.set_recording("7", "a")
+    cache.set_meta("7", "aggregates", {"n": 1})
+    assert engine.get_log("7", "a") is None and engine.get_recording("7") is None
+    assert cache.get_log("7", "a") == LOG  # served from memory
+
+    assert cache.flush() == 1
+    assert engine.get_log("7", "a") == LOG
+    assert engine.get_recording("7") == "a"
+    assert engine.get_meta("7", "aggregates") == {"n": 1}
+    assert cache.flush() == 0
+    cache.close()
+
+
+def test_a_failed_flush_keeps_the_changes(engine):
+    cache = make_cache(engine)
+    cache.add_user("7", SETTINGS)
+    cache.put_log("7", "a", LOG)
+    write_batch = engine.write_batch
+
+    def broken(batch):
+        raise OSError("the engine is down")
+    engine.write_batch = broken
+    with pytest.raises(OSError):
+        cache.flush()
+    engine.write_batch = write_batch
+    assert cache.flush() == 1
+    assert engine.get_log("7", "a") == LOG
+    cache.close()
+
+
+def test_clean_users_are_evicted_and_stay_known(engine):
+    cache = make_cache(engine, capacity=2)
+    for user_id in ("1", "2", "3"):
+        cache.add_user(user_id, SETTINGS)
+    assert list(cache.users) == ["2", "3"]
+    assert cache.has_user("1")  # asked the engine, cached again
+    assert list(cache.users) == ["3", "1"]
+
+    cache.set_settings("3", {**SETTINGS, "projects": ["Sport"]})
+    cache.get_settings("2")
+    cache.get_settings("1")
+    assert "3" in cache.users  # dirty users are never evicted
+    cache.flush()
+    assert len(cache.users) == 2
+    assert engine.get_settings("3")["projects"] == ["Sport"]
+    cache.close()
+
+
+def test_flush_count_wakes_the_background_flush(engine):
+    cache = make_cache(engine, flush_count=3)
+    cache.add_user("7", SETTINGS)
+    cache.put_logs("7", {str(i): dict(LOG, start=100 + i) for i in range(3)})
+    cache._thread.join(0.5)  # the thread flushes and waits for the next change
+    assert engine.get_log("7", "2") == dict(LOG, start=102)
+    cache.close()
+
+
+def test_deleting_a_user_drops_the_pending_changes(engine):
+    cache = make_cache(engine)
+    cache.add_user("7", SETTINGS)
+    cache.put_log("7", "a", LOG)
+    cache.delete_user("7")
+    assert not cache.has_user("7")
+    cache.flush()
+    assert not engine.has_user("7")
+    cache.close()
@@ -0,0 +1,73 @@
+import gzip
+import io
+from datetime import datetime, timedelta
+
+import pytest
+
+from backends import ReplitBackend
+from db import Storage
+from fakes import FakeReplitDB
+from importer import LogImporter, _open_text, read_rows
+
+CSV = "START,STOP,PROJECT\n2024-01-02 09:00,2024-01-02 10:30,Work\n2024-01-02 11:00,2024-01-02 12:00,Sport\n"
+
+
+def make_storage() -> Storage:
+    storage = Storage(ReplitBackend(FakeReplitDB()))
+    storage.add_user(7)
+    return storage
+
+
+def rows(data: bytes) -> list:
+    return list(read_rows(io.BytesIO(data)))
+
+
+def test_csv_json_and_gzip_give_the_same_rows():
+    json_rows = rows(b'[{"Start": "2024-01-02 09:00", "End": "2024-01-02 10:30", "Task": "Work"}]')
+    assert json_rows == [(1, {"start": "2024-01-02 09:00", "stop": "2024-01-02 10:30", "project": "Work"})]
+    assert rows(gzip.compress(CSV.encode())) == rows(CSV.encode())
+    assert [line for line, _ in rows(CSV.encode())] == [2, 3]
+
+
+@pytest.mark.parametrize("data, reason", [
+    (b"\x1f\x8bnot gzip at all", "not a valid gzip file"),
+    (gzip.compress(CSV.encode() * 1000)[:-40], "cut off or damaged"),
+    (b'[{"start": "2024-01-02 09:00", "stop": ', "invalid JSON"),
+    (b'{"logs": {"a": {"start": 1}} ', "invalid JSON"),
+    ("START,STOP,PROJECT\n1,2,Café\n".encode("latin-1"), "not UTF-8"),
+    (b"START,STOP,PROJECT\n1,2," + b"x" * 200000 + b"\n", "broken CSV in line 2"),
+    (b"WHEN,WHAT\n1,2\n", "the first line must name the columns"),
+])
+def test_broken_files_raise_a_readable_value_error(data, reason):
+    with pytest.raises(ValueError, match=reason):
+        rows(data)
+
+
+def test_a_gzip_bomb_is_refused():
+    with pytest.raises(ValueError, match="larger than 1 MB"):
+        _open_text(io.BytesIO(gzip.compress(b"0" * (3 << 20))), max_bytes=1 << 20).read()
+
+
+def test_a_file_imported_twice_adds_nothing():
+    storage = make_storage()
+    data = CSV + "2024-01-02 09:00,2024-01-02 10:30,Work\nnot a time,2024-01-02 10:30,Work\n"
+    report = LogImporter(storage, 7).run(io.BytesIO(data.encode()))
+    assert (report.rows, report.imported, report.duplicates, sum(report.invalid.values())) == (4, 2, 1, 1)
+    assert report.errors[0].startswith("5: ")
+
+    again = LogImporter(storage, 7).run(io.BytesIO(gzip.compress(data.encode())))
+    assert (again.imported, again.duplicates) == (0, 3)
+    assert len(dict(storage.backend.iter_logs("7"))) == 2
+
+
+def test_the_batches_before_a_broken_part_are_kept():
+    storage = make_storage()
+    start = datetime(2024, 2, 1)
+    lines = (f"{start + timedelta(hours=i):%Y-%m-%d %H:%M},{start + timedelta(hours=i, minutes=30):%Y-%m-%d %H:%M},Work\n"
+             for i in range(5000))  # more than the first read of the file
+    data = gzip.compress((CSV + "".join(lines)).encode())[:-20]
+    with pytest.raises(ValueError, match="cut off"):
+        LogImporter(storage, 7, batch_size=500).run(io.BytesIO(data))
+    stored = len(dict(storage.backend.iter_logs("7")))
+    assert stored and stored % 500 == 0
+    assert storage.aggregate_user_logs(7)[0]["Work"]["n_logs"] + storage.aggregate_user_logs(7)[0]["Sport"]["n_logs"] == stored
@@ -0,0 +1,120 @@
+from backends import ReplitBackend
+from cache import CachedBackend
+from db import Storage
+from fakes import FakeReplitDB
+from journal import Journal, rebalance
+
+
+def open_storage(engine, path, snapshot_every=2):
+    ''' a bot storage as after a (re)start: a cold write-behind cache that only flushes when asked '''
+    backend = CachedBackend(engine, flush_interval=3600, flush_count=10 ** 6)
+    storage = Storage(backend, journal=Journal(path, shards=1, snapshot_every=snapshot_every))
+    storage.journal  # opened and replayed
+    return storage
+
+
+def crash(storage):
+    ''' lose the unflushed cache and leave the journal files as they are '''
+    storage.backend.flush = lambda user_id=None: 0  # the flush thread and atexit write nothing any more
+    storage.backend._stopped.set()
+    for shard in storage.journal.shards:
+        shard.close()
+
+
+def test_stopped_log_survives_a_crash_after_compaction(tmp_path):
+    engine = ReplitBackend(FakeReplitDB())
+    storage = open_storage(engine, str(tmp_path))
+    storage.add_user(7)
+    storage.start_log(7, "Work")
+    log = storage.stop_log(7)  # the second event, its shard is compacted
+    crash(storage)
+
+    storage = open_storage(engine, str(tmp_path))
+    logs = dict(storage.backend.iter_logs("7"))
+    assert [(l["name"], l["start"], l["stop"]) for l in logs.values()] == [("Work", log["start"], log["stop"])]
+    assert storage.current_log(7) == (None, None)
+    assert storage.aggregate_user_logs(7)[0]["Work"]["n_logs"] == 1
+
+
+def test_project_edit_survives_a_crash_after_compaction(tmp_path):
+    engine = ReplitBackend(FakeReplitDB())
+    storage = open_storage(engine, str(tmp_path))
+    storage.add_user(7)
+    storage.add_project(7, "Garden")
+    storage.remove_project(7, "Sport")  # the second event, its shard is compacted
+    crash(storage)
+
+    storage = open_storage(engine, str(tmp_path))
+    projects = storage.settings(7)["projects"]
+    assert "Garden" in projects and "Sport" not in projects
+
+
+def test_deleted_log_stays_deleted_after_a_crash(tmp_path):
+    engine = ReplitBackend(FakeReplitDB())
+    storage = open_storage(engine, str(tmp_path))
+    storage.add_user(7)
+    storage.start_log(7, "Garden")
+    storage.stop_log(7)
+    log_id = next(iter(dict(storage.backend.iter_logs("7"))))
+    storage.start_log(7, "Work")
+    storage.delete_log(7, log_id)  # compacted once the log is deleted from the cache
+    crash(storage)
+
+    storage = open_storage(engine, str(tmp_path))
+    assert dict(storage.backend.iter_logs("7")) == {}
+    assert storage.current_log(7)[1]["name"] == "Work"
+
+
+def test_running_timer_is_replayed_exactly(tmp_path):
+    engine = ReplitBackend(FakeReplitDB())
+    storage = open_storage(engine, str(tmp_path), snapshot_every=1000)
+    storage.add_user(7)
+    log_id, _ = storage.start_log(7, "Work")
+    storage.pause_log(7)
+    before = storage.current_log(7)
+    crash(storage)
+
+    storage = open_storage(engine, str(tmp_path), snapshot_every=1000)
+    assert storage.current_log(7) == before
+    assert storage.current_log(7)[0] == log_id
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    journal = Journal(str(tmp_path), shards=1)
+    journal.append("7", "start", 100, id="a", name="Work")
+    journal.append("7", "pause", 150)
+    for shard in journal.shards:
+        shard.close()
+    with open(tmp_path / "journal-000.log", "ab") as f:
+        f.write(b'{"s":3,"u":"7","k":"res')
+
+    journal = Journal(str(tmp_path), shards=1)
+    assert journal.timer("7") == {"id": "a", "name": "Work", "start": 100, "pause": 0, "paused_at": 150}
+    journal.append("7", "resume", 200)  # written after the valid events, not after the torn one
+    journal.close()
+    assert Journal(str(tmp_path), shards=1).timer("7")["pause"] == 50
+
+
+def test_rebalance_moves_closed_journals_and_refuses_unclean_ones(tmp_path):
+    path = str(tmp_path)
+    journal = Journal(path, shards=4)
+    for user in range(10):
+        journal.append(str(user), "start", 100 + user, id=f"log{user}", name="Work")
+    journal.close()
+
+    assert rebalance(path, 2, lambda user_id: int(user_id) % 2) == 10
+    for index in range(2):
+        moved = Journal(f"{path}/shard-{index}-of-2", shards=16)
+        assert sorted(int(user) for user, _ in moved.running()) == list(range(index, 10, 2))
+        if index == 0:
+            moved.append("0", "stop", 200)
+            for shard in moved.shards:  # left with its event, like after a crash
+                shard.close()
+        else:
+            moved.close()
+    try:
+        rebalance(path, 1, lambda user_id: 0)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("an unclean journal was moved")
@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram.ext import ExtBot
+
+from fakes import FakeRequest
+from live import LiveTimers
+from locks import KeyedLock
+from outbox import Outbox, BACKGROUND
+
+
+def make_bot(request: FakeRequest, outbox: Outbox) -> ExtBot:
+    return ExtBot("1:TOKEN", request=request, get_updates_request=FakeRequest(), rate_limiter=outbox)
+
+
+def test_the_user_lock_is_free_while_the_edit_is_sent():
+    async def run():
+        request = FakeRequest(latency=0.3)
+        bot = make_bot(request, Outbox())
+        await bot.initialize()
+        locks = KeyedLock()
+        live = LiveTimers(bot, lambda user_id: ("log", "0:01", None), locks)
+        live.add(7, 7, 10, "log", "0:00")
+        refresh = asyncio.create_task(live.refresh(live.entry(7)))
+        await asyncio.sleep(0.1)
+        locked = locks.locked(7)
+        await refresh
+        await bot.shutdown()
+        return locked, live.entry(7).text, request.calls
+
+    locked, text, calls = asyncio.run(run())
+    assert not locked
+    assert text == "0:01"
+    assert [(method, params["text"]) for method, params in calls if method == "editMessageText"] == [("editMessageText", "0:01")]
+
+
+def test_an_edit_of_a_handler_is_not_overtaken_by_an_older_refresh():
+    async def run():
+        request = FakeRequest()
+        bot = make_bot(request, Outbox(chat_burst=1))
+        await bot.initialize()
+        await bot.send_message(7, "the timer", rate_limit_args=BACKGROUND)  # the chat waits a second now
+        live = LiveTimers(bot, lambda user_id: ("log", "0:01", None), KeyedLock())
+        live.add(7, 7, 10, "log", "0:00")
+        refresh = asyncio.create_task(live.refresh(live.entry(7)))
+        await asyncio.sleep(0.1)
+        # the user stops the timer, the handler edits the message while the refresh waits for the chat
+        live.remove(7)
+        await bot.edit_message_text("stopped", chat_id=7, message_id=10)
+        await refresh
+        await bot.shutdown()
+        return request.calls
+
+    calls = asyncio.run(run())
+    assert [params["text"] for method, params in calls if method == "editMessageText"] == ["stopped"]
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from outbox import Outbox, USER, BACKGROUND
+
+
+def call(outbox, sent, name, endpoint="sendMessage", priority=None, chat_id=7, message_id=None):
+    async def callback():
+        sent.append(name)
+        return name
+    data = {"chat_id": chat_id}
+    if message_id is not None:
+        data["message_id"] = message_id
+    return asyncio.create_task(outbox.process_request(callback, (), {}, endpoint, data, priority))
+
+
+async def queued(outbox, make_calls):
+    ''' start the calls while the outbox holds back, so they all wait for a slot at once '''
+    await outbox.initialize()
+    outbox.blocked_until = time.monotonic() + 0.1
+    tasks = make_calls()
+    results = await asyncio.gather(*tasks)
+    await outbox.shutdown()
+    return results
+
+
+def test_calls_are_sent_by_priority():
+    sent = []
+
+    async def run():
+        outbox = Outbox(rate=100)
+        return await queued(outbox, lambda: [
+            call(outbox, sent, "background", priority=BACKGROUND, chat_id=1),
+            call(outbox, sent, "user", chat_id=2),
+            call(outbox, sent, "answer", endpoint="answerCallbackQuery", chat_id=3),
+        ])
+
+    asyncio.run(run())
+    assert sent == ["answer", "user", "background"]
+
+
+def test_background_calls_keep_their_share_of_the_slots():
+    sent = []
+
+    async def run():
+        outbox = Outbox(rate=200, background_share=0.25)
+        return await queued(outbox, lambda: [
+            call(outbox, sent, f"background {i}", priority=BACKGROUND, chat_id=100 + i) for i in range(3)
+        ] + [call(outbox, sent, f"user {i}", priority=USER, chat_id=i) for i in range(20)])
+
+    asyncio.run(run())
+    assert [i for i, name in enumerate(sent) if name.startswith("background")] == [3, 7, 11]
+    assert [name for name in sent if name.startswith("background")] == [f"background {i}" for i in range(3)]
+
+
+def test_a_waiting_edit_is_replaced_by_a_newer_one_along_the_whole_chain():
+    sent = []
+
+    async def run():
+        outbox = Outbox(rate=100)
+        return await queued(outbox, lambda: [
+            call(outbox, sent, f"edit {i}", endpoint="editMessageText", priority=priority, message_id=10)
+            for i, priority in enumerate([BACKGROUND, USER, BACKGROUND, BACKGROUND])
+        ] + [call(outbox, sent, "other message", endpoint="editMessageText", message_id=11)])
+
+    results = asyncio.run(run())
+    assert sorted(sent) == ["edit 3", "other message"]
+    assert results == ["edit 3"] * 4 + ["other message"]
+    assert sent[0] == "edit 3"  # it kept the priority of the USER edit it replaced
+
+
+def test_a_sent_edit_is_not_replaced():
+    sent = []
+
+    async def run():
+        outbox = Outbox(rate=100)
+        await outbox.initialize()
+        first = await call(outbox, sent, "edit 0", endpoint="editMessageText", message_id=10)
+        second = await call(outbox, sent, "edit 1", endpoint="editMessageText", message_id=10)
+        await outbox.shutdown()
+        return first, second
+
+    assert asyncio.run(run()) == ("edit 0", "edit 1")
+    assert sent == ["edit 0", "edit 1"]
+
+
+def test_interactive_calls_do_not_wait_for_the_chat():
+    sent = []
+
+    async def run():
+        outbox = Outbox(rate=100, chat_burst=1)
+        await outbox.initialize()
+        started = time.monotonic()
+        await asyncio.gather(call(outbox, sent, "background 0", priority=BACKGROUND),
+                             call(outbox, sent, "background 1", priority=BACKGROUND))
+        background = time.monotonic() - started
+        started = time.monotonic()
+        await asyncio.gather(*(call(outbox, sent, f"answer {i}", endpoint="answerCallbackQuery") for i in range(3)))
+        interactive = time.monotonic() - started
+        await outbox.shutdown()
+        return background, interactive
+
+    background, interactive = asyncio.run(run())
+    assert background >= 0.9  # one BACKGROUND call per second in a private chat
+    assert interactive < 0.2
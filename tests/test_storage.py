@@ -0,0 +1,68 @@
+import io
+
+import pytest
+
+import aggregates
+from backends import ReplitBackend, SQLiteBackend
+from cache import CachedBackend
+from db import Storage
+from fakes import FakeReplitDB
+from importer import LogImporter
+from journal import Journal
+
+
+@pytest.fixture(params=["replit", "sqlite", "replit+journal"])
+def storage(request, tmp_path):
+    engine = SQLiteBackend(":memory:") if request.param == "sqlite" else ReplitBackend(FakeReplitDB())
+    journal = Journal(str(tmp_path), shards=2, snapshot_every=3) if request.param.endswith("journal") else None
+    storage = Storage(CachedBackend(engine, flush_interval=3600), journal=journal)
+    storage.add_user(7)
+    yield storage
+    storage.close()
+
+
+def assert_aggregates_match(storage):
+    columns = storage.backend.log_columns("7")
+    assert storage.aggregates(7) == aggregates.rebuild_columns(columns, skip=storage.current_log(7)[0])
+    assert storage.verify_aggregates(7, repair=False)
+
+
+def test_aggregates_follow_stop_delete_and_import(storage):
+    for project in ("Work", "Sport", "Work"):
+        storage.start_log(7, project)
+        storage.pause_log(7)
+        storage.resume_log(7)
+        storage.stop_log(7)
+        assert_aggregates_match(storage)
+    assert storage.aggregate_user_logs(7)[0]["Work"]["n_logs"] == 2
+
+    storage.start_log(7, "Education")  # the running log is not counted
+    assert_aggregates_match(storage)
+    storage.start_log(7, "Work")  # stops the running one first
+    assert_aggregates_match(storage)
+
+    finished = [log_id for log_id, log in storage.backend.iter_logs("7") if log["name"] == "Sport"]
+    storage.delete_log(7, finished[0])
+    assert_aggregates_match(storage)
+    assert "Sport" not in storage.aggregate_user_logs(7)[0]
+    storage.delete_log(7, storage.current_log(7)[0])  # dropping the running log changes nothing
+    assert_aggregates_match(storage)
+
+    csv = "START,STOP,PROJECT\n2024-01-02 09:00,2024-01-02 10:30,Work\n2024-01-03 09:00,2024-01-03 09:45,Garden\n"
+    report = LogImporter(storage, 7).run(io.BytesIO(csv.encode()))
+    assert report.imported == 2
+    assert_aggregates_match(storage)
+    assert storage.aggregate_user_logs(7)[0]["Garden"]["n_logs"] == 1
+
+    storage.reset_user_data(7, only_logs=True)
+    assert_aggregates_match(storage)
+    assert storage.aggregate_user_logs(7)[0] == {}
+
+
+def test_a_timezone_change_keeps_the_aggregates(storage):
+    storage.start_log(7, "Work")
+    storage.stop_log(7)
+    before = storage.aggregates(7)
+    storage.set_timezone(7, "Europe/Berlin")
+    assert storage.aggregates(7) == before
+    assert_aggregates_match(storage)
@@ -0,0 +1,175 @@
+import calendar
+import functools
+import re
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from helpers import Timezone, zone
+
+DAY = 86400
+_TWO_DIGITS = [f"{i:02d}" for i in range(60)]
+_HOURS = _TWO_DIGITS[:24]
+_FIELDS = {"%H": "{0}", "%M": "{1}", "%S": "{2}"}
+
+
+class TimestampFormatter():
+    ''' Formats many epoch timestamps in the timezone of a user at once (tables and exports of logs).
+
+    `strftime` is called once per local day, not per timestamp: the parts of the format that depend on
+    the day (date, weekday, ...) are rendered into a template that is kept, and the time of the day
+    (%H, %M, %S) is taken from the seconds since the local midnight. The few days with a change of the
+    UTC offset (DST) are not kept, their timestamps are formatted one by one.
+    Args:
+        tz : Timezone - hours east of UTC or an IANA name (see `helpers.zone`)
+        fmt : str - strftime format
+        max_days : int - days kept, the oldest half is dropped beyond it
+    '''
+    def __init__(self, tz: Timezone = 0, fmt: str = "%d.%m.%Y %H:%M", max_days: int = 4096):
+        self.zone = zone(tz)
+        self.fmt = fmt
+        self.max_days = max_days
+        # the format split into strftime parts and time fields, "%%" stays with the strftime parts
+        self.parts = [part for part in re.split(r"(%%|%[HMS])", fmt) if part]
+        # local day number -> (first second, end, template or None on a DST day)
+        self.days: Dict[int, Tuple[int, int, Optional[str]]] = {}
+        self.offset = 0  # UTC offset of the last day looked up, a guess of the day of the next timestamp
+
+    def _day(self, ts: int) -> Tuple[int, int, Optional[str]]:
+        day = self.days.get((ts + self.offset) // DAY)
+        if day is not None and day[0] <= ts < day[1]:
+            return day
+        midnight = datetime.fromtimestamp(ts, self.zone).replace(hour=0, minute=0, second=0, microsecond=0)
+        following = midnight + timedelta(days=1)
+        since, until = int(midnight.timestamp()), int(following.timestamp())
+        self.offset = int(midnight.utcoffset().total_seconds())
+        template = None
+        if until - since == DAY and midnight.utcoffset() == following.utcoffset():
+            template = "".join(_FIELDS.get(part) or midnight.strftime(part).replace("{", "{{").replace("}", "}}")
+                               for part in self.parts)
+        if len(self.days) >= self.max_days:
+            for key in list(self.days)[:self.max_days // 2]:
+                self.days.pop(key, None)  # the formatter is shared by threads
+        day = self.days[(since + self.offset) // DAY] = (since, until, template)
+        return day
+
+    def format(self, ts: int) -> str:
+        since, _, template = self._day(ts)
+        if template is None:
+            return datetime.fromtimestamp(ts, self.zone).strftime(self.fmt)
+        seconds = ts - since
+        return template.format(_HOURS[seconds // 3600], _TWO_DIGITS[seconds // 60 % 60], _TWO_DIGITS[seconds % 60])
+
+    def column(self, timestamps: Iterable[int]) -> List[str]:
+        ''' the formatted timestamps, in one pass '''
+        out = []
+        append = out.append
+        since, until, template = 0, 0, None
+        for ts in timestamps:
+            if not since <= ts < until:  # logs come sorted, most timestamps fall on the day of the previous one
+                since, until, template = self._day(ts)
+            if template is None:
+                append(datetime.fromtimestamp(ts, self.zone).strftime(self.fmt))
+            else:
+                seconds = ts - since
+                append(template.format(_HOURS[seconds // 3600], _TWO_DIGITS[seconds // 60 % 60],
+                                       _TWO_DIGITS[seconds % 60]))
+        return out
+
+
+@functools.lru_cache(maxsize=1024)
+def formatter(tz: Timezone = 0, fmt: str = "%d.%m.%Y %H:%M") -> TimestampFormatter:
+    ''' the formatter of a timezone and format, shared so its days are rendered once per process '''
+    return TimestampFormatter(tz, fmt)
+
+
+# "dd.mm.yyyy" (exports) or "yyyy-mm-dd" (ISO 8601), optionally with a time and an explicit UTC offset
+_DATETIME = re.compile(r"(?:(\d{1,2})\.(\d{1,2})\.(\d{4})|(\d{4})-(\d{1,2})-(\d{1,2}))"
+                       r"(?:[ T](\d{1,2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)?\s*(Z|[+-]\d{2}:?\d{2})?$")
+_DURATION = re.compile(r"(?:(\d+) days?, )?(\d+):(\d{2})(?::(\d{2}))?$")
+
+
+class TimestampParser():
+    ''' Parses many dates and times in the timezone of a user at once (imports), the inverse of `TimestampFormatter`.
+
+    Understands the format of the exports "dd.mm.yyyy HH:MM[:SS]", ISO 8601 "yyyy-mm-dd[THH:MM[:SS[.f]]][Z|+HH:MM]"
+    and epoch seconds. The local midnight of a day is found once and the time of the day added to it,
+    times without an offset on a day with a change of the UTC offset (DST) are converted one by one.
+    Args:
+        tz : Timezone - of the times without an explicit offset
+        max_days : int - days kept, the oldest half is dropped beyond it
+    '''
+    def __init__(self, tz: Timezone = 0, max_days: int = 4096):
+        self.zone = zone(tz)
+        self.max_days = max_days
+        self.days: Dict[Tuple[int, int, int], Tuple[int, bool]] = {}  # (y, m, d) -> (local midnight, regular day)
+
+    def _day(self, year: int, month: int, day: int) -> Tuple[int, bool]:
+        key = (year, month, day)
+        found = self.days.get(key)
+        if found is None:
+            midnight = datetime(year, month, day, tzinfo=self.zone)
+            following = midnight + timedelta(days=1)
+            since = int(midnight.timestamp())
+            regular = int(following.timestamp()) - since == DAY and midnight.utcoffset() == following.utcoffset()
+            if len(self.days) >= self.max_days:
+                for old in list(self.days)[:self.max_days // 2]:
+                    self.days.pop(old, None)
+            found = self.days[key] = (since, regular)
+        return found
+
+    def parse(self, text: str) -> int:
+        ''' epoch seconds of the text, ValueError if it is not a date '''
+        text = text.strip()
+        if text.isdigit():
+            ts = int(text)
+            return ts // 1000 if ts > 10 ** 11 else ts  # milliseconds
+        match = _DATETIME.match(text)
+        if match is None:
+            raise ValueError(f"not a date: {text[:40]!r}")
+        d, m, y, y2, m2, d2, hours, minutes, seconds, offset = match.groups()
+        year, month, day = (int(y), int(m), int(d)) if y else (int(y2), int(m2), int(d2))
+        hours, minutes, seconds = int(hours or 0), int(minutes or 0), int(seconds or 0)
+        if hours > 23 or minutes > 59 or seconds > 59:
+            raise ValueError(f"not a time: {text[:40]!r}")
+        time_of_day = hours * 3600 + minutes * 60 + seconds
+        if offset is not None:
+            if offset == "Z":
+                shift = 0
+            else:
+                digits = offset[1:].replace(":", "")
+                shift = (int(digits[:2]) * 3600 + int(digits[2:]) * 60) * (-1 if offset[0] == "-" else 1)
+            datetime(year, month, day)  # validates the date
+            return calendar.timegm((year, month, day, 0, 0, 0)) + time_of_day - shift
+        midnight, regular = self._day(year, month, day)
+        if regular:
+            return midnight + time_of_day
+        return int(datetime(year, month, day, hours, minutes, seconds, tzinfo=self.zone).timestamp())
+
+
+@functools.lru_cache(maxsize=1024)
+def parser(tz: Timezone = 0) -> TimestampParser:
+    ''' the parser of a timezone, shared so its days are computed once per process '''
+    return TimestampParser(tz)
+
+
+def parse_duration(text: str) -> int:
+    ''' seconds of "1:02:03", "2 days, 1:02:03" (the text of `duration`), "1:02" or plain seconds '''
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    match = _DURATION.match(text)
+    if match is None:
+        raise ValueError(f"not a duration: {text[:40]!r}")
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * DAY + int(hours) * 3600 + int(minutes) * 60 + int(seconds or 0)
+
+
+def duration(seconds: int) -> str:
+    ''' same text as `helpers.timedelta_to_str`, "1:02:03", without building a timedelta below a day '''
+    if 0 <= seconds < DAY:
+        return f"{seconds // 3600}:{_TWO_DIGITS[seconds // 60 % 60]}:{_TWO_DIGITS[seconds % 60]}"
+    return str(timedelta(seconds=seconds))
+
+
+def durations(column: Iterable[int]) -> List[str]:
+    return [duration(seconds) for seconds in column]